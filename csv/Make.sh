@@ -1,12 +1,8 @@
 #!/bin/bash
 
-python3 make_config_macros.py
+# Generates the variant configs in memory and translates them together with ../*.cfg, only ../../translate/
+# is written. The build is incremental: a .build_manifest.json there records what each file was built from,
+# and only files whose inputs changed are rewritten.
+# make_config_macros.py writes the generated *_config_*.cfg to ../ if you need to look at them.
 
-for i in *.csv; do
-    python3 translate.py $i ../../translate/
-done
-
-rm ../ff5m_config_native.cfg
-rm ../ff5m_config_off.cfg
-rm ../ad5x_config_native.cfg
-rm ../ad5x_config_off.cfg
+python3 build.py *.csv ../../translate/
@@ -0,0 +1,57 @@
+import argparse
+import os
+
+from make_config_macros import generate
+from translate import load_sources, pack, report, translate
+from variant_matrix import load_matrix
+
+# Usage: python3 build.py [--jobs N] [--pack] <lang.csv> [<lang.csv> ...] <translate_dir>
+#
+# Generate and translate in one process. The variant configs of variants.json are generated into memory and handed to
+# the translator as sources next to the hand-written ../*.cfg, so nothing but translate_dir/<lang>/ is ever written:
+# no ../*_config_*.cfg to write, read back and delete, and no stale ones left behind by another build to pick up.
+#
+# make_config_macros.py and translate.py still work on their own, for looking at the generated files.
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the variant configs and translate all configs in one pass.")
+    parser.add_argument('catalogs', nargs='+', metavar='lang.csv')
+    parser.add_argument('translate_dir')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help="number of variants / languages processed in parallel (default: number of CPUs)")
+    parser.add_argument('--no-optimize', action='store_true',
+                        help="translate the macros exactly as emitted, without the jinja_optimizer pass")
+    parser.add_argument('--trace', action='store_true',
+                        help="wrap the generated code in ZMOD_TRACE_POINT spans for extras/zmod_trace.py")
+    parser.add_argument('--matrix', default='variants.json')
+    parser.add_argument('--source-dir', default='../')
+    parser.add_argument('--report', action='store_true',
+                        help="only report missing, unused and duplicate keys for each language, do not translate")
+    parser.add_argument('--pack', action='store_true',
+                        help="write content-addressed language packs to translate_dir instead of one tree per language")
+    args = parser.parse_args()
+
+    translate_dir = args.translate_dir
+    if not translate_dir.strip():
+        translate_dir = "../../"
+
+    matrix = load_matrix(args.matrix)
+    outputs = list(matrix.outputs.items())
+    results = generate([key for _, key in outputs], not args.no_optimize, args.jobs, trace=args.trace)
+
+    generated = {}
+    for (output_file, _), (text, stats) in zip(outputs, results):
+        generated[os.path.basename(output_file)] = text
+        if stats != None:
+            print(f"{os.path.basename(output_file)}: {stats.summary()}")
+
+    sources = load_sources(args.source_dir, generated)
+    if args.report:
+        report(sources, args.catalogs)
+    elif args.pack:
+        pack(sources, args.catalogs, translate_dir)
+    else:
+        translate(sources, args.catalogs, translate_dir, args.jobs)
+
+if __name__ == "__main__":
+    main()
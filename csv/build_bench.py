@@ -0,0 +1,283 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from build_manifest import MANIFEST_NAME
+from catalogs import CATALOG_CACHE_DIR
+from make_config_macros import generate, load_template, render_config
+from settings_model import compile_settings
+from translate import load_sources, translate
+from variant_matrix import load_matrix
+
+# Usage: python3 build_bench.py [--quick] [--json report.json] [--check baseline.json]
+#
+# Scaling benchmark for the build. The generator and the translator are fed synthetic inputs built from the real ones,
+# so their shape stays what the build sees:
+#
+#   generate   zmod_settings.json grown to --settings entries (44 .. 5000). Copies of the real settings get their own
+#              names and texts, n/g/x/m condition codes rotated over their get_zmod_data_text keys and a
+#              show_condition on an earlier copy for every fourth one. All variants of variants.json are rendered and
+#              optimized, as make_config_macros.py does.
+#   translate  The real config tree, generated files included, repeated up to --lines lines (10k .. 1M) and split into
+#              files of about FILE_LINES lines, translated into one language; then the real tree translated into
+#              --languages languages (1 .. 50), the 12 real catalogs reused under new names past the 12th.
+#
+# Every case reports the best wall time over --repeat runs, the peak Python heap of one more run under tracemalloc
+# and the bytes it produced. Translate runs are cold: a fresh output directory and catalog cache every time.
+#
+# --json writes the report together with the thresholds it should be held to. --check compares this run with such a
+# report and exits with 1 if any case got slower, bigger in memory or bigger in output than the thresholds allow.
+# Wall times only compare on the same machine; peak memory and output bytes are portable.
+
+SETTINGS_COUNTS = (44, 500, 5000)
+LINE_COUNTS = (10000, 100000, 1000000)
+LANGUAGE_COUNTS = (1, 12, 50)
+
+FILE_LINES = 10000
+
+# Allowed ratio of this run to the baseline.
+DEFAULT_THRESHOLDS = {'wall_s': 1.5, 'peak_bytes': 1.25, 'output_bytes': 1.05}
+
+CONDITION_CODES = ('', 'n', 'g', 'x', 'm')
+
+def synthetic_settings(settings_json_data, count):
+    # The real settings first, then numbered copies of the non-special ones until there are count of them.
+    settings = dict(settings_json_data['Settings'])
+    templates = [(name, data) for name, data in settings_json_data['Settings'].items() if data.get('type') != 'special']
+    previous = {}
+    copy = 1
+    while len(settings) < count:
+        for name, data in templates:
+            if len(settings) >= count:
+                break
+            data = json.loads(json.dumps(data))
+            new_name = f"{name}_{copy}"
+            is_string = data.get('type') == 'string'
+
+            texts = {}
+            for index, (key, text) in enumerate(data.get('get_zmod_data_text', {}).items()):
+                if not is_string and key != '*' and key.isdigit():
+                    key += CONDITION_CODES[(copy + index) % len(CONDITION_CODES)]
+                # A text of its own, so the copy adds a marker to translate like a real setting would.
+                texts[key] = text[:-3] + f" {copy}===" if text.endswith('===') else text
+            data['get_zmod_data_text'] = texts
+            data.pop('global_text', None)
+
+            # show_condition may only reference settings emitted before this one, so pick the last copy of the same
+            # category.
+            category = data.get('category', '')
+            if copy % 4 == 0 and category in previous:
+                earlier = previous[category]
+                quote = '"' if earlier[2] else ''
+                data['show_condition'] = f"z{earlier[0].lower()} == {quote}{earlier[1]}{quote}"
+            else:
+                data.pop('show_condition', None)
+            previous[category] = (new_name, data.get('default', '' if is_string else 0), is_string)
+
+            settings[new_name] = data
+        copy += 1
+    return {'Categories': settings_json_data['Categories'], 'Settings': settings}
+
+def synthetic_tree(sources, line_count):
+    # sources repeated until line_count lines, in files of about FILE_LINES lines.
+    lines = []
+    for _, text in sources:
+        lines += text.split('\n')
+    tree = []
+    written = 0
+    while written < line_count:
+        size = min(FILE_LINES, line_count - written)
+        chunk = [lines[(written + index) % len(lines)] for index in range(size)]
+        tree.append((f"synthetic_{len(tree):04d}.cfg", '\n'.join(chunk)))
+        written += size
+    return tree
+
+def synthetic_catalogs(catalog_files, count, work_dir):
+    # The real catalogs, reused under new names until there are count of them.
+    catalog_dir = os.path.join(work_dir, 'catalogs')
+    os.makedirs(catalog_dir, exist_ok=True)
+    catalogs = []
+    for index in range(count):
+        source = catalog_files[index % len(catalog_files)]
+        name = os.path.splitext(os.path.basename(source))[0]
+        if index >= len(catalog_files):
+            name += str(index // len(catalog_files))
+        target = os.path.join(catalog_dir, f"{name}.csv")
+        shutil.copyfile(source, target)
+        catalogs.append(target)
+    return catalogs
+
+def _directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+def measure(run, repeat):
+    # run() returns the output size. Returns (best wall time, peak heap, output bytes).
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output_bytes = run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak, output_bytes
+
+def bench_generate(settings_json_data, count, keys, repeat):
+    data = synthetic_settings(settings_json_data, count)
+    template = load_template()
+
+    def run():
+        model = compile_settings(data, keys)
+        return sum(len(render_config(is_ad5x, is_native_screen, model, True, template)[0].encode('utf-8'))
+                   for is_ad5x, is_native_screen in keys)
+
+    return measure(run, repeat)
+
+def bench_translate(sources, catalogs, work_dir, repeat, jobs):
+    def run():
+        output_dir = os.path.join(work_dir, 'out')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        shutil.rmtree(os.path.join(work_dir, CATALOG_CACHE_DIR), ignore_errors=True)
+        # The catalog cache is kept relative to the working directory.
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                translate(sources, catalogs, output_dir, jobs)
+        finally:
+            os.chdir(cwd)
+        return _directory_bytes(output_dir) - os.path.getsize(os.path.join(output_dir, MANIFEST_NAME))
+
+    return measure(run, repeat)
+
+def compare(cases, baseline, thresholds):
+    # Returns the lines describing every regression.
+    baseline_cases = dict((case['name'], case) for case in baseline['cases'])
+    regressions = []
+    for case in cases:
+        base = baseline_cases.get(case['name'], None)
+        if base is None:
+            continue
+        for metric, limit in thresholds.items():
+            if not base.get(metric):
+                continue
+            ratio = case[metric] / base[metric]
+            if ratio > limit:
+                regressions.append(f"{case['name']}: {metric} {base[metric]:.6g} -> {case[metric]:.6g} "
+                                   f"(x{ratio:.2f}, limit x{limit:.2f})")
+    return regressions
+
+def _counts(value):
+    return tuple(int(count) for count in value.split(','))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark how the generator and the translator scale.")
+    parser.add_argument('--settings', type=_counts, default=SETTINGS_COUNTS, help="settings counts, eg. 44,500,5000")
+    parser.add_argument('--lines', type=_counts, default=LINE_COUNTS, help="config tree sizes in lines")
+    parser.add_argument('--languages', type=_counts, default=LANGUAGE_COUNTS, help="language counts")
+    parser.add_argument('--quick', action='store_true', help="only the two smallest sizes of every sweep")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="translator processes (default: 1)")
+    parser.add_argument('--json', help="write the report and its thresholds to this file")
+    parser.add_argument('--check', metavar='BASELINE', help="fail on regressions against this report")
+    parser.add_argument('--threshold', action='append', default=[], metavar='METRIC=RATIO',
+                        help=f"override a threshold, metrics: {', '.join(DEFAULT_THRESHOLDS)}")
+    parser.add_argument('--source-dir', default='../')
+    args = parser.parse_args()
+
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    baseline = None
+    if args.check:
+        with open(args.check, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        thresholds.update(baseline.get('thresholds', {}))
+    for override in args.threshold:
+        metric, _, ratio = override.partition('=')
+        if metric not in DEFAULT_THRESHOLDS:
+            parser.error(f"unknown metric {metric}")
+        thresholds[metric] = float(ratio)
+
+    settings_counts, line_counts, language_counts = args.settings, args.lines, args.languages
+    if args.quick:
+        settings_counts, line_counts, language_counts = settings_counts[:2], line_counts[:2], language_counts[:2]
+    repeat = max(args.repeat, 1)
+
+    with open('zmod_settings.json', 'r', encoding='utf-8') as f:
+        settings_json_data = json.load(f)
+    matrix = load_matrix()
+    keys = tuple(matrix.keys())
+    catalog_files = sorted(os.path.abspath(name) for name in glob.glob('*.csv'))
+
+    outputs = list(matrix.outputs.items())
+    generated = {}
+    for (output_file, _), (text, _) in zip(outputs, generate([key for _, key in outputs])):
+        generated[os.path.basename(output_file)] = text
+    sources = load_sources(args.source_dir, generated)
+    source_lines = sum(text.count('\n') + 1 for _, text in sources)
+
+    cases = []
+
+    def record(stage, name, result, **params):
+        wall_s, peak_bytes, output_bytes = result
+        case = {'stage': stage, 'name': name, 'wall_s': wall_s, 'peak_bytes': peak_bytes,
+                'output_bytes': output_bytes}
+        case.update(params)
+        cases.append(case)
+        print(f"{name:<28} {wall_s:>9.3f} s {peak_bytes / 1048576.0:>9.1f} MiB {output_bytes / 1048576.0:>9.2f} MiB out",
+              flush=True)
+
+    with tempfile.TemporaryDirectory(prefix='build_bench_') as work_dir:
+        for count in settings_counts:
+            record('generate', f"generate settings={count}",
+                   bench_generate(settings_json_data, count, keys, repeat), settings=count, variants=len(keys))
+
+        single = synthetic_catalogs(catalog_files, 1, work_dir)
+        for line_count in line_counts:
+            tree = synthetic_tree(sources, line_count)
+            record('translate', f"translate lines={line_count}",
+                   bench_translate(tree, single, work_dir, repeat, args.jobs), lines=line_count, languages=1)
+
+        for language_count in language_counts:
+            catalogs = synthetic_catalogs(catalog_files, language_count, work_dir)
+            record('translate', f"translate languages={language_count}",
+                   bench_translate(sources, catalogs, work_dir, repeat, args.jobs),
+                   lines=source_lines, languages=language_count)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeat': repeat,
+        'thresholds': thresholds,
+        'cases': cases
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+            f.write('\n')
+
+    if baseline is not None:
+        regressions = compare(cases, baseline, thresholds)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.check}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+
+# Content-hash bookkeeping for the incremental build driven by Make.sh.
+#
+# A manifest lives next to the outputs it describes. It records the content hash of every input that was looked at, and
+# for every output the key of the inputs it was last built from. An output is rebuilt only when the key computed from
+# its current inputs differs from the recorded one, or when the file has gone missing. Outputs whose freshly built bytes
+# match what is already on disk are not rewritten.
+
+MANIFEST_NAME = '.build_manifest.json'
+MANIFEST_VERSION = 1
+
+def hash_bytes(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hash_bytes(f.read())
+
+def combine_hashes(*parts):
+    return hash_bytes('\0'.join(str(part) for part in parts))
+
+def write_if_changed(path, data):
+    # Returns True if the file was (re)written.
+    encoded = data.encode('utf-8') if isinstance(data, str) else data
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == encoded:
+                return False
+    except FileNotFoundError:
+        pass
+
+    # Not "<path>.tmp": translate.py --tmp-overlays treats *.cfg.tmp files in the source tree as overlays.
+    part_path = f"{path}.{os.getpid()}.part"
+    with open(part_path, 'wb') as f:
+        f.write(encoded)
+    os.replace(part_path, path)
+    return True
+
+class MemoTable:
+    # key -> value memo for the generator. prune() forgets every entry that was not used since the last prune, so a
+    # long running --watch does not keep the fragments of settings that no longer exist.
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        value = self.used.get(key, None)
+        if value is None:
+            value = self.entries.get(key, None)
+            if value is None:
+                value = compute()
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.used[key] = value
+        else:
+            self.hits += 1
+        return value
+
+    def prune(self):
+        self.entries = self.used
+        self.used = {}
+
+    def known(self):
+        # Every entry, used or not, to start the table of a worker process with.
+        known = dict(self.entries)
+        known.update(self.used)
+        return known
+
+    def take_used(self):
+        # The entries used since the last call, for the parent process to merge. They stay known to this table.
+        used = self.used
+        self.entries.update(used)
+        self.used = {}
+        return used
+
+    def merge(self, used, hits, misses):
+        # What a worker's table took_used, with its counts.
+        self.used.update(used)
+        self.hits += hits
+        self.misses += misses
+
+class BuildManifest:
+    def __init__(self, path):
+        self.path = path
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        self.inputs = {}
+        self.outputs = {}
+        self.dirty = False
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if data.get('version', None) != MANIFEST_VERSION:
+            return
+        self.inputs = data.get('inputs', {})
+        self.outputs = data.get('outputs', {})
+
+    def _output_name(self, output_path):
+        return os.path.relpath(os.path.abspath(output_path), self.base_dir).replace(os.sep, '/')
+
+    def hash_input(self, name, path):
+        file_hash = hash_file(path)
+        self.record_input(name, file_hash)
+        return file_hash
+
+    def record_input(self, name, file_hash):
+        if self.inputs.get(name, None) != file_hash:
+            self.inputs[name] = file_hash
+            self.dirty = True
+
+    def is_current(self, output_path, key):
+        return self.outputs.get(self._output_name(output_path), None) == key and os.path.isfile(output_path)
+
+    def record(self, output_path, key):
+        name = self._output_name(output_path)
+        if self.outputs.get(name, None) != key:
+            self.outputs[name] = key
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {
+            'version': MANIFEST_VERSION,
+            'inputs': dict(sorted(self.inputs.items())),
+            'outputs': dict(sorted(self.outputs.items()))
+        }
+        write_if_changed(self.path, json.dumps(data, indent=1, ensure_ascii=False) + '\n')
+        self.dirty = False
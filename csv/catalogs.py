@@ -0,0 +1,95 @@
+import csv
+import marshal
+import os
+import sys
+
+from build_manifest import hash_bytes, write_if_changed
+
+# Compiled translation catalogs and the marker coverage index.
+#
+# A language CSV is parsed once into a Catalog and cached as a marshal blob in CATALOG_CACHE_DIR. The blob carries the
+# hash of the CSV it was compiled from, so an edited CSV is simply recompiled on the next run. Duplicate keys, which
+# csv.reader + dict would otherwise silently collapse, are recorded while compiling.
+#
+# CoverageIndex maps every ===...=== marker in the source and generated configs to the files that use it, so that
+# missing, unused and duplicate keys can be reported per language without diffing files by hand.
+
+CATALOG_CACHE_DIR = '.catalog_cache'
+# marshal output is only stable within one Python minor version.
+CATALOG_FORMAT = (1, sys.version_info[0], sys.version_info[1])
+
+class Catalog:
+    __slots__ = ('name', 'translations', 'duplicates')
+
+    def __init__(self, name, translations, duplicates):
+        self.name = name
+        self.translations = translations
+        self.duplicates = duplicates
+
+def compile_catalog(name, csv_text):
+    translations = {}
+    duplicates = []
+    reader = csv.reader(csv_text.splitlines(keepends=True), delimiter=';')
+    for row in reader:
+        if len(row) >= 2:
+            original = row[0].strip()
+            translated = row[1].strip()
+            if original in translations:
+                duplicates.append(original)
+            translations[original] = translated
+    return Catalog(name, translations, duplicates)
+
+def load_catalog(translate_file, cache_dir=CATALOG_CACHE_DIR):
+    name = os.path.splitext(os.path.basename(translate_file))[0]
+    with open(translate_file, 'r', encoding='utf-8') as f:
+        csv_text = f.read()
+    csv_hash = hash_bytes(csv_text)
+
+    cache_path = os.path.join(cache_dir, f"{name}.bin")
+    try:
+        with open(cache_path, 'rb') as f:
+            cache_format, cached_hash, keys, values, duplicates = marshal.loads(f.read())
+        if cache_format == CATALOG_FORMAT and cached_hash == csv_hash:
+            return Catalog(name, dict(zip(keys, values)), list(duplicates))
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    catalog = compile_catalog(name, csv_text)
+    os.makedirs(cache_dir, exist_ok=True)
+    write_if_changed(cache_path, marshal.dumps((CATALOG_FORMAT, csv_hash, tuple(catalog.translations.keys()),
+                                               tuple(catalog.translations.values()), tuple(catalog.duplicates))))
+    return catalog
+
+class CoverageIndex:
+    __slots__ = ('markers', 'files')
+
+    def __init__(self, markers, templates):
+        self.markers = markers
+        # marker id -> names of the files it appears in
+        self.files = [[] for _ in markers.keys]
+        for name, template in templates:
+            for marker_id in dict.fromkeys(template.marker_ids):
+                self.files[marker_id].append(name)
+
+    def report(self, catalog):
+        translations = catalog.translations
+        missing = [key for key in self.markers.keys if key not in translations]
+        unused = [key for key in translations if key not in self.markers.ids]
+        return {
+            'missing': missing,
+            'unused': unused,
+            'duplicates': list(dict.fromkeys(catalog.duplicates))
+        }
+
+    def print_report(self, catalog):
+        report = self.report(catalog)
+        print(f"{catalog.name}: {len(self.markers.keys)} markers, {len(catalog.translations)} keys, "
+              f"missing: {len(report['missing'])}, unused: {len(report['unused'])}, "
+              f"duplicates: {len(report['duplicates'])}")
+        for key in report['missing']:
+            print(f"    missing: {key}  ({', '.join(self.files[self.markers.ids[key]])})")
+        for key in report['unused']:
+            print(f"    unused: {key}")
+        for key in report['duplicates']:
+            print(f"    duplicate: {key}")
+        return report
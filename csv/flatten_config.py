@@ -0,0 +1,286 @@
+import argparse
+import configparser
+import glob
+import json
+import os
+import posixpath
+import re
+
+from build_manifest import write_if_changed
+from make_config_macros import generate
+from translate import load_sources
+from variant_matrix import load_matrix
+
+# Usage: python3 flatten_config.py [--output-dir DIR] [--verify] [target.cfg ...]
+#
+# Resolves the [include] graph of a target config the way Klipper does and writes it as one precomposed config, so the
+# printer parses a single file without the shadowed sections and options Klipper would throw away anyway.
+#
+# Klipper reads a section that appears more than once as one section: options are kept in the order they first
+# appeared, later values override earlier ones. The flattener does the same merge up front, drops full line comments
+# and keeps every remaining line byte for byte. Includes that are not part of the tree (../mod_data/*.cfg, shell.cfg,
+# KAMP) are kept as [include] lines, rewritten relative to the target. Sections are only merged between two such
+# includes, since the external file may define them too.
+#
+# Next to every DIR/<target> a <target>.map.json is written: a list of [first output line, line count, source file,
+# first source line] runs mapping the flattened file back to the originals.
+#
+# The variant configs of variants.json are generated into memory, as in build.py, unless --no-generate is given (eg.
+# to flatten a translated tree that already has them). --verify parses the original include chain and the flattened
+# file the way Klipper would and checks that they give the same sections and options.
+
+# target -> {included file: file it is replaced with}. The AD5X targets run with ad5x.cfg where the tree has ff5.cfg.
+TARGETS = {
+    'mod.cfg': {},
+    'ff5m_display_off.cfg': {},
+    'ad5x_display_off.cfg': {'ff5.cfg': 'ad5x.cfg'},
+    'klipper11.cfg': {},
+    'klipper11_pro.cfg': {},
+    'ff5m_klipper13.cfg': {},
+    'ad5x_klipper13.cfg': {}
+}
+
+# The same patterns Klipper's configparser uses.
+SECTION_HEADER = re.compile(r'\[(?P<header>[^]]+)\]')
+OPTION_NAME = re.compile(r'(?P<option>.*?)\s*[=:]')
+
+class FlattenError(Exception):
+    pass
+
+class Option:
+    __slots__ = ('name', 'lines', 'line_numbers', 'source_file')
+
+    def __init__(self, name, line, line_number, source_file):
+        self.name = name
+        self.lines = [line]
+        self.line_numbers = [line_number]
+        self.source_file = source_file
+
+    def append(self, line, line_number):
+        self.lines.append(line)
+        self.line_numbers.append(line_number)
+
+    def value(self):
+        # The value as Klipper reads it: comments stripped, continuation lines kept with their indentation.
+        first = _code(self.lines[0])
+        lines = [first[OPTION_NAME.match(first).end():].strip()] + [_code(line).rstrip() for line in self.lines[1:]]
+        return '\n'.join(lines).strip('\n')
+
+class Section:
+    __slots__ = ('name', 'header', 'options', 'source_file', 'line_number')
+
+    def __init__(self, name, header, source_file, line_number):
+        self.name = name
+        self.header = header
+        # option name -> Option, in the order Klipper would list them
+        self.options = {}
+        self.source_file = source_file
+        self.line_number = line_number
+
+class FlatConfig:
+    __slots__ = ('target', 'blocks', 'files', 'sections_read', 'options_read')
+
+    def __init__(self, target):
+        self.target = target
+        # Sections merged between externals: [{name: Section}, external include spec, {name: Section}, ...]
+        self.blocks = [{}]
+        self.files = []
+        self.sections_read = 0
+        self.options_read = 0
+
+def _code(line):
+    # What Klipper's parser sees of a line: everything up to the first #.
+    position = line.find('#')
+    return line if position < 0 else line[:position]
+
+def _read_file(flat, sources, name, substitutions, visited):
+    if name in visited:
+        raise FlattenError(f"recursive include of {name}")
+    visited = visited | {name}
+    flat.files.append(name)
+
+    section = None
+    option = None
+    for line_number, line in enumerate(sources[name].split('\n'), 1):
+        code = _code(line).rstrip()
+        stripped = code.strip()
+        if not stripped or stripped.startswith(';'):
+            # Blank lines can be part of a multi line value, full line comments are dropped.
+            if option is not None and not line.strip():
+                option.append(line, line_number)
+            continue
+
+        header = SECTION_HEADER.match(code)
+        if header is not None:
+            option = None
+            header = header.group('header')
+            if header.startswith('include '):
+                section = None
+                _include(flat, sources, name, header[len('include '):].strip(), substitutions, visited)
+                continue
+            block = flat.blocks[-1]
+            section = block.get(header, None)
+            if section is None:
+                section = Section(header, line.rstrip(), name, line_number)
+                block[header] = section
+            flat.sections_read += 1
+            continue
+
+        if section is None:
+            raise FlattenError(f"{name}:{line_number}: option outside of a section")
+        if code[0].isspace() and option is not None:
+            option.append(line, line_number)
+            continue
+
+        match = OPTION_NAME.match(code)
+        if match is None:
+            raise FlattenError(f"{name}:{line_number}: cannot parse '{line}'")
+        option_name = match.group('option').strip().lower()
+        option = Option(option_name, line, line_number, name)
+        # A redefinition keeps the place of the first one, as it does in configparser.
+        section.options[option_name] = option
+        flat.options_read += 1
+
+def _include(flat, sources, including, spec, substitutions, visited):
+    directory = posixpath.dirname(including)
+    pattern = posixpath.normpath(posixpath.join(directory, spec))
+    if glob.has_magic(pattern):
+        names = sorted(name for name in sources if glob.fnmatch.fnmatch(name, pattern))
+    else:
+        pattern = substitutions.get(pattern, pattern)
+        names = [pattern] if pattern in sources else []
+
+    if not names:
+        # Not part of the tree, the printer resolves it. Rewrite it relative to the target's directory.
+        target_directory = posixpath.dirname(flat.target)
+        external = posixpath.relpath(posixpath.join(directory, spec), target_directory or '.')
+        flat.blocks.append(external)
+        flat.blocks.append({})
+        return
+
+    for name in names:
+        _read_file(flat, sources, name, substitutions, visited)
+
+def flatten(sources, target, substitutions=None):
+    flat = FlatConfig(target)
+    _read_file(flat, sources, target, substitutions or {}, frozenset())
+    return flat
+
+
+def render(flat):
+    # Returns (text, source map)
+    out = [f"# Flattened from {flat.target} by flatten_config.py, do not edit. Source map: "
+           f"{posixpath.basename(flat.target)}.map.json", '']
+    source_map = []
+
+    def add(line, source_file, line_number):
+        last = source_map[-1] if source_map else None
+        if last is not None and last[2] == source_file and last[0] + last[1] == len(out) + 1 and \
+                last[3] + last[1] == line_number:
+            last[1] += 1
+        else:
+            source_map.append([len(out) + 1, 1, source_file, line_number])
+        out.append(line)
+
+    for block in flat.blocks:
+        if isinstance(block, str):
+            out.append(f"[include {block}]")
+            out.append('')
+            continue
+        for section in block.values():
+            add(section.header, section.source_file, section.line_number)
+            for option in section.options.values():
+                # Trailing blank lines of a value mean nothing to Klipper.
+                end = len(option.lines)
+                while end > 1 and not option.lines[end - 1].strip():
+                    end -= 1
+                for line, line_number in zip(option.lines[:end], option.line_numbers[:end]):
+                    add(line, option.source_file, line_number)
+            out.append('')
+
+    return '\n'.join(out), source_map
+
+def _value_lines(value):
+    # Dropped comment lines inside a value are only empty lines to Klipper, which it ignores.
+    return [line for line in value.split('\n') if line.strip()]
+
+def klipper_items(sources, target, text=None, substitutions=None):
+    # Sections and options as Klipper's configparser ends up with them, skipping includes outside of the tree.
+    fileconfig = configparser.RawConfigParser(strict=False, inline_comment_prefixes=(';', '#'))
+
+    def parse(name, data, visited):
+        buffer = []
+        for line in data.split('\n'):
+            line = _code(line)
+            header = SECTION_HEADER.match(line)
+            header = header and header.group('header')
+            if header and header.startswith('include '):
+                fileconfig.read_string('\n'.join(buffer), name)
+                buffer = []
+                spec = posixpath.normpath(posixpath.join(posixpath.dirname(name), header[8:].strip()))
+                spec = (substitutions or {}).get(spec, spec)
+                names = sorted(n for n in sources if glob.fnmatch.fnmatch(n, spec)) if glob.has_magic(spec) else \
+                    [spec] if spec in sources else []
+                for include in names:
+                    if include in visited:
+                        raise FlattenError(f"recursive include of {include}")
+                    parse(include, sources[include], visited | {include})
+            else:
+                buffer.append(line)
+        fileconfig.read_string('\n'.join(buffer), name)
+
+    parse(target, sources[target] if text is None else text, frozenset([target]))
+    return [(section, [(option, _value_lines(value)) for option, value in fileconfig.items(section)])
+            for section in fileconfig.sections()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Flatten the [include] graph of the target configs into one file each.")
+    parser.add_argument('targets', nargs='*', help=f"default: {', '.join(TARGETS)}")
+    parser.add_argument('--source-dir', default='../')
+    parser.add_argument('--output-dir', default='../flat/')
+    parser.add_argument('--no-generate', action='store_true',
+                        help="take the *_config_*.cfg files from the source dir instead of generating them")
+    parser.add_argument('--verify', action='store_true',
+                        help="check that Klipper would read the same sections and options from the flattened file")
+    args = parser.parse_args()
+
+    generated = {}
+    if not args.no_generate:
+        matrix = load_matrix()
+        outputs = list(matrix.outputs.items())
+        for (output_file, _), (text, _) in zip(outputs, generate([key for _, key in outputs])):
+            generated[os.path.basename(output_file)] = text
+    sources = dict(load_sources(args.source_dir, generated))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed = False
+    for target in args.targets or list(TARGETS):
+        if target not in sources:
+            parser.error(f"{target} not found in {args.source_dir}")
+        substitutions = TARGETS.get(target, {})
+        flat = flatten(sources, target, substitutions)
+        text, source_map = render(flat)
+
+        output_file = os.path.join(args.output_dir, target)
+        write_if_changed(output_file, text)
+        write_if_changed(f"{output_file}.map.json", json.dumps(source_map) + '\n')
+
+        original_size = sum(len(sources[name].encode('utf-8')) for name in dict.fromkeys(flat.files))
+        section_count = sum(len(block) for block in flat.blocks if not isinstance(block, str))
+        option_count = sum(len(section.options) for block in flat.blocks if not isinstance(block, str)
+                           for section in block.values())
+        line = (f"{target}: {len(flat.files)} files, {original_size} -> {len(text.encode('utf-8'))} bytes, "
+                f"sections {flat.sections_read} -> {section_count}, options {flat.options_read} -> {option_count}")
+
+        if args.verify:
+            same = klipper_items(sources, target, substitutions=substitutions) == \
+                klipper_items(sources, target, text)
+            line += ", verified" if same else ", DIFFERS from the original"
+            failed = failed or not same
+        print(line)
+
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+import ast
+import re
+
+# Build-time optimizer for the generated *_config_*.cfg files.
+#
+# Runs over the finished text of one variant, just before it is written. Only gcode: bodies of [gcode_macro] sections
+# are touched, and only in ways that cannot change what the macro emits on the printer of that variant:
+#
+#   - Conditions on `screen` and `client.ad5x` are folded where the macro takes them from _SCREEN and _CLIENT_VARIABLE,
+#     since every variant file is only ever included next to the matching base_*.cfg and ff5.cfg / ad5x.cfg.
+#     Branches that cannot be taken are dropped and branches that are always taken are unwrapped.
+#   - {% if %} blocks left without a body are dropped.
+#   - printer.save_variables.variables is looked up once per macro into a local instead of once per setting.
+#   - Trailing whitespace is stripped and runs of blank lines are collapsed.
+#
+# Given a block cache (a build_manifest.MemoTable), a macro body that was optimized before for the same variant is not
+# looked at again, and of a body that changed only the top-level {% if %} blocks that were not folded before for the
+# same facts are. make_config_macros.py keeps one across runs, so editing one setting only optimizes the macros and
+# blocks of that setting.
+
+STANDALONE_TAG = re.compile(r'^(\s*)\{%\s*(if|elif|else|endif)\b\s*(.*?)\s*%\}\s*$')
+ANY_IF_TAG = re.compile(r'\{%\s*if\b')
+ANY_ENDIF_TAG = re.compile(r'\{%\s*endif\b')
+SET_TAG = re.compile(r'^\s*\{%\s*set\s+(\w+)\s*=\s*(.*?)\s*%\}\s*$')
+
+# Locals whose value is fixed for a given variant, and the exact lookup a macro must use for the local to be trusted.
+SCREEN_LOOKUP = 'printer["gcode_macro _SCREEN"].screen'
+CLIENT_LOOKUP = "printer['gcode_macro _CLIENT_VARIABLE'] | default({})"
+
+SAVE_VARIABLES_LOOKUP = 'printer.save_variables.variables'
+SAVE_VARIABLES_LOCAL = 'svars'
+
+class OptimizerStats:
+    __slots__ = ('bytes_before', 'bytes_after', 'conditions_folded', 'branches_removed', 'lookups_hoisted')
+
+    def __init__(self):
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.conditions_folded = 0
+        self.branches_removed = 0
+        self.lookups_hoisted = 0
+
+    def summary(self):
+        return (f"{self.bytes_before} -> {self.bytes_after} bytes ({self.bytes_before - self.bytes_after} saved), "
+                f"{self.conditions_folded} conditions folded, {self.branches_removed} branches removed, "
+                f"{self.lookups_hoisted} lookups hoisted")
+
+def _evaluate(node, facts):
+    # True / False if the expression is decided by facts alone, None otherwise.
+    if isinstance(node, ast.Constant) and isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        key = ast.unparse(node)
+        if key in facts:
+            return facts[key]
+        return None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        value = _evaluate(node.operand, facts)
+        return None if value is None else not value
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.comparators[0], ast.Constant):
+        left = _evaluate(node.left, facts)
+        if left is None:
+            return None
+        right = node.comparators[0].value
+        if isinstance(node.ops[0], ast.Eq):
+            return left == right
+        if isinstance(node.ops[0], ast.NotEq):
+            return left != right
+        return None
+    if isinstance(node, ast.BoolOp):
+        values = [_evaluate(value, facts) for value in node.values]
+        deciding = isinstance(node.op, ast.Or)
+        if deciding in values:
+            return deciding
+        if None not in values:
+            return not deciding
+    return None
+
+def fold_expression(expression, facts):
+    # Returns (value, expression). value is True / False when the condition is constant for this variant. Otherwise
+    # it is None, and known operands of a top-level and/or have been dropped from the returned expression.
+    if not facts:
+        return None, expression
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        return None, expression
+
+    value = _evaluate(tree.body, facts)
+    if value is not None or not isinstance(tree.body, ast.BoolOp):
+        return value, expression
+
+    neutral = isinstance(tree.body.op, ast.And)
+    remaining = []
+    for operand in tree.body.values:
+        if _evaluate(operand, facts) == neutral:
+            continue
+        segment = ast.get_source_segment(expression, operand)
+        if isinstance(operand, ast.BoolOp):
+            segment = f"({segment})"
+        remaining.append(segment)
+
+    if len(remaining) == len(tree.body.values):
+        return None, expression
+    return None, (' and ' if neutral else ' or ').join(remaining)
+
+def _dedent(lines, indent):
+    result = []
+    for line in lines:
+        if line.startswith(indent):
+            line = line[len(indent):]
+        result.append(line)
+    return result
+
+def _body_indent(tag_indent, lines):
+    for line in lines:
+        if line.strip():
+            indent = line[:len(line) - len(line.lstrip())]
+            if len(indent) > len(tag_indent):
+                return indent[len(tag_indent):]
+            return ''
+    return ''
+
+def _fold_chain(tag_indent, branches, end_line, facts, stats):
+    changed = False
+    kept = []
+    for index, (kind, expression, tag_line, body) in enumerate(branches):
+        body = fold_lines(body, facts, stats)
+        if kind == 'else':
+            kept.append((None, tag_line, body))
+            break
+
+        value, folded = fold_expression(expression, facts)
+        if value is False:
+            stats.branches_removed += 1
+            changed = True
+            continue
+        if value is True:
+            stats.conditions_folded += 1
+            stats.branches_removed += len(branches) - index - 1
+            changed = True
+            kept.append((None, None, body))
+            break
+        if folded != expression:
+            stats.conditions_folded += 1
+            changed = True
+            tag_line = None
+        kept.append((folded, tag_line, body))
+
+    # Nothing to show and nothing to evaluate: the whole block is dead.
+    has_body = any(line.strip() for _, _, body in kept for line in body)
+    calls_something = any(expression is not None and '(' in expression for expression, _, _ in kept)
+    if not has_body and not calls_something:
+        if kept:
+            stats.branches_removed += len(kept)
+        return []
+
+    if not kept:
+        return []
+
+    if kept[0][0] is None:
+        # The first remaining branch always runs.
+        body = kept[0][2]
+        return _dedent(body, _body_indent(tag_indent, body))
+
+    result = []
+    for index, (expression, tag_line, body) in enumerate(kept):
+        if not changed and tag_line is not None:
+            result.append(tag_line)
+        elif expression is None:
+            result.append(f"{tag_indent}{{% else %}}")
+        else:
+            result.append(f"{tag_indent}{{% {'if' if index == 0 else 'elif'} {expression} %}}")
+        result += body
+    result.append(end_line)
+    return result
+
+def fold_lines(lines, facts, stats):
+    result = []
+    index = 0
+    while index < len(lines):
+        match = STANDALONE_TAG.match(lines[index])
+        if not match or match.group(2) != 'if':
+            result.append(lines[index])
+            index += 1
+            continue
+
+        start = index
+        tag_indent = match.group(1)
+        branches = []
+        current = ['if', match.group(3), lines[index], []]
+        depth = 0
+        index += 1
+        while index < len(lines):
+            tag = STANDALONE_TAG.match(lines[index])
+            if tag:
+                kind = tag.group(2)
+                if kind == 'if':
+                    depth += 1
+                elif kind == 'endif':
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif depth == 0:
+                    branches.append(current)
+                    current = [kind, tag.group(3), lines[index], []]
+                    index += 1
+                    continue
+            current[3].append(lines[index])
+            index += 1
+
+        if index >= len(lines):
+            # Unterminated block, leave the rest alone.
+            result += lines[start:]
+            break
+
+        branches.append(current)
+        result += _fold_chain(tag_indent, branches, lines[index], facts, stats)
+        index += 1
+
+    return result
+
+def _top_level_blocks(lines):
+    # Splits lines the way fold_lines() walks them: yields (True, lines) for a complete top-level {% if %} block and
+    # (False, lines) for the lines between blocks, which it leaves alone.
+    plain = []
+    index = 0
+    while index < len(lines):
+        match = STANDALONE_TAG.match(lines[index])
+        if not match or match.group(2) != 'if':
+            plain.append(lines[index])
+            index += 1
+            continue
+
+        start = index
+        depth = 0
+        index += 1
+        while index < len(lines):
+            tag = STANDALONE_TAG.match(lines[index])
+            if tag:
+                if tag.group(2) == 'if':
+                    depth += 1
+                elif tag.group(2) == 'endif':
+                    if depth == 0:
+                        break
+                    depth -= 1
+            index += 1
+
+        if index >= len(lines):
+            plain += lines[start:]
+            break
+        if plain:
+            yield False, plain
+            plain = []
+        index += 1
+        yield True, lines[start:index]
+    if plain:
+        yield False, plain
+
+def _fold_block(block, facts):
+    stats = OptimizerStats()
+    return fold_lines(block, facts, stats), (stats.conditions_folded, stats.branches_removed)
+
+def fold_lines_cached(lines, facts, stats, block_cache):
+    facts_key = tuple(sorted(facts.items()))
+    result = []
+    for is_block, block in _top_level_blocks(lines):
+        if not is_block:
+            result += block
+            continue
+        folded, (conditions_folded, branches_removed) = block_cache.get((facts_key, '\n'.join(block)),
+                                                                       lambda: _fold_block(block, facts))
+        result += folded
+        stats.conditions_folded += conditions_folded
+        stats.branches_removed += branches_removed
+    return result
+
+def _can_fold(body):
+    # Folding relies on every if/endif that is not on a line of its own being balanced within its line.
+    for line in body:
+        if '{%-' in line or '-%}' in line:
+            return False
+        if STANDALONE_TAG.match(line):
+            continue
+        if len(ANY_IF_TAG.findall(line)) != len(ANY_ENDIF_TAG.findall(line)):
+            return False
+    return True
+
+def _facts(body, is_ad5x, is_native_screen):
+    lookups = {}
+    for line in body:
+        match = SET_TAG.match(line)
+        if match:
+            lookups.setdefault(match.group(1), []).append(match.group(2))
+
+    facts = {}
+    if lookups.get('screen', None) == [SCREEN_LOOKUP]:
+        facts['screen'] = is_native_screen
+    if lookups.get('client', None) == [CLIENT_LOOKUP]:
+        facts['client.ad5x'] = is_ad5x
+    return facts
+
+def _hoist_save_variables(body, stats):
+    uses = sum(line.count(SAVE_VARIABLES_LOOKUP) for line in body)
+    if uses < 2 or any(re.search(rf'\b{SAVE_VARIABLES_LOCAL}\b', line) for line in body):
+        return body
+
+    indent = '    '
+    for line in body:
+        if line.strip():
+            indent = line[:len(line) - len(line.lstrip())]
+            break
+
+    stats.lookups_hoisted += uses
+    result = [f"{indent}{{% set {SAVE_VARIABLES_LOCAL} = {SAVE_VARIABLES_LOOKUP} %}}"]
+    for line in body:
+        result.append(line.replace(SAVE_VARIABLES_LOOKUP, SAVE_VARIABLES_LOCAL))
+    return result
+
+def _tidy(lines):
+    result = []
+    for line in lines:
+        line = line.rstrip()
+        if not line and (not result or not result[-1]):
+            continue
+        result.append(line)
+    return result
+
+def _optimize_macro(body, is_ad5x, is_native_screen, stats, block_cache=None):
+    if _can_fold(body):
+        facts = _facts(body, is_ad5x, is_native_screen)
+        if block_cache is None or not facts:
+            body = fold_lines(body, facts, stats)
+        else:
+            body = fold_lines_cached(body, facts, stats, block_cache)
+    body = _hoist_save_variables(body, stats)
+    return _tidy(body)
+
+def _optimize_macro_cached(body, is_ad5x, is_native_screen, stats, block_cache):
+    def optimize():
+        macro_stats = OptimizerStats()
+        lines = _optimize_macro(body, is_ad5x, is_native_screen, macro_stats, block_cache)
+        return lines, (macro_stats.conditions_folded, macro_stats.branches_removed, macro_stats.lookups_hoisted)
+
+    lines, (conditions_folded, branches_removed, lookups_hoisted) = block_cache.get(
+        (is_ad5x, is_native_screen, '\n'.join(body)), optimize)
+    stats.conditions_folded += conditions_folded
+    stats.branches_removed += branches_removed
+    stats.lookups_hoisted += lookups_hoisted
+    return lines
+
+def optimize_config(text, is_ad5x, is_native_screen, block_cache=None):
+    stats = OptimizerStats()
+    stats.bytes_before = len(text.encode('utf-8'))
+
+    lines = text.split('\n')
+    result = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        result.append(line)
+        index += 1
+        if not line.startswith('[gcode_macro '):
+            continue
+
+        # Copy the section's options up to gcode:, then optimize its indented body.
+        while index < len(lines) and not lines[index].startswith('[') and not lines[index].startswith('gcode:'):
+            result.append(lines[index])
+            index += 1
+        if index >= len(lines) or not lines[index].startswith('gcode:'):
+            continue
+        result.append(lines[index])
+        index += 1
+
+        body_end = index
+        while body_end < len(lines) and not lines[body_end].startswith('['):
+            body_end += 1
+
+        # Keep the blank line(s) and comments between this body and the next section where they were.
+        trailer_start = body_end
+        while trailer_start > index and (not lines[trailer_start - 1].strip() or lines[trailer_start - 1].startswith('#')):
+            trailer_start -= 1
+
+        if block_cache is None:
+            result += _optimize_macro(lines[index:trailer_start], is_ad5x, is_native_screen, stats)
+        else:
+            result += _optimize_macro_cached(lines[index:trailer_start], is_ad5x, is_native_screen, stats, block_cache)
+        result += lines[trailer_start:body_end]
+        index = body_end
+
+    text = '\n'.join(result)
+    stats.bytes_after = len(text.encode('utf-8'))
+    return text, stats
@@ -0,0 +1,387 @@
+import argparse
+import ast
+import collections
+import configparser
+import json
+import os
+import shlex
+import time
+
+import jinja2
+
+from settings_model import load_settings
+from variant_matrix import load_matrix
+
+# Offline render benchmark for [gcode_macro] templates.
+#
+# Usage: python3 macro_bench.py [--repeat N] [--expand] [--json report.json] [variant ...]
+#
+# The macros of one variant of variants.json are loaded the way Klipper would see them (base.cfg, the variant's
+# configs, then its generated *_config_*.cfg), compiled with the same Jinja settings as Klipper's gcode_macro, and
+# rendered against a stand-in `printer` object. The stand-in carries save_variables (the defaults from
+# zmod_settings.json), a synthetic bed_mesh, configfile, probe and the variables of every loaded gcode_macro.
+#
+# For every case the report has the template size, the best and mean render time over --repeat renders and the number
+# of commands the render emitted and the number of times it rewrote the variables file. With --expand, emitted commands that name another loaded macro are rendered too
+# (SET_GCODE_VARIABLE and SAVE_VARIABLE are applied to the stand-in state as they go), which is closer to what the
+# printer actually pays for a click. The _GLOBAL N=<page> cases are always expanded, _GLOBAL itself only dispatches to
+# _GLOBAL_PAGE_<page>. Like Klipper's gcode_macro, a macro called while it is still being run is an error. --batch-save gives the stand-in the [zmod_variables] of extras/zmod_variables.py,
+# so the generated macros stage their saves with ZMOD_SAVE_VARIABLE and write once on ZMOD_FLUSH_VARIABLES.
+#
+# Run make_config_macros.py first, the generated variant files are not part of the tree.
+
+MAX_EXPAND_DEPTH = 8
+
+# Klipper reports positions as a Coord namedtuple, macros use both .z and [2].
+Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e'))
+
+class MacroError(Exception):
+    pass
+
+class Macro:
+    __slots__ = ('name', 'source_file', 'template_text', 'template', 'defaults', 'variables')
+
+    def __init__(self, name, source_file, template_text, variables):
+        self.name = name
+        self.source_file = source_file
+        self.template_text = template_text
+        self.template = None
+        self.defaults = variables
+        self.variables = dict(variables)
+
+def create_environment():
+    # The same delimiters and extensions as Klipper's gcode_macro.
+    env = jinja2.Environment('{%', '%}', '{', '}')
+    env.add_extension('jinja2.ext.do')
+    return env
+
+def _parse_variable(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+def load_macros(paths):
+    # Later files override earlier ones, like later sections do in Klipper.
+    macros = {}
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        parser = configparser.RawConfigParser(strict=False, inline_comment_prefixes=(';', '#'))
+        with open(path, 'r', encoding='utf-8') as f:
+            parser.read_file(f, path)
+
+        for section in parser.sections():
+            if not section.startswith('gcode_macro '):
+                continue
+            name = section.split(None, 1)[1].strip()
+            options = dict(parser.items(section))
+            variables = {}
+            for option, value in options.items():
+                if option.startswith('variable_'):
+                    variables[option[len('variable_'):]] = _parse_variable(value)
+            macros[name.upper()] = Macro(name, os.path.basename(path), options.get('gcode', ''), variables)
+    return macros
+
+def synthetic_mesh(x_count, y_count, mesh_min, mesh_max):
+    # A shallow bowl with a slight tilt, in the shape printer.bed_mesh reports.
+    matrix = []
+    for y_index in range(y_count):
+        row = []
+        for x_index in range(x_count):
+            dx = x_index / max(x_count - 1, 1) - 0.5
+            dy = y_index / max(y_count - 1, 1) - 0.5
+            row.append(round(0.12 * (dx * dx + dy * dy) + 0.03 * dx - 0.02 * dy, 4))
+        matrix.append(row)
+    return {
+        'profile_name': 'default',
+        'mesh_min': tuple(mesh_min),
+        'mesh_max': tuple(mesh_max),
+        'probed_matrix': matrix,
+        'mesh_matrix': matrix,
+        'profiles': {'default': {'points': matrix, 'mesh_params': {
+            'min_x': mesh_min[0], 'max_x': mesh_max[0], 'min_y': mesh_min[1], 'max_y': mesh_max[1],
+            'x_count': x_count, 'y_count': y_count, 'mesh_x_pps': 2, 'mesh_y_pps': 2, 'algo': 'lagrange', 'tension': 0.2
+        }}}
+    }
+
+def default_save_variables(model):
+    variables = {}
+    for setting in model.settings.values():
+        if setting.type != 'special':
+            variables[setting.lower] = setting.default
+    return variables
+
+def build_printer(macros, save_variables, bed_mesh, language='en', last_probe=0.05, batch_save=False):
+    # printer is a plain dict: Jinja falls back to item lookup for attributes, so printer.bed_mesh and
+    # printer['gcode_macro _SCREEN'] both work as they do on the printer.
+    printer = {
+        'save_variables': {'variables': save_variables},
+        'bed_mesh': bed_mesh,
+        'configfile': {
+            'config': {'zmod': {'language': language}},
+            'settings': {'probe': {'z_offset': 0.0}}
+        },
+        'probe': {'last_z_result': last_probe, 'last_probe_position': Coord(0.0, 0.0, last_probe, 0.0)},
+        'query_endstops': {'last_query': {}},
+        'virtual_sdcard': {'file_path': '', 'is_active': False},
+        'print_stats': {'state': 'standby', 'filename': '', 'message': ''},
+        'display_status': {'progress': 0.0},
+        'idle_timeout': {'state': 'Idle'},
+        'pause_resume': {'is_paused': False},
+        'mcu': {'mcu_version': 'bench'},
+        'extruder': {'temperature': 25.0, 'target': 0.0},
+        'heater_bed': {'temperature': 25.0, 'target': 0.0},
+        'temperature_sensor weightValue': {'temperature': 0.0},
+        'fan_generic fanM106': {'speed': 0.0},
+        'toolhead': {
+            'homed_axes': 'xyz', 'extruder': 'extruder', 'position': Coord(0.0, 0.0, 0.0, 0.0), 'max_velocity': 600.0,
+            'max_accel': 20000.0, 'minimum_cruise_ratio': 0.5, 'square_corner_velocity': 9.0, 'cone_start_z': 0.0
+        },
+        'gcode_move': {
+            'absolute_coordinates': True, 'absolute_extrude': True, 'speed_factor': 1.0,
+            'gcode_position': Coord(0.0, 0.0, 0.0, 0.0), 'homing_origin': Coord(0.0, 0.0, 0.0, 0.0)
+        }
+    }
+    if batch_save:
+        printer['zmod_variables'] = {'pending': 0, 'flushes': 0, 'unchanged': 0}
+    for macro in macros.values():
+        printer[f"gcode_macro {macro.name}"] = macro.variables
+    return printer
+
+def parse_command(line):
+    # "NAME KEY=VALUE ..." -> (NAME, {KEY: VALUE}), the way Klipper splits extended commands.
+    parts = line.split(None, 1)
+    name = parts[0].upper()
+    params = {}
+    if len(parts) > 1:
+        try:
+            arguments = shlex.split(parts[1])
+        except ValueError:
+            arguments = parts[1].split()
+        for argument in arguments:
+            if '=' in argument:
+                key, value = argument.split('=', 1)
+                params[key.upper()] = value
+    return name, params
+
+class RenderResult:
+    __slots__ = ('commands', 'responses', 'error', 'renders', 'writes')
+
+    def __init__(self):
+        self.commands = []
+        self.responses = []
+        self.error = None
+        self.renders = 0
+        # rewrites of the variables file
+        self.writes = 0
+
+class MacroRenderer:
+    def __init__(self, macros, printer):
+        self.macros = macros
+        self.printer = printer
+        # The macros being run, Klipper's in_script of every gcode_macro.
+        self.running = set()
+        self.save_variables = dict(printer['save_variables']['variables'])
+        # values staged by ZMOD_SAVE_VARIABLE
+        self.pending = {}
+        self.env = create_environment()
+        start = time.perf_counter()
+        for macro in macros.values():
+            macro.template = self.env.from_string(macro.template_text)
+        self.compile_time = time.perf_counter() - start
+
+    def reset(self):
+        # Back to the state the printer was built with, the dicts are updated in place since printer shares them.
+        for macro in self.macros.values():
+            macro.variables.clear()
+            macro.variables.update(macro.defaults)
+        variables = self.printer['save_variables']['variables']
+        variables.clear()
+        variables.update(self.save_variables)
+        self.pending.clear()
+        self.running.clear()
+
+    def _context(self, macro, params, result):
+        def respond_info(msg):
+            result.responses.append(msg)
+            return ""
+
+        def raise_error(msg):
+            raise MacroError(msg)
+
+        def emergency_stop(msg="action_emergency_stop"):
+            raise MacroError(msg)
+
+        def call_remote_method(method, **kwargs):
+            return ""
+
+        context = dict(macro.variables)
+        context.update({
+            'printer': self.printer,
+            'params': params,
+            'rawparams': ' '.join(f"{key}={value}" for key, value in params.items()),
+            'action_respond_info': respond_info,
+            'action_raise_error': raise_error,
+            'action_emergency_stop': emergency_stop,
+            'action_call_remote_method': call_remote_method
+        })
+        return context
+
+    def _apply(self, name, params, result):
+        # Keep the stand-in state moving like the printer's would.
+        if name == 'SET_GCODE_VARIABLE':
+            macro = self.macros.get(params.get('MACRO', '').upper(), None)
+            if macro is not None and 'VARIABLE' in params:
+                macro.variables[params['VARIABLE'].lower()] = _parse_variable(params.get('VALUE', ''))
+        elif name == 'SAVE_VARIABLE' and 'VARIABLE' in params:
+            variables = self.printer['save_variables']['variables']
+            variables[params['VARIABLE'].lower()] = _parse_variable(params.get('VALUE', ''))
+            result.writes += 1
+        elif name == 'ZMOD_SAVE_VARIABLE' and 'VARIABLE' in params:
+            # Staged only if it changes the file, as extras/zmod_variables.py does.
+            name = params['VARIABLE'].lower()
+            value = _parse_variable(params.get('VALUE', ''))
+            variables = self.printer['save_variables']['variables']
+            if name in variables and repr(variables[name]) == repr(value):
+                self.pending.pop(name, None)
+            else:
+                self.pending[name] = value
+        elif name == 'ZMOD_FLUSH_VARIABLES' and self.pending:
+            self.printer['save_variables']['variables'].update(self.pending)
+            self.pending.clear()
+            result.writes += 1
+
+    def render(self, command, expand=False, result=None, depth=0):
+        if result is None:
+            result = RenderResult()
+        name, params = parse_command(command)
+        macro = self.macros[name]
+        if name in self.running:
+            result.error = f"Macro {macro.name} called recursively"
+            return result
+
+        result.renders += 1
+        try:
+            output = macro.template.render(self._context(macro, params, result))
+        except MacroError as e:
+            result.error = str(e)
+            return result
+        except jinja2.TemplateError as e:
+            # Usually a printer object the stand-in does not model.
+            result.error = f"{macro.name}: {e}"
+            return result
+
+        self.running.add(name)
+        try:
+            for line in output.split('\n'):
+                line = line.strip()
+                if not line or line.startswith(';'):
+                    continue
+                result.commands.append(line)
+                sub_name, sub_params = parse_command(line)
+                self._apply(sub_name, sub_params, result)
+                if expand and depth < MAX_EXPAND_DEPTH and sub_name in self.macros:
+                    self.render(line, expand, result, depth + 1)
+                    if result.error is not None:
+                        break
+        finally:
+            self.running.discard(name)
+        return result
+
+def variant_paths(repo_dir, variant):
+    return [os.path.join(repo_dir, name) for name in ['base.cfg'] + variant.configs] + [variant.output_file]
+
+def benchmark_cases(macros):
+    # [(command, macro whose template size is reported, always expanded)]
+    cases = [('GET_ZMOD_DATA', 'GET_ZMOD_DATA', False)]
+    page_count = sum(1 for name in macros if name.startswith('_GLOBAL_PAGE_'))
+    # A click on a page renders the dispatcher and the page, the last one is the end message.
+    cases += [(f"_GLOBAL N={page}", f"_GLOBAL_PAGE_{page}" if page <= page_count else '_GLOBAL', True)
+              for page in range(1, page_count + 2)]
+    cases += [(name, name, False) for name in ('_RESET_ZMOD', '_MESH_COMPARE', '_FIND_POINT')]
+    return cases
+
+def run_variant(repo_dir, variant, model, repeat, expand, mesh_size, batch_save=False):
+    paths = variant_paths(repo_dir, variant)
+    if not os.path.isfile(paths[-1]):
+        raise SystemExit(f"{paths[-1]} not found, run make_config_macros.py first")
+
+    macros = load_macros(paths)
+    client = macros.get('_CLIENT_VARIABLE', None)
+    client_vars = client.defaults if client is not None else {}
+    mesh = synthetic_mesh(mesh_size[0], mesh_size[1],
+                          (client_vars.get('min_x', 0.0) + 5, client_vars.get('min_y', 0.0) + 5),
+                          (client_vars.get('max_x', 220.0) - 5, client_vars.get('max_y', 220.0) - 5))
+    printer = build_printer(macros, default_save_variables(model), mesh, batch_save=batch_save)
+    renderer = MacroRenderer(macros, printer)
+
+    rows = []
+    for case, name, always_expand in benchmark_cases(macros):
+        timings = []
+        for _ in range(repeat):
+            # Every render starts from the same state, SAVE_VARIABLE / SET_GCODE_VARIABLE must not leak between runs.
+            renderer.reset()
+            start = time.perf_counter()
+            result = renderer.render(case, expand or always_expand)
+            timings.append(time.perf_counter() - start)
+
+        rows.append({
+            'variant': variant.name,
+            'case': case,
+            'template_bytes': len(macros[name.upper()].template_text.encode('utf-8')),
+            'best_ms': min(timings) * 1000.0,
+            'mean_ms': sum(timings) / len(timings) * 1000.0,
+            'commands': len(result.commands),
+            'renders': result.renders,
+            'writes': result.writes,
+            'error': result.error
+        })
+    return rows, renderer.compile_time, len(macros)
+
+def main():
+    parser = argparse.ArgumentParser(description="Render gcode_macro templates offline and report their cost.")
+    parser.add_argument('variants', nargs='*', metavar='variant', help="names from variants.json (default: all)")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--expand', action='store_true', help="also render macros called by the rendered output")
+    parser.add_argument('--mesh', default='5x5', help="size of the synthetic bed mesh, eg. 7x7")
+    parser.add_argument('--json', help="also write the report to this file")
+    parser.add_argument('--batch-save', action='store_true', help="render as if [zmod_variables] was loaded")
+    parser.add_argument('--repo-dir', default='../')
+    args = parser.parse_args()
+
+    matrix = load_matrix()
+    variants = []
+    for name in args.variants:
+        variant = matrix.find(name)
+        if variant is None:
+            parser.error(f"unknown variant {name}, expected one of: {', '.join(v.name for v in matrix.variants)}")
+        variants.append(variant)
+    if not variants:
+        variants = matrix.variants
+
+    mesh_size = tuple(int(size) for size in args.mesh.lower().split('x'))
+    model = load_settings('zmod_settings.json')
+
+    rows = []
+    for variant in variants:
+        variant_rows, compile_time, macro_count = run_variant(args.repo_dir, variant, model, max(args.repeat, 1),
+                                                              args.expand, mesh_size, args.batch_save)
+        print(f"{variant.name}: {macro_count} macros compiled in {compile_time * 1000.0:.1f} ms")
+        rows += variant_rows
+
+    print()
+    print(f"{'variant':<26} {'case':<16} {'bytes':>7} {'best ms':>9} {'mean ms':>9} {'cmds':>6} {'renders':>7} {'writes':>6}")
+    for row in rows:
+        line = (f"{row['variant']:<26} {row['case']:<16} {row['template_bytes']:>7} {row['best_ms']:>9.3f} "
+                f"{row['mean_ms']:>9.3f} {row['commands']:>6} {row['renders']:>7} {row['writes']:>6}")
+        if row['error'] is not None:
+            line += f"  error: {row['error']}"
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=1, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import re
+
+from flatten_config import TARGETS, flatten
+from macro_bench import create_environment
+from make_config_macros import generate
+from translate import load_sources
+from variant_matrix import load_matrix
+
+# Usage: python3 macro_graph.py [--target mod.cfg] [--top N] [--json report.json] [--compare old.json] [macro ...]
+#
+# Static call graph and expansion cost of the [gcode_macro]s of a target config.
+#
+# The target's include graph is resolved with flatten_config.py, so every macro is analyzed in the definition Klipper
+# would end up with. Each gcode: template is lexed with Klipper's Jinja settings and reduced to a tree of commands,
+# loops and if/elif/else branches. A line that renders to something is one command, and a command naming another macro
+# is a call. Worst case costs are then:
+#
+#   - a command costs 1, plus the expanded cost of the macro it calls
+#   - a loop costs its multiplier times its body. range() with literal bounds gives the multiplier, any other loop
+#     (eg. over the mesh points in _FIND_POINT) is counted with --loop-bound and reported as unbounded
+#   - a branch costs its most expensive arm
+#
+# A command whose name is partly templated (eg. _GLOBAL_PAGE_{n} in the _GLOBAL dispatcher) calls whichever macro its
+# literal parts match, and costs as much as the most expensive of them.
+#
+# Calls that close a cycle are counted as one command, the macros on it get the cost without going round again and
+# the cycle is reported. Klipper refuses to call a macro that is still running, so on the printer such a call is an
+# error. Besides calls the graph records the data dependencies between macros: SET_GCODE_VARIABLE MACRO=X writes X's
+# state, printer["gcode_macro X"] reads it.
+#
+# --json writes the report so that --compare can show what changed between two releases.
+
+DEFAULT_ENTRY_POINTS = ['START_PRINT', '_START_PRINT', 'KAMP', 'M600', 'CHECK_MD5', 'PAUSE', 'RESUME', 'CANCEL_PRINT']
+DEFAULT_LOOP_BOUND = 25
+
+RANGE_LOOP = re.compile(r'^for\s+\w+(?:\s*,\s*\w+)*\s+in\s+range\s*\('
+                        r'\s*(-?\d+)\s*(?:,\s*(-?\d+)\s*)?(?:,\s*(-?\d+)\s*)?\)\s*$')
+MACRO_READ = re.compile(r'''printer\s*\[\s*['"]gcode_macro\s+([^'"]+?)\s*['"]\s*\]''')
+MACRO_WRITE = re.compile(r'SET_GCODE_VARIABLE\s+.*?MACRO=([^\s{]+)', re.IGNORECASE)
+# A {...} in a command name.
+NAME_EXPRESSION = re.compile(r'(\{[^}]*\})')
+# Tags that open a block whose output is not emitted where it stands.
+CAPTURE_TAGS = {'set': 'endset', 'macro': 'endmacro', 'call': 'endcall', 'filter': 'endfilter'}
+
+class Command:
+    __slots__ = ('text', 'line')
+
+    def __init__(self, line):
+        self.text = ''
+        self.line = line
+
+    @property
+    def name(self):
+        word = self.text.split(None, 1)[0] if self.text.strip() else ''
+        return word.upper()
+
+class Loop:
+    __slots__ = ('multiplier', 'bounded', 'body', 'line')
+
+    def __init__(self, multiplier, bounded, line):
+        self.multiplier = multiplier
+        self.bounded = bounded
+        self.body = []
+        self.line = line
+
+class Branch:
+    __slots__ = ('arms', 'has_else', 'line')
+
+    def __init__(self, line):
+        self.arms = [[]]
+        self.has_else = False
+        self.line = line
+
+def _loop_multiplier(tag, loop_bound):
+    match = RANGE_LOOP.match(tag)
+    if match is None:
+        return loop_bound, False
+    start, stop, step = match.groups()
+    if stop is None:
+        start, stop = 0, start
+    start, stop, step = int(start), int(stop), int(step or 1)
+    return max(len(range(start, stop, step)), 0), True
+
+def parse_template(env, source, loop_bound=DEFAULT_LOOP_BOUND):
+    # Returns the body (a list of Command / Loop / Branch) of a gcode template.
+    body = []
+    # (node, list being filled, closing tag). node is None for blocks whose output is thrown away.
+    stack = [(None, body, None)]
+    command = None
+    tag = None
+    expression = None
+
+    for line, token_type, value in env.lex(source):
+        if token_type == 'block_begin':
+            tag = []
+            continue
+        if token_type == 'block_end':
+            words = ' '.join(tag).split()
+            keyword = words[0] if words else ''
+            text = ' '.join(words)
+            tag = None
+            _, target, closing = stack[-1]
+            if keyword == 'for':
+                loop = Loop(*_loop_multiplier(text, loop_bound), line)
+                target.append(loop)
+                stack.append((loop, loop.body, 'endfor'))
+            elif keyword == 'if':
+                branch = Branch(line)
+                target.append(branch)
+                stack.append((branch, branch.arms[0], 'endif'))
+            elif keyword in ('elif', 'else') and isinstance(stack[-1][0], Branch):
+                branch = stack[-1][0]
+                if keyword == 'else':
+                    branch.has_else = True
+                branch.arms.append([])
+                stack[-1] = (branch, branch.arms[-1], 'endif')
+            elif keyword in CAPTURE_TAGS and (keyword != 'set' or '=' not in text):
+                stack.append((None, [], CAPTURE_TAGS[keyword]))
+            elif keyword == closing and len(stack) > 1:
+                stack.pop()
+            continue
+        if tag is not None:
+            tag.append(value)
+            continue
+
+        if token_type == 'variable_begin':
+            expression = []
+            continue
+        if token_type == 'variable_end':
+            text = '{' + ''.join(expression).strip() + '}'
+            expression = None
+            if command is None:
+                # A line that only calls action_*() renders to nothing.
+                if text.startswith('{action_'):
+                    continue
+                command = Command(line)
+                stack[-1][1].append(command)
+            command.text += text
+            continue
+        if expression is not None:
+            expression.append(value)
+            continue
+
+        if token_type == 'data':
+            pieces = value.split('\n')
+            for index, piece in enumerate(pieces):
+                if index > 0:
+                    command = None
+                if piece.strip() and command is None:
+                    command = Command(line + index)
+                    stack[-1][1].append(command)
+                if command is not None:
+                    command.text += piece
+
+    return _clean(body)
+
+def _clean(body):
+    # Drop commands that are comments or whitespace only.
+    result = []
+    for item in body:
+        if isinstance(item, Command):
+            text = item.text.strip()
+            if not text or text.startswith(';') or text.startswith('#'):
+                continue
+            item.text = text
+        elif isinstance(item, Loop):
+            item.body = _clean(item.body)
+        else:
+            item.arms = [_clean(arm) for arm in item.arms]
+        result.append(item)
+    return result
+
+class MacroInfo:
+    __slots__ = ('name', 'source_file', 'line', 'body', 'renamed', 'reads', 'writes', 'callees', 'callers',
+                 'direct', 'expanded', 'max_multiplier', 'unbounded_loops', 'recursive')
+
+    def __init__(self, name, source_file, line, body, renamed):
+        self.name = name
+        self.source_file = source_file
+        self.line = line
+        self.body = body
+        self.renamed = renamed
+        self.reads = set()
+        self.writes = set()
+        self.callees = set()
+        self.callers = set()
+        self.direct = 0
+        self.expanded = None
+        self.max_multiplier = 1
+        self.unbounded_loops = 0
+        self.recursive = False
+
+def _walk_commands(body, multiplier=1):
+    for item in body:
+        if isinstance(item, Command):
+            yield item, multiplier
+        elif isinstance(item, Loop):
+            yield from _walk_commands(item.body, multiplier * item.multiplier)
+        else:
+            for arm in item.arms:
+                yield from _walk_commands(arm, multiplier)
+
+class MacroGraph:
+    def __init__(self, sections, loop_bound=DEFAULT_LOOP_BOUND):
+        self.env = create_environment()
+        self.macros = {}
+        # Commands that rename_existing moved a built-in or an earlier macro to, they cost one command.
+        self.builtins = set()
+        # [[A, B, ..., A]] for every call cycle found, and the templated command names resolved so far.
+        self.cycles = []
+        self.patterns = {}
+        for section in sections:
+            if not section.name.startswith('gcode_macro '):
+                continue
+            name = section.name.split(None, 1)[1].strip().upper()
+            gcode = section.options.get('gcode', None)
+            source = gcode.value() if gcode is not None else ''
+            renamed = None
+            if 'rename_existing' in section.options:
+                renamed = section.options['rename_existing'].value().upper()
+                self.builtins.add(renamed)
+            self.macros[name] = MacroInfo(name, section.source_file, section.line_number,
+                                          parse_template(self.env, source, loop_bound), renamed)
+            for match in MACRO_READ.finditer(source):
+                self.macros[name].reads.add(match.group(1).strip().upper())
+            for match in MACRO_WRITE.finditer(source):
+                self.macros[name].writes.add(match.group(1).strip().upper())
+
+        for macro in self.macros.values():
+            macro.direct = self._cost(macro.body, None)
+            for command, multiplier in _walk_commands(macro.body):
+                macro.max_multiplier = max(macro.max_multiplier, multiplier)
+                for callee in self._callees(command.name):
+                    macro.callees.add(callee)
+                    self.macros[callee].callers.add(macro.name)
+            macro.unbounded_loops = self._unbounded(macro.body)
+
+        for name in self.macros:
+            self._expand(name, [])
+
+    def _callees(self, name):
+        # The macros a command name calls: itself, or every macro the literal parts of a templated name match. A name
+        # that starts with an expression could be anything and is left alone.
+        if '{' not in name:
+            return [name] if name in self.macros and name not in self.builtins else []
+        if name.startswith('{'):
+            return []
+        callees = self.patterns.get(name, None)
+        if callees is None:
+            pattern = re.compile(''.join(r'\S+' if part.startswith('{') else re.escape(part)
+                                         for part in NAME_EXPRESSION.split(name) if part))
+            callees = sorted(callee for callee in self.macros
+                             if callee not in self.builtins and pattern.fullmatch(callee))
+            self.patterns[name] = callees
+        return callees
+
+    def _unbounded(self, body):
+        count = 0
+        for item in body:
+            if isinstance(item, Loop):
+                count += (0 if item.bounded else 1) + self._unbounded(item.body)
+            elif isinstance(item, Branch):
+                count += sum(self._unbounded(arm) for arm in item.arms)
+        return count
+
+    def _cost(self, body, active):
+        # active is None to count the body's own commands only.
+        total = 0
+        for item in body:
+            if isinstance(item, Command):
+                total += 1
+                if active is not None:
+                    total += max([self._expand(callee, active) for callee in self._callees(item.name)] or [0])
+            elif isinstance(item, Loop):
+                total += item.multiplier * self._cost(item.body, active)
+            else:
+                total += max(self._cost(arm, active) for arm in item.arms)
+        return total
+
+    def _expand(self, name, active):
+        # active is the call stack.
+        macro = self.macros[name]
+        if macro.expanded is not None:
+            return macro.expanded
+        if name in active:
+            # A cycle, the call itself has been counted already.
+            cycle = active[active.index(name):]
+            for member in cycle:
+                self.macros[member].recursive = True
+            # The same cycle entered elsewhere is reported once, starting at its first macro by name.
+            start = cycle.index(min(cycle))
+            cycle = cycle[start:] + cycle[:start]
+            if cycle + [cycle[0]] not in self.cycles:
+                self.cycles.append(cycle + [cycle[0]])
+            return 0
+        active.append(name)
+        # On a cycle this is the cost without going round again.
+        macro.expanded = self._cost(macro.body, active)
+        active.pop()
+        return macro.expanded
+
+    def report(self, entry_points):
+        macros = {}
+        for macro in sorted(self.macros.values(), key=lambda m: (-m.expanded, m.name)):
+            macros[macro.name] = {
+                'source': f"{macro.source_file}:{macro.line}",
+                'direct': macro.direct,
+                'expanded': macro.expanded,
+                'max_multiplier': macro.max_multiplier,
+                'unbounded_loops': macro.unbounded_loops,
+                'recursive': macro.recursive,
+                'callees': sorted(macro.callees),
+                'callers': sorted(macro.callers),
+                'reads': sorted(macro.reads),
+                'writes': sorted(macro.writes)
+            }
+        return {
+            'entry_points': [name for name in entry_points if name in self.macros],
+            'macros': macros,
+            'cycles': sorted(self.cycles)
+        }
+
+def load_target_sections(source_dir, target, no_generate=False):
+    generated = {}
+    if not no_generate:
+        matrix = load_matrix()
+        outputs = list(matrix.outputs.items())
+        for (output_file, _), (text, _) in zip(outputs, generate([key for _, key in outputs])):
+            generated[os.path.basename(output_file)] = text
+    sources = dict(load_sources(source_dir, generated))
+    flat = flatten(sources, target, TARGETS.get(target, {}))
+    return [section for block in flat.blocks if not isinstance(block, str) for section in block.values()]
+
+def _delta(new, old):
+    if old is None:
+        return 'new'
+    difference = new - old
+    return f"{difference:+d}" if difference else ''
+
+def print_report(report, top, old_report=None):
+    macros = report['macros']
+    old_macros = old_report['macros'] if old_report is not None else {}
+
+    def row(name):
+        info = macros[name]
+        old = old_macros.get(name, None)
+        flags = []
+        if info['unbounded_loops']:
+            flags.append(f"{info['unbounded_loops']} unbounded loop(s)")
+        if info['recursive']:
+            flags.append('recursive')
+        line = (f"{name:<32} {info['expanded']:>8} {info['direct']:>7} {info['max_multiplier']:>6} "
+                f"{len(info['callees']):>6} {len(info['callers']):>6}")
+        if old_report is not None:
+            line += f" {_delta(info['expanded'], old['expanded'] if old else None):>8}"
+        if flags:
+            line += '  ' + ', '.join(flags)
+        return line
+
+    header = f"{'macro':<32} {'expanded':>8} {'direct':>7} {'x loop':>6} {'calls':>6} {'called':>6}"
+    if old_report is not None:
+        header += f" {'change':>8}"
+
+    print("Entry points:")
+    print(header)
+    for name in report['entry_points']:
+        print(row(name))
+        info = macros[name]
+        if info['reads'] or info['writes']:
+            print(f"{'':<4}reads: {', '.join(info['reads']) or '-'}; writes: {', '.join(info['writes']) or '-'}")
+
+    print()
+    print(f"Hottest {top} macros:")
+    print(header)
+    for name in list(macros)[:top]:
+        print(row(name))
+
+    if report['cycles']:
+        # Klipper stops these with "Macro ... called recursively".
+        print()
+        print("Call cycles:")
+        for cycle in report['cycles']:
+            print(f"    {' -> '.join(cycle)}")
+
+    if old_report is not None:
+        removed = [name for name in old_macros if name not in macros]
+        if removed:
+            print()
+            print(f"Removed: {', '.join(removed)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the worst case expanded command count of gcode macros.")
+    parser.add_argument('entry_points', nargs='*', metavar='macro',
+                        help=f"macros to report in detail (default: {', '.join(DEFAULT_ENTRY_POINTS)})")
+    parser.add_argument('--target', default='mod.cfg', help="config whose include graph is analyzed")
+    parser.add_argument('--source-dir', default='../')
+    parser.add_argument('--no-generate', action='store_true',
+                        help="take the *_config_*.cfg files from the source dir instead of generating them")
+    parser.add_argument('--loop-bound', type=int, default=DEFAULT_LOOP_BOUND,
+                        help="iterations assumed for loops that are not over a literal range()")
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--json', help="also write the report to this file")
+    parser.add_argument('--compare', help="a report written by --json to compare against")
+    args = parser.parse_args()
+
+    sections = load_target_sections(args.source_dir, args.target, args.no_generate)
+    graph = MacroGraph(sections, args.loop_bound)
+    report = graph.report([name.upper() for name in args.entry_points] or DEFAULT_ENTRY_POINTS)
+    report['target'] = args.target
+    report['loop_bound'] = args.loop_bound
+
+    old_report = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            old_report = json.load(f)
+    print_report(report, args.top, old_report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
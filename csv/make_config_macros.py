@@ -1,5 +1,15 @@
-import json
+import argparse
+import marshal
+import os
 import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from build_manifest import BuildManifest, MANIFEST_NAME, MemoTable, combine_hashes, hash_file, write_if_changed
+from jinja_optimizer import optimize_config
+from settings_model import load_settings
+from variant_matrix import load_matrix
 
 # zmod_settings.json structure:
 # "Categories": A set of key-value pairs for the categories settings are divided into.
@@ -10,8 +20,9 @@ import re
 #
 # "Settings": A set of key-value pairs for the actual parameters. The keys should match the parameter name.
 #       "type": The type of data stored by the setting (int, string, etc). Assumed type if not specified is indicated by
-#               TYPE_ASSUMPTION. If set to "special", the parameter will do nothing in SAVE/GET_ZMOD_DATA or _RESET_ZMOD,
-#               and in GLOBAL will copy pre-written code exactly. (Used for LANG and _RESET_ZMOD buttons.)
+#               TYPE_ASSUMPTION in settings_model.py. If set to "special", the parameter will do nothing in
+#               SAVE/GET_ZMOD_DATA or _RESET_ZMOD, and in GLOBAL will copy pre-written code exactly. (Used for LANG and
+#               _RESET_ZMOD buttons.)
 #       "default": The default value for the parameter. Assumed default if not specified is the value of
 #                  DEFAULT_STRING_ASSUMPTION for strings, or DEFAULT_VALUE_ASSUMPTION for anything else.
 #       "category": The category for the parameter (should match one of the keys from Categories).
@@ -62,541 +73,663 @@ BASE_INDENT_GLOBAL = 1
 
 ITEMS_PER_GLOBAL_PAGE = 4
 
-DEFAULT_VALUE_ASSUMPTION = 0
-DEFAULT_STRING_ASSUMPTION = ""
-TYPE_ASSUMPTION = 'int'
-
 GLOBAL_CANNOT_CHANGE_COLOR = 'grey'
 
-def validate_setup(ad5x_requirement, native_screen_requirement, is_ad5x, is_native_screen):
-    if ad5x_requirement < 0 and is_ad5x:
-        return False
-    if ad5x_requirement > 0 and not is_ad5x:
-        return False
-    if native_screen_requirement < 0 and is_native_screen:
-        return False
-    if native_screen_requirement > 0 and not is_native_screen:
-        return False
-    return True
-
-def get_setting_global_settable_options(setting, is_ad5x, is_native_screen):
-    texts = setting.get("global_text", None)
-    if texts == None:
-        texts = setting.get("get_zmod_data_text", {})
-
-    can_set_values = setting.get("global_set_values", None)
-    if is_ad5x:
-        can_set_values = setting.get("global_set_values_ad5x", can_set_values)
-    if is_native_screen:
-        can_set_values = setting.get("global_set_values_native_screen", can_set_values)
-    if is_ad5x and is_native_screen:
-        can_set_values = setting.get("global_set_values_native_screen_ad5x", can_set_values)
-    if can_set_values == None:
-        can_set_values = []
-        for condition, _ in texts.items():
-            if condition == '*':
-                break
-            if setting.get('type', TYPE_ASSUMPTION) != 'string':
-                if 'n' in condition and not is_native_screen:
-                    continue
-                if 'g' in condition and is_native_screen:
-                    continue
-                if 'x' in condition and not is_ad5x:
-                    continue
-                if 'm' in condition and is_ad5x:
-                    continue
-                condition = re.sub(r'[nxmg]', '', condition)
-            can_set_values += [condition]
-
-    can_set_values = [str(value) for value in can_set_values]
-
-    return list(dict.fromkeys(can_set_values))
-
-def get_valid_options(setting, is_ad5x, is_native_screen):
-    global_options = get_setting_global_options('placeholder', setting, is_ad5x, is_native_screen)
-    global_options = [option['condition'] for option in global_options]
-
-    result = {
-        'settable_values': get_setting_global_settable_options(setting, is_ad5x, is_native_screen),
-        'valid_values': global_options,
-        'min_value': setting.get('min_valid_value', None),
-        'max_value': setting.get('max_valid_value', None),
-        'allow_generic': '*' in global_options
-    }
-
-    if '*' in global_options:
-        global_options.remove('*')
-
-    return result 
-
-def get_setting_global_options(setting_name, setting, is_ad5x, is_native_screen):
-    result = []
-
-    texts = setting.get("global_text", None)
-    if texts == None:
-        texts = setting.get("get_zmod_data_text", {})
-
-    can_set_values = get_setting_global_settable_options(setting, is_ad5x, is_native_screen)
-    done_conditions = []
-
-    generic_text = texts.get('*', None)
-
-    for value in can_set_values:
-        next_value_index = can_set_values.index(value) + 1
-        if next_value_index == len(can_set_values):
-            next_value_index = 0
-        next_value = can_set_values[next_value_index]
-
-        for condition, text in texts.items():
-            if setting['type'] != 'string':
-                condition_ad5x = 1 if 'x' in condition else -1 if 'm' in condition else 0
-                condition_native_screen = 1 if 'n' in condition else -1 if 'g' in condition else 0
-                condition_stripped = re.sub(r'[nxmg]', '', condition)
-            else:
-                condition_ad5x = False
-                condition_native_screen = False
-                condition_stripped = condition
-
-            if condition_stripped != value:
-                continue
-
-            if not validate_setup(condition_ad5x, condition_native_screen, is_ad5x, is_native_screen):
-                continue
-
-            result += [{
-                "condition": condition_stripped,
-                "text": text,
-                "next_value": next_value
-            }]
-            done_conditions += [condition_stripped]
-            break
-        if value not in done_conditions:
-            if generic_text == None:
-                option_text = f"{setting_name.upper()} ===custom value:=== {{z{setting_name.lower()}}}"
-            else:
-                option_text = generic_text
-            result += [{
-                "condition": value,
-                "text": option_text,
-                "next_value": next_value
-            }]
-
-    for condition, text in texts.items():
-        if setting['type'] != 'string':
-            condition_ad5x = 1 if 'x' in condition else -1 if 'm' in condition else 0
-            condition_native_screen = 1 if 'n' in condition else -1 if 'g' in condition else 0
-            condition_stripped = re.sub(r'[nxmg]', '', condition)
-        else:
-            condition_ad5x = False
-            condition_native_screen = False
-            condition_stripped = condition
-
-        if condition_stripped in done_conditions:
-            continue
-
-        if not validate_setup(condition_ad5x, condition_native_screen, is_ad5x, is_native_screen):
-            continue
-
-        result += [{
-            "condition": condition_stripped,
-            "text": text,
-            "next_value": None
-        }]
-
-        if condition_stripped == '*':
-            break
-        done_conditions += [condition_stripped]
-
-    return result
-
-def add_save_zmod_data(file_data, is_ad5x, is_native_screen, categories, settings):
+# What _GLOBAL shows after the last page.
+GLOBAL_END = "_SHOW_MSG MSG=\"===If any parameters were changed, it is recommended to reboot the printer===. Macro GLOBAL\" COMMAND='_GLOBAL_SAVE PARAM=skip_global' COMMAND_REBOOT=\"_GLOBAL_SAVE PARAM=skip_global REBOOT=1\""
+
+# Settings are saved with the command the macro template keeps in save_command: ZMOD_SAVE_VARIABLE when
+# extras/zmod_variables.py is loaded, which only stages changed values until the template's ZMOD_FLUSH_VARIABLES writes
+# them all at once, SAVE_VARIABLE otherwise.
+SAVE_COMMAND = '{save_command}'
+
+def save_variable(setting, value):
+    # value is copied verbatim, a literal or a {jinja} expression
+    if setting.type == 'string':
+        return f"{SAVE_COMMAND} VARIABLE={setting.lower} VALUE=\"\\\"{value}\\\"\""
+    return f"{SAVE_COMMAND} VARIABLE={setting.lower} VALUE={value}"
+
+def add_setting_fragment(file_data, cache, key, setting, emit):
+    # Appends what emit(lines) appends. With a cache, the lines are only emitted again when the setting's JSON changed.
+    if cache == None:
+        emit(file_data)
+        return
+    file_data += cache.fragments.get(key + (setting.name, setting.source), lambda: _emitted(emit))
+
+def _emitted(emit):
+    lines = []
+    emit(lines)
+    return lines
+
+def add_save_zmod_data(file_data, is_ad5x, is_native_screen, model, cache=None):
     indent_level = BASE_INDENT_SAVE_ZMOD_DATA
 
     file_data.append((indent_level * STANDARD_INDENT) + '# Begin script-generated SAVE_ZMOD_DATA code')
     file_data.append('')
 
-    for category, cat_data in categories.items():
-        for setting, set_data in settings.items():
-            if set_data.get('category', '') != category or set_data.get('type', '') == 'special':
+    for category in model.categories:
+        for setting in category.settings:
+            if setting.type == 'special':
                 continue
 
-            if not validate_setup(set_data.get('require_ad5x', 0), set_data.get('require_native_screen', 0), is_ad5x, is_native_screen):
+            if not setting.visible(is_ad5x, is_native_screen):
                 continue
 
-            file_data.append((indent_level * STANDARD_INDENT) + f"{{% if params.{setting.upper()} %}}")
-            indent_level += 1
+            add_setting_fragment(file_data, cache, ('SAVE_ZMOD_DATA',), setting,
+                                 lambda lines: add_save_zmod_data_setting(lines, indent_level, setting))
 
-            if set_data.get('type', TYPE_ASSUMPTION) == 'string':
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = params.{setting.upper()}|default(\"{set_data.get('default', DEFAULT_STRING_ASSUMPTION)}\")|string %}}")
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% if z{setting.lower()} == \"0\" %}}")
-                file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"{{% set z{setting.lower()} = \"\" %}}")
-                file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
-                file_data.append((indent_level * STANDARD_INDENT) + f"SAVE_VARIABLE VARIABLE={setting.lower()} VALUE=\"\\\"{{z{setting.lower()}}}\\\"\"")
-            else:
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting} = params.{setting.upper()}|default({set_data.get('default', DEFAULT_VALUE_ASSUMPTION)})|{set_data.get('type', TYPE_ASSUMPTION)} %}}")
-                file_data.append((indent_level * STANDARD_INDENT) + f"SAVE_VARIABLE VARIABLE={setting.lower()} VALUE={{z{setting.lower()}}}")
+    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated SAVE_ZMOD_DATA code')
 
-            indent_level -= 1
-            file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
+def add_save_zmod_data_setting(file_data, indent_level, setting):
+    file_data.append((indent_level * STANDARD_INDENT) + f"{{% if params.{setting.upper} %}}")
+    indent_level += 1
 
-            file_data.append('')
+    if setting.type == 'string':
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = params.{setting.upper}|default(\"{setting.default}\")|string %}}")
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if z{setting.lower} == \"0\" %}}")
+        file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"{{% set z{setting.lower} = \"\" %}}")
+        file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
+    else:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.name} = params.{setting.upper}|default({setting.default})|{setting.type} %}}")
+    file_data.append((indent_level * STANDARD_INDENT) + save_variable(setting, f"{{z{setting.lower}}}"))
 
-    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated SAVE_ZMOD_DATA code')
+    indent_level -= 1
+    file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
 
-def add_get_zmod_data(file_data, is_ad5x, is_native_screen, categories, settings):
+    file_data.append('')
+
+def add_get_zmod_data(file_data, is_ad5x, is_native_screen, model, cache=None):
     indent_level = BASE_INDENT_GET_ZMOD_DATA
 
     file_data.append((indent_level * STANDARD_INDENT) + '# Begin script-generated GET_ZMOD_DATA code')
     file_data.append('')
 
-    for category, cat_data in categories.items():
-        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"info\" MSG=\"{cat_data.get("get_zmod_data_text", "")}\"")
+    for category in model.categories:
+        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"info\" MSG=\"{category.get_zmod_data_text}\"")
         file_data.append('')
-        for setting, set_data in settings.items():
-            if set_data.get('category', '') != category or set_data.get('type', '') == 'special':
+        for setting in category.settings:
+            if setting.type == 'special':
                 continue
 
-            if not validate_setup(set_data.get("require_ad5x", 0), set_data.get("require_native_screen", 0), is_ad5x, is_native_screen):
+            if not setting.visible(is_ad5x, is_native_screen):
                 continue
 
-            condition = set_data.get('show_condition', None)
-            if condition != None:
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% if {condition} %}}")
-                indent_level += 1
-            setting_type = set_data.get('type', TYPE_ASSUMPTION)
+            add_setting_fragment(file_data, cache, ('GET_ZMOD_DATA', is_ad5x, is_native_screen), setting,
+                                 lambda lines: add_get_zmod_data_setting(lines, indent_level, setting, is_ad5x, is_native_screen))
+
+    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated GET_ZMOD_DATA code')
+
+def add_get_zmod_data_setting(file_data, indent_level, setting, is_ad5x, is_native_screen):
+    variant = setting.variant(is_ad5x, is_native_screen)
+
+    condition = setting.show_condition
+    if condition != None:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if {condition} %}}")
+        indent_level += 1
+    setting_type = setting.type
+
+    if setting_type == 'string':
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = printer.save_variables.variables['{setting.lower}']|default(\"{setting.default}\")|string %}}")
+    else:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = printer.save_variables.variables['{setting.lower}']|default({setting.default})|{setting_type} %}}")
+
+    if variant.allow_generic:
+        if setting_type != 'string':
+            min_valid_value = setting.min_value
+            max_valid_value = setting.max_value
+
+            if min_valid_value != None:
+                file_data.append((indent_level * STANDARD_INDENT) + f"{{% if z{setting.lower} < {min_valid_value} %}}")
+                file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"{{% set z{setting.lower} = {min_valid_value} %}}")
+                file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
+            if max_valid_value != None:
+                file_data.append((indent_level * STANDARD_INDENT) + f"{{% if z{setting.lower} > {max_valid_value} %}}")
+                file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"{{% set z{setting.lower} = {max_valid_value} %}}")
+                file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
+    elif len(variant.valid_values) > 0:
+        quotechar = '"' if setting_type == 'string' else ''
+        reset_condition = ' and '.join(f"z{setting.lower} != {quotechar}{valid_value}{quotechar}" for valid_value in variant.valid_values)
+
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if {reset_condition} %}}")
+        indent_level += 1
+
+        if setting_type == 'string':
+            file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = \"{setting.default}\" %}}")
+        else:
+            file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = {setting.default} %}}")
+
+        indent_level -= 1
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
+
+    had_generic = False
+    is_first = True
+    for text_condition in variant.zmod_data_texts:
+        text = text_condition.text
+        if text_condition.value == '*':
+            had_generic = True
+            if not is_first:
+                file_data.append(((indent_level - 1) * STANDARD_INDENT) + "{% else %}")
+        else:
+            prefix = "" if is_first else "el" # "if" or "elif"
+
+            if not is_first:
+                indent_level -= 1
 
             if setting_type == 'string':
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = printer.save_variables.variables['{setting.lower()}']|default(\"{set_data.get('default', DEFAULT_STRING_ASSUMPTION)}\")|string %}}")
-            else:
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = printer.save_variables.variables['{setting.lower()}']|default({set_data.get('default', DEFAULT_VALUE_ASSUMPTION)})|{setting_type} %}}")
-
-            valid_options = get_valid_options(set_data, is_ad5x, is_native_screen)
-
-            if valid_options['allow_generic']:
-                if setting_type != 'string':
-                    min_valid_value = valid_options['min_value']
-                    max_valid_value = valid_options['max_value']
-
-                    if min_valid_value != None:
-                        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if z{setting.lower()} < {min_valid_value} %}}")
-                        file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"{{% set z{setting.lower()} = {min_valid_value} %}}")
-                        file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
-                    if max_valid_value != None:
-                        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if z{setting.lower()} > {max_valid_value} %}}")
-                        file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"{{% set z{setting.lower()} = {max_valid_value} %}}")
-                        file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
+                condition_string = f"{prefix}if z{setting.lower} == \"{text_condition.value}\""
             else:
-                reset_condition = ''
-                quotechar = '"' if setting_type == 'string' else ''
-                for valid_option in valid_options['valid_values']:
-                    if reset_condition != '':
-                        reset_condition += ' and '
-                    reset_condition += f"z{setting.lower()} != {quotechar}{valid_option}{quotechar}"
-
-                if reset_condition != '':
-                    file_data.append((indent_level * STANDARD_INDENT) + f"{{% if {reset_condition} %}}")
-                    indent_level += 1
-
-                    if setting_type == 'string':
-                        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = \"{set_data.get('default', DEFAULT_STRING_ASSUMPTION)}\" %}}")
-                    else:
-                        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = {set_data.get('default', DEFAULT_VALUE_ASSUMPTION)} %}}")
-
-                    indent_level -= 1
-                    file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
-
-            had_generic = False
-            is_first = True
-            for text_condition, text in set_data.get('get_zmod_data_text', {}).items():
-                if text_condition == '*':
-                    had_generic = True
-                    if not is_first:
-                        file_data.append(((indent_level - 1) * STANDARD_INDENT) + "{% else %}")
-                else:
-                    if setting_type != 'string':
-                        condition_ad5x = 1 if 'x' in text_condition else -1 if 'm' in text_condition else 0
-                        condition_native_screen = 1 if 'n' in text_condition else -1 if 'g' in text_condition else 0
-                        text_condition = re.sub(r'[nxmg]', '', text_condition)
-                        if not validate_setup(condition_ad5x, condition_native_screen, is_ad5x, is_native_screen):
-                            continue
-
-                    had_regular = True
-                    prefix = "" if is_first else "el" # "if" or "elif"
-
-                    if not is_first:
-                        indent_level -= 1
-
-                    if setting_type == 'string':
-                        condition_string = f"{prefix}if z{setting.lower()} == \"{text_condition}\""
-                    else:
-                        condition_string = f"{prefix}if z{setting.lower()} == {text_condition}"
-
-                    file_data.append((indent_level * STANDARD_INDENT) + f"{{% {condition_string} %}}")
-                    indent_level += 1
+                condition_string = f"{prefix}if z{setting.lower} == {text_condition.value}"
 
-                if setting_type == 'string':
-                    file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"{text} // SAVE_ZMOD_DATA {setting.upper()}=\\\"{{z{setting.lower()}}}\\\"\"")
-                else:
-                    file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"{text} // SAVE_ZMOD_DATA {setting.upper()}={{z{setting.lower()}}}\"")
+            file_data.append((indent_level * STANDARD_INDENT) + f"{{% {condition_string} %}}")
+            indent_level += 1
 
-                if had_generic:
-                    break
+        if setting_type == 'string':
+            file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"{text} // SAVE_ZMOD_DATA {setting.upper}=\\\"{{z{setting.lower}}}\\\"\"")
+        else:
+            file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"{text} // SAVE_ZMOD_DATA {setting.upper}={{z{setting.lower}}}\"")
 
-                is_first = False
+        if had_generic:
+            break
 
-            if not had_generic:
-                if not is_first:
-                    file_data.append(((indent_level - 1) * STANDARD_INDENT) + "{% else %}")
-                if setting_type == 'string':
-                    file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"===Unrecognized value for setting:=== {setting.upper()} // SAVE_ZMOD_DATA {setting.upper()}=\\\"{{z{setting.lower()}}}\\\"\"")
-                else:
-                    file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"===Unrecognized value for setting:=== {setting.upper()} // SAVE_ZMOD_DATA {setting.upper()}={{z{setting.lower()}}}\"")
+        is_first = False
 
-            if not is_first or not had_generic:
-                indent_level -= 1
-                file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
+    if not had_generic:
+        if not is_first:
+            file_data.append(((indent_level - 1) * STANDARD_INDENT) + "{% else %}")
+        if setting_type == 'string':
+            file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"===Unrecognized value for setting:=== {setting.upper} // SAVE_ZMOD_DATA {setting.upper}=\\\"{{z{setting.lower}}}\\\"\"")
+        else:
+            file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND PREFIX=\"//\" MSG=\"===Unrecognized value for setting:=== {setting.upper} // SAVE_ZMOD_DATA {setting.upper}={{z{setting.lower}}}\"")
 
-            if setting_type == 'string':
-                file_data.append((indent_level * STANDARD_INDENT) + f"SAVE_VARIABLE VARIABLE={setting.lower()} VALUE=\"\\\"{{z{setting.lower()}}}\\\"\"")
-            else:
-                file_data.append((indent_level * STANDARD_INDENT) + f"SAVE_VARIABLE VARIABLE={setting.lower()} VALUE={{z{setting.lower()}}}")
+    if not is_first or not had_generic:
+        indent_level -= 1
+        file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
 
-            if condition != None:
-                indent_level -= 1
-                file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
+    file_data.append((indent_level * STANDARD_INDENT) + save_variable(setting, f"{{z{setting.lower}}}"))
 
-            file_data.append('')
+    if condition != None:
+        indent_level -= 1
+        file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
 
-    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated GET_ZMOD_DATA code')
+    file_data.append('')
 
-def add_reset_zmod(file_data, is_ad5x, is_native_screen, categories, settings):
+def add_reset_zmod(file_data, is_ad5x, is_native_screen, model, cache=None):
     indent_level = BASE_INDENT_RESET_ZMOD
 
     file_data.append((indent_level * STANDARD_INDENT) + '# Begin script-generated _RESET_ZMOD code')
     file_data.append('')
 
-    for category, cat_data in categories.items():
-        file_data.append((indent_level * STANDARD_INDENT) + f"# {category}")
-        for setting, set_data in settings.items():
-            if set_data.get('category', '') != category or set_data.get('type', '') == 'special':
+    for category in model.categories:
+        file_data.append((indent_level * STANDARD_INDENT) + f"# {category.name}")
+        for setting in category.settings:
+            if setting.type == 'special':
                 continue
-            if set_data.get('exclude_from_reset', False):
+            if setting.exclude_from_reset:
                 continue
-            if not set_data.get('show_in_global', True):
+            if not setting.show_in_global:
                 continue
 
-            if not validate_setup(set_data.get('require_ad5x', 0), set_data.get('require_native_screen', 0), is_ad5x, is_native_screen):
+            if not setting.visible(is_ad5x, is_native_screen):
                 continue
 
-            valid_options = get_valid_options(set_data, is_ad5x, is_native_screen)
-            settable_values = valid_options['settable_values']
+            add_setting_fragment(file_data, cache, ('_RESET_ZMOD', is_ad5x, is_native_screen), setting,
+                                 lambda lines: add_reset_zmod_setting(lines, indent_level, setting, is_ad5x, is_native_screen))
 
-            if len(settable_values) == 0:
-                continue
+    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated _RESET_ZMOD code')
 
-            setting_type = set_data.get('type', TYPE_ASSUMPTION)
-            quotechar = '"' if setting_type == 'string' else ''
+def add_reset_zmod_setting(file_data, indent_level, setting, is_ad5x, is_native_screen):
+    variant = setting.variant(is_ad5x, is_native_screen)
+    settable_values = variant.settable_values
 
-            if valid_options['allow_generic']:
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = printer.save_variables.variables['{setting.lower()}'] %}}")
-                if_line = None
-                for settable_value in settable_values:
-                    if if_line == None:
-                        if_line = "{% if"
-                    else:
-                        if_line += " or"
-                    if_line += f" z{setting.lower()} == {quotechar}{settable_value}{quotechar}"
+    if len(settable_values) == 0:
+        return
 
-                if_line += " %}"
+    quotechar = '"' if setting.type == 'string' else ''
 
-                file_data.append((indent_level * STANDARD_INDENT) + if_line)
-                indent_level += 1
+    if variant.allow_generic:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = printer.save_variables.variables['{setting.lower}'] %}}")
+        if_line = "{% if " + " or ".join(f"z{setting.lower} == {quotechar}{settable_value}{quotechar}" for settable_value in settable_values) + " %}"
 
-            if setting_type == 'string':
-                file_data.append((indent_level * STANDARD_INDENT) + f"SAVE_VARIABLE VARIABLE={setting.lower()} VALUE=\"\\\"{set_data.get('default', DEFAULT_STRING_ASSUMPTION)}\\\"\"")
-            else:
-                file_data.append((indent_level * STANDARD_INDENT) + f"SAVE_VARIABLE VARIABLE={setting.lower()} VALUE={set_data.get('default', DEFAULT_VALUE_ASSUMPTION)}")
+        file_data.append((indent_level * STANDARD_INDENT) + if_line)
+        indent_level += 1
 
-            if valid_options['allow_generic']:
-                indent_level -= 1
-                file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
-            file_data.append('')
+    file_data.append((indent_level * STANDARD_INDENT) + save_variable(setting, setting.default))
 
-    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated _RESET_ZMOD code')
+    if variant.allow_generic:
+        indent_level -= 1
+        file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
+    file_data.append('')
+
+
+def get_global_pages(model, is_ad5x, is_native_screen):
+    # The GLOBAL page layout for one variant. Every category starts on a new page, and a page holds at most
+    # ITEMS_PER_GLOBAL_PAGE settings.
+    pages = []
+
+    for category in model.categories:
+        page = None
+        for setting in category.settings:
+            if not setting.visible(is_ad5x, is_native_screen):
+                continue
+            if setting.show_in_global == False:
+                continue
+
+            if page == None or len(page['settings']) == ITEMS_PER_GLOBAL_PAGE:
+                page = {"number": len(pages) + 1, "header": category.global_text, "settings": []}
+                pages.append(page)
+            page['settings'].append(setting)
 
+    for page in pages:
+        # Only a page made up entirely of settings with a show_condition can turn out empty on the printer. Every other
+        # page is known to show something, so it doesn't need to count its items.
+        page['may_be_empty'] = all(setting.type != 'special' and setting.show_condition != None for setting in page['settings'])
 
-def add_global(file_data, is_ad5x, is_native_screen, categories, settings):
+    return pages
+
+def add_global(file_data, is_ad5x, is_native_screen, model):
     indent_level = BASE_INDENT_GLOBAL
 
     file_data.append((indent_level * STANDARD_INDENT) + '# Begin script-generated _GLOBAL code')
     file_data.append('')
 
-    # This one is trickier. We need some extra logic here to skip unused pages, and divide into pages.
+    # _GLOBAL itself only dispatches to the macro for the requested page, so the printer never renders the other pages.
 
-    setting_entries = []
+    page_count = len(get_global_pages(model, is_ad5x, is_native_screen))
 
-    for category, cat_data in categories.items():
-        category_entries = {}
-        header_text = cat_data.get("global_text", None)
-        if header_text == None:
-            header_text = cat_data.get("get_zmod_data_text", "")
-        setting_entries += [{"header": header_text, "settings": category_entries}]
+    file_data.append((indent_level * STANDARD_INDENT) + "{% if start == 0 %}")
+    indent_level += 1
 
-        for setting, set_data in settings.items():
-            if set_data.get('category', '') != category:
-                continue
-            if not validate_setup(set_data.get('require_ad5x', 0), set_data.get('require_native_screen', 0), is_ad5x, is_native_screen):
-                continue
-            if set_data.get('show_in_global', True) == False:
-                continue
-            category_entries[setting] = set_data
+    if page_count > 0:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if n >= 1 and n <= {page_count} %}}")
+        file_data.append(((indent_level + 1) * STANDARD_INDENT) + "_GLOBAL_PAGE_{n}")
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% elif n > {page_count} %}}")
+    else:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if n >= 1 %}}")
+    file_data.append(((indent_level + 1) * STANDARD_INDENT) + GLOBAL_END)
+    file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
 
-    page = 1
-    items_on_page = 0
+    indent_level -= 1
+    file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
 
-    indent_level += 1
+    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated _GLOBAL code')
+    file_data.append('')
 
-    for category_entry in setting_entries:
-        for setting, set_data in category_entry['settings'].items():
-            if items_on_page == ITEMS_PER_GLOBAL_PAGE:
-                file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_footer_button ===Next===|_GLOBAL N={page + 1}|red\"")
-                file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_show\"")
-                file_data.append((indent_level * STANDARD_INDENT) + "{% if this_page_visible_items == 0 %}")
-                file_data.append(((indent_level + 1) * STANDARD_INDENT) + "RESPOND TYPE=command MSG=\"action:prompt_end\"")
-                file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"{{% set n = {page+1} %}}")
-
-                file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
-                file_data.append(((indent_level - 1) * STANDARD_INDENT) + "{% endif %}")
-                file_data.append('')
-
-                page += 1
-                items_on_page = 0
-            if items_on_page == 0:
-                file_data.append(((indent_level - 1) * STANDARD_INDENT) + f"{{% if n == {page} and start == 0 %}}")
-                file_data.append((indent_level * STANDARD_INDENT) + f"{{% set this_page_visible_items = 0 %}}")
-                file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_begin {page}: {category_entry['header']}\"")
-                file_data.append('')
-
-            setting_type = set_data.get('type', TYPE_ASSUMPTION)
-
-            if setting_type == "special":
-                code = set_data.get('code', '').replace('\r', '').split('\n')
-                file_data.append((indent_level * STANDARD_INDENT) + "{% set this_page_visible_items = this_page_visible_items + 1 %}")
-                for line in code:
-                    file_data.append((indent_level * STANDARD_INDENT) + line)
-                file_data.append('')
-                items_on_page += 1
-            else:
-                extra_condition = set_data.get('show_condition', None)
-                if extra_condition != None:
-                    file_data.append((indent_level * STANDARD_INDENT) + f"{{% if {extra_condition} %}}")
-                    indent_level += 1
+def add_global_setting(file_data, indent_level, setting, page, is_ad5x, is_native_screen):
+    setting_type = setting.type
 
+    if setting_type == "special":
+        code = setting.code.replace('\r', '').split('\n')
+        if page['may_be_empty']:
+            file_data.append((indent_level * STANDARD_INDENT) + "{% set this_page_visible_items = this_page_visible_items + 1 %}")
+        for line in code:
+            file_data.append((indent_level * STANDARD_INDENT) + line)
+        file_data.append('')
+        return
+
+    extra_condition = setting.show_condition
+    if extra_condition != None:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% if {extra_condition} %}}")
+        indent_level += 1
+
+    if setting_type == 'string':
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = printer.save_variables.variables['{setting.lower}']|default(\"{setting.default}\")|string %}}")
+    else:
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower} = printer.save_variables.variables['{setting.lower}']|default({setting.default})|{setting_type} %}}")
+
+    setting_conditions = setting.variant(is_ad5x, is_native_screen).global_options
+    page_number = page['number']
+
+    if len(setting_conditions) == 0:
+        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {setting.upper} ===custom value:=== {{z{setting.lower}}}|_GLOBAL N={page_number}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
+    elif len(setting_conditions) == 1 and setting_conditions[0].condition == '*':
+        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {setting_conditions[0].text}|_GLOBAL N={page_number}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
+    else:
+        generic_option = setting_conditions[-1]
+        if generic_option.condition == '*':
+            setting_conditions = setting_conditions[:-1]
+        else:
+            generic_option = None
+        if_text = 'if'
+        for this_condition in setting_conditions:
+            local_condition = this_condition.condition
+            if setting_type == 'string':
+                local_condition = f"\"{local_condition}\""
+            file_data.append((indent_level * STANDARD_INDENT) + f"{{% {if_text} z{setting.name} == {local_condition} %}}")
+            if_text = 'elif'
+            if this_condition.next_value == None:
+                file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {this_condition.text}|_GLOBAL N={page_number}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
+            else:
+                local_next_value = this_condition.next_value
                 if setting_type == 'string':
-                    file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = printer.save_variables.variables['{setting.lower()}']|default(\"{set_data.get('default', DEFAULT_STRING_ASSUMPTION)}\")|string %}}")
-                else:
-                    file_data.append((indent_level * STANDARD_INDENT) + f"{{% set z{setting.lower()} = printer.save_variables.variables['{setting.lower()}']|default({set_data.get('default', DEFAULT_VALUE_ASSUMPTION)})|{setting_type} %}}")
-
-                setting_conditions = get_setting_global_options(setting, set_data, is_ad5x, is_native_screen)
-
-                if len(setting_conditions) == 0:
-                    file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {setting.upper()} ===custom value:=== {{z{setting.lower()}}}|_GLOBAL N={page}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
-                elif len(setting_conditions) == 1 and setting_conditions[0]['condition'] == '*':
-                    file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {setting_conditions[0]['text']}|_GLOBAL N={page}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
-                else:
-                    generic_option = setting_conditions[-1]
-                    if generic_option['condition'] == '*':
-                        setting_conditions.remove(generic_option)
-                    else:
-                        generic_option = None
-                    if_text = 'if'
-                    for this_condition in setting_conditions:
-                        local_condition = this_condition['condition']
-                        if setting_type == 'string':
-                            local_condition = f"\"{local_condition}\""
-                        file_data.append((indent_level * STANDARD_INDENT) + f"{{% {if_text} z{setting} == {local_condition} %}}")
-                        if_text = 'elif'
-                        if this_condition['next_value'] == None:
-                            file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {this_condition['text']}|_GLOBAL N={page}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
-                        else:
-                            local_next_value = this_condition['next_value']
-                            if setting_type == 'string':
-                                local_next_value = f"\\\"{local_next_value}\\\""
-                            file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {this_condition['text']}|SAVE_ZMOD_DATA {setting.upper()}={local_next_value} I={page}|primary\"")
-
-                    file_data.append((indent_level * STANDARD_INDENT) + "{% else %}")
-
-                    if generic_option == None:
-                        fallback_text = f"{setting.upper()} ===custom value:=== {{z{setting.lower()}}}"
-                    else:
-                        fallback_text = generic_option['text']
-
-                    file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {fallback_text}|_GLOBAL N={page}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
-                    file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
-
-                file_data.append((indent_level * STANDARD_INDENT) + "{% set this_page_visible_items = this_page_visible_items + 1 %}")
-
-                if extra_condition != None:
-                    indent_level -= 1
-                    file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
-
-                file_data.append('')
-                items_on_page += 1
-
-        if items_on_page > 0:
-            items_on_page = ITEMS_PER_GLOBAL_PAGE # force page change between categories
-
-    if items_on_page > 0:
-        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_footer_button ===Next===|_GLOBAL N={page + 1}|red\"")
-        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_show\"")
-        indent_level -= 1
+                    local_next_value = f"\\\"{local_next_value}\\\""
+                file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {this_condition.text}|SAVE_ZMOD_DATA {setting.upper}={local_next_value} I={page_number}|primary\"")
+
+        file_data.append((indent_level * STANDARD_INDENT) + "{% else %}")
+
+        if generic_option == None:
+            fallback_text = f"{setting.upper} ===custom value:=== {{z{setting.lower}}}"
+        else:
+            fallback_text = generic_option.text
+
+        file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_button {fallback_text}|_GLOBAL N={page_number}|{GLOBAL_CANNOT_CHANGE_COLOR}\"")
         file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
-        file_data.append('')
-        page += 1
 
-    file_data.append((indent_level * STANDARD_INDENT) + f"{{% if n >= {page} and start == 0 %}}")
-    file_data.append(((indent_level + 1) * STANDARD_INDENT) + "_SHOW_MSG MSG=\"===If any parameters were changed, it is recommended to reboot the printer===. Macro GLOBAL\" COMMAND='_GLOBAL_SAVE PARAM=skip_global' COMMAND_REBOOT=\"_GLOBAL_SAVE PARAM=skip_global REBOOT=1\"")
-    file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
+    if page['may_be_empty']:
+        file_data.append((indent_level * STANDARD_INDENT) + "{% set this_page_visible_items = this_page_visible_items + 1 %}")
 
+    if extra_condition != None:
+        indent_level -= 1
+        file_data.append((indent_level * STANDARD_INDENT) + f"{{% endif %}}")
 
-    file_data.append((indent_level * STANDARD_INDENT) + '# End script-generated _GLOBAL code')
     file_data.append('')
 
-def process_file(output_file, is_ad5x, is_native_screen, categories, settings):
-    file_data = []
+def add_global_pages(file_data, is_ad5x, is_native_screen, model, cache=None):
+    # One macro per GLOBAL page, called by the _GLOBAL dispatcher.
+    file_data.append('# Begin script-generated _GLOBAL page macros')
+    file_data.append('')
+
+    pages = get_global_pages(model, is_ad5x, is_native_screen)
+    for page in pages:
+        indent_level = BASE_INDENT_GLOBAL
+
+        file_data.append(f"[gcode_macro _GLOBAL_PAGE_{page['number']}]")
+        file_data.append("gcode:")
+        file_data.append((indent_level * STANDARD_INDENT) + "{% set client = printer['gcode_macro _CLIENT_VARIABLE'] | default({}) %}")
+        file_data.append((indent_level * STANDARD_INDENT) + "{% set screen = printer[\"gcode_macro _SCREEN\"].screen %}")
+        file_data.append('')
+
+        if page['may_be_empty']:
+            file_data.append((indent_level * STANDARD_INDENT) + "{% set this_page_visible_items = 0 %}")
+        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_begin {page['number']}: {page['header']}\"")
+        file_data.append('')
 
-    with open('config-template.cfg', 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.strip().startswith('# **'):
-                if line.strip() == '# ** SAVE_ZMOD_DATA ** #':
-                    add_save_zmod_data(file_data, is_ad5x, is_native_screen, categories, settings)
-                if line.strip() == '# ** GET_ZMOD_DATA ** #':
-                    add_get_zmod_data(file_data, is_ad5x, is_native_screen, categories, settings)
-                if line.strip() == '# ** _RESET_ZMOD ** #':
-                    add_reset_zmod(file_data, is_ad5x, is_native_screen, categories, settings)
-                if line.strip() == '# ** _GLOBAL ** #':
-                    add_global(file_data, is_ad5x, is_native_screen, categories, settings)
+        for setting in page['settings']:
+            add_setting_fragment(file_data, cache,
+                                 ('_GLOBAL', page['number'], page['may_be_empty'], is_ad5x, is_native_screen), setting,
+                                 lambda lines: add_global_setting(lines, indent_level, setting, page, is_ad5x,
+                                                                  is_native_screen))
+
+        file_data.append((indent_level * STANDARD_INDENT) + f"RESPOND TYPE=command MSG=\"action:prompt_footer_button ===Next===|_GLOBAL N={page['number'] + 1}|red\"")
+        file_data.append((indent_level * STANDARD_INDENT) + "RESPOND TYPE=command MSG=\"action:prompt_show\"")
+        if page['may_be_empty']:
+            file_data.append((indent_level * STANDARD_INDENT) + "{% if this_page_visible_items == 0 %}")
+            # Straight on to the next page: _GLOBAL, which called this one, is still running and cannot be called again.
+            file_data.append(((indent_level + 1) * STANDARD_INDENT) + "RESPOND TYPE=command MSG=\"action:prompt_end\"")
+            if page['number'] < len(pages):
+                file_data.append(((indent_level + 1) * STANDARD_INDENT) + f"_GLOBAL_PAGE_{page['number'] + 1}")
             else:
-                file_data += [line]
+                file_data.append(((indent_level + 1) * STANDARD_INDENT) + GLOBAL_END)
+            file_data.append((indent_level * STANDARD_INDENT) + "{% endif %}")
+        file_data.append('')
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for line in file_data:
-            f.write(line)
-            if not line.endswith('\n'):
-                f.write('\n')
+    file_data.append('# End script-generated _GLOBAL page macros')
 
+# --trace: the generated code of every macro becomes a ZMOD_TRACE_POINT span of extras/zmod_trace.py, a no-op where
+# the module is not loaded.
+TRACE_SECTION = re.compile(r'^(\s+)# (Begin|End) script-generated \S+ code$')
 
-def main():
-    with open('zmod_settings.json', 'r', encoding='utf-8') as f:
-        settings_json_data = json.load(f)
+def add_trace_point(file_data, indent, end):
+    file_data.append(indent + "{% if 'zmod_trace' in printer %}")
+    file_data.append(indent + STANDARD_INDENT + "ZMOD_TRACE_POINT NAME=generated" + (" END=1" if end else ""))
+    file_data.append(indent + "{% endif %}")
+
+def add_trace_points(file_data):
+    result = []
+    for line in file_data:
+        match = TRACE_SECTION.match(line.rstrip('\n'))
+        if match == None:
+            result.append(line)
+        elif match.group(2) == 'Begin':
+            result.append(line)
+            add_trace_point(result, match.group(1), False)
+        else:
+            add_trace_point(result, match.group(1), True)
+            result.append(line)
+    return result
 
-    categories = settings_json_data['Categories']
-    settings = settings_json_data['Settings']
+def load_template(file_name='config-template.cfg'):
+    with open(file_name, 'r', encoding='utf-8') as f:
+        return f.readlines()
 
-    process_file("../ff5m_config_native.cfg", False, True, categories, settings)
-    process_file("../ff5m_config_off.cfg", False, False, categories, settings)
-    process_file("../ad5x_config_native.cfg", True, True, categories, settings)
-    process_file("../ad5x_config_off.cfg", True, False, categories, settings)
+def render_config(is_ad5x, is_native_screen, model, optimize=True, template=None, cache=None, trace=False):
+    if template == None:
+        template = load_template()
+
+    file_data = []
+    for line in template:
+        if line.strip().startswith('# **'):
+            if line.strip() == '# ** SAVE_ZMOD_DATA ** #':
+                add_save_zmod_data(file_data, is_ad5x, is_native_screen, model, cache)
+            if line.strip() == '# ** GET_ZMOD_DATA ** #':
+                add_get_zmod_data(file_data, is_ad5x, is_native_screen, model, cache)
+            if line.strip() == '# ** _RESET_ZMOD ** #':
+                add_reset_zmod(file_data, is_ad5x, is_native_screen, model, cache)
+            if line.strip() == '# ** _GLOBAL ** #':
+                add_global(file_data, is_ad5x, is_native_screen, model)
+            if line.strip() == '# ** _GLOBAL pages ** #':
+                add_global_pages(file_data, is_ad5x, is_native_screen, model, cache)
+        else:
+            file_data += [line]
+    if trace:
+        file_data = add_trace_points(file_data)
+
+    text = ''.join([line if line.endswith('\n') else line + '\n' for line in file_data])
+    stats = None
+    if optimize:
+        text, stats = optimize_config(text, is_ad5x, is_native_screen, cache.blocks if cache != None else None)
+    return text, stats
+
+# Everything a generated file depends on, besides which variant it is.
+GENERATOR_INPUTS = ['zmod_settings.json', 'config-template.cfg', 'make_config_macros.py', 'settings_model.py',
+                    'jinja_optimizer.py', 'variants.json', 'variant_matrix.py']
+
+# Emitted fragments only depend on the code that emits and optimizes them, not on the template or the matrix.
+FRAGMENT_CODE = ['make_config_macros.py', 'settings_model.py', 'jinja_optimizer.py']
+FRAGMENT_CACHE = '.fragment_cache.bin'
+# marshal output is only stable within one Python minor version.
+FRAGMENT_CACHE_FORMAT = (1, sys.version_info[0], sys.version_info[1])
+
+WATCH_INTERVAL = 0.3
+
+class FragmentCache:
+    # The per-setting lines of every emitter, keyed by emitter, variant, page, setting name and the setting's JSON (see
+    # add_setting_fragment), and the optimized macro bodies and folded {% if %} blocks of the optimizer, keyed by their
+    # text and variant. A changed setting only emits and optimizes its own fragments again, everything else is spliced
+    # in from here. settings keeps the compiled settings of the last run in memory, for --watch.
+    __slots__ = ('version', 'fragments', 'blocks', 'settings')
+
+    def __init__(self, version, fragments=None, blocks=None):
+        self.version = version
+        self.fragments = MemoTable(fragments)
+        self.blocks = MemoTable(blocks)
+        self.settings = None
+
+    def prune(self):
+        self.fragments.prune()
+        self.blocks.prune()
+
+    def summary(self):
+        return (f"fragments: {self.fragments.hits} cached, {self.fragments.misses} emitted; "
+                f"blocks: {self.blocks.hits} cached, {self.blocks.misses} folded")
+
+def fragment_code_version():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return combine_hashes(*[hash_file(os.path.join(directory, name)) for name in FRAGMENT_CODE])
+
+def load_fragment_cache(file_name=FRAGMENT_CACHE):
+    version = fragment_code_version()
+    try:
+        with open(file_name, 'rb') as f:
+            cache_format, cached_version, fragments, blocks = marshal.loads(f.read())
+        if cache_format == FRAGMENT_CACHE_FORMAT and cached_version == version:
+            return FragmentCache(version, fragments, blocks)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    return FragmentCache(version)
+
+def save_fragment_cache(cache, file_name=FRAGMENT_CACHE):
+    entries = (FRAGMENT_CACHE_FORMAT, cache.version, cache.fragments.entries, cache.blocks.entries)
+    write_if_changed(file_name, marshal.dumps(entries))
+
+# Set in each pool worker by _init_worker, so the model is compiled once and not pickled once per task. A worker of a
+# cached build gets a FragmentCache of its own, started with everything the parent's knows.
+_worker_model = None
+_worker_template = None
+_worker_cache = None
+
+def _init_worker(model, template, fragments=None, blocks=None):
+    global _worker_model, _worker_template, _worker_cache
+    _worker_model = model
+    _worker_template = template
+    _worker_cache = FragmentCache(None, fragments, blocks) if fragments != None else None
+
+def _render_variant(is_ad5x, is_native_screen, optimize, cache=None, trace=False):
+    return render_config(is_ad5x, is_native_screen, _worker_model, optimize, _worker_template, cache, trace)
+
+def _render_cached_variant(is_ad5x, is_native_screen, optimize, trace=False):
+    # Renders with the worker's cache, returns what it used for the parent's cache to merge.
+    cache = _worker_cache
+    cache.fragments.hits = cache.fragments.misses = cache.blocks.hits = cache.blocks.misses = 0
+    text, stats = _render_variant(is_ad5x, is_native_screen, optimize, cache, trace)
+    return (text, stats, (cache.fragments.take_used(), cache.fragments.hits, cache.fragments.misses),
+            (cache.blocks.take_used(), cache.blocks.hits, cache.blocks.misses))
+
+def generate(variants, optimize=True, jobs=1, cache=None, trace=False):
+    # variants: [(is_ad5x, is_native_screen), ...]. Returns [(text, stats), ...] in the same order, nothing is written.
+    # With a FragmentCache in parallel, every worker renders with a copy of it and what they used is merged back, so
+    # the cache ends up as a serial build would leave it.
+    if not variants:
+        return []
+
+    # Only the combinations asked for are compiled, once, and shared by every worker.
+    model = load_settings('zmod_settings.json', list(dict.fromkeys(variants)), cache.settings if cache != None else None)
+    template = load_template()
+    if cache != None:
+        cache.settings = model.settings
+
+    worker_count = max(1, min(jobs, len(variants)))
+    if worker_count == 1:
+        _init_worker(model, template)
+        return [_render_variant(is_ad5x, is_native_screen, optimize, cache, trace)
+                for is_ad5x, is_native_screen in variants]
+
+    if cache == None:
+        with ProcessPoolExecutor(max_workers=worker_count, initializer=_init_worker,
+                                 initargs=(model, template)) as pool:
+            futures = [pool.submit(_render_variant, is_ad5x, is_native_screen, optimize, None, trace)
+                       for is_ad5x, is_native_screen in variants]
+            return [future.result() for future in futures]
+
+    with ProcessPoolExecutor(max_workers=worker_count, initializer=_init_worker,
+                             initargs=(model, template, cache.fragments.known(), cache.blocks.known())) as pool:
+        futures = [pool.submit(_render_cached_variant, is_ad5x, is_native_screen, optimize, trace)
+                   for is_ad5x, is_native_screen in variants]
+        results = []
+        for future in futures:
+            text, stats, fragments, blocks = future.result()
+            cache.fragments.merge(*fragments)
+            cache.blocks.merge(*blocks)
+            results.append((text, stats))
+        return results
+
+def generator_hash(manifest, optimize, matrix_file='variants.json', trace=False):
+    inputs = GENERATOR_INPUTS if matrix_file in GENERATOR_INPUTS else GENERATOR_INPUTS + [matrix_file]
+    return combine_hashes(*[manifest.hash_input(name, name) for name in inputs], optimize, trace)
+
+def build(matrix_file, optimize, jobs, cache=None, trace=False):
+    # Writes the stale outputs of the matrix, returns the names of the files that changed.
+    matrix = load_matrix(matrix_file)
+
+    manifest = BuildManifest(MANIFEST_NAME)
+    inputs_hash = generator_hash(manifest, optimize, matrix_file, trace)
+
+    pending = []
+    for output_file, (is_ad5x, is_native_screen) in matrix.outputs.items():
+        output_key = combine_hashes(inputs_hash, is_ad5x, is_native_screen)
+        if not manifest.is_current(output_file, output_key):
+            pending.append((output_file, is_ad5x, is_native_screen, output_key))
+
+    written = []
+    results = generate([(is_ad5x, is_native_screen) for _, is_ad5x, is_native_screen, _ in pending], optimize, jobs,
+                       cache, trace)
+    for (output_file, _, _, output_key), (text, stats) in zip(pending, results):
+        if write_if_changed(output_file, text):
+            written.append(os.path.basename(output_file))
+        manifest.record(output_file, output_key)
+        if stats != None:
+            print(f"{os.path.basename(output_file)}: {stats.summary()}")
+
+    manifest.save()
+    if cache != None and len(pending) == len(matrix.outputs):
+        # Everything was rendered, so whatever was not used is gone from the settings.
+        cache.prune()
+    return written
+
+def _input_times(names):
+    times = {}
+    for name in names:
+        try:
+            times[name] = os.stat(name).st_mtime_ns
+        except FileNotFoundError:
+            times[name] = None
+    return times
+
+def watch(matrix_file, optimize, cache, trace=False):
+    # Regenerates whenever an input is saved. The cache stays in memory in between; a change to the generator's own
+    # code restarts the process, since the running one would keep using the old code.
+    inputs = GENERATOR_INPUTS if matrix_file in GENERATOR_INPUTS else GENERATOR_INPUTS + [matrix_file]
+    times = _input_times(inputs)
+    print(f"Watching {', '.join(inputs)}, Ctrl+C to stop")
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        current = _input_times(inputs)
+        changed = [name for name in inputs if current[name] != times[name]]
+        if not changed:
+            continue
+        times = current
+        if any(name in FRAGMENT_CODE for name in changed):
+            print(f"{', '.join(changed)} changed, restarting")
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+        start = time.perf_counter()
+        cache.fragments.hits = cache.fragments.misses = cache.blocks.hits = cache.blocks.misses = 0
+        try:
+            written = build(matrix_file, optimize, 1, cache, trace)
+        except (ValueError, KeyError, TypeError) as e:
+            # Most likely a half saved or broken JSON file, wait for the next save.
+            print(f"{', '.join(changed)}: {e!r}")
+            continue
+        print(f"{', '.join(changed)} changed: {len(written)} files rewritten in "
+              f"{(time.perf_counter() - start) * 1000.0:.0f} ms ({cache.summary()})", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the *_config_*.cfg variant files from zmod_settings.json.")
+    parser.add_argument('--no-optimize', action='store_true',
+                        help="write the macros exactly as emitted, without the jinja_optimizer pass")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help="number of variant files generated in parallel (default: number of CPUs)")
+    parser.add_argument('--matrix', default='variants.json', help="variant matrix to generate (default: variants.json)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f"render everything from scratch, without {FRAGMENT_CACHE}")
+    parser.add_argument('--watch', action='store_true', help="regenerate whenever an input is saved")
+    parser.add_argument('--trace', action='store_true',
+                        help="wrap the generated code in ZMOD_TRACE_POINT spans for extras/zmod_trace.py")
+    args = parser.parse_args()
+    optimize = not args.no_optimize
+
+    cache = None
+    if not args.no_cache or args.watch:
+        cache = load_fragment_cache()
+    build(args.matrix, optimize, args.jobs, cache, args.trace)
+    if cache != None:
+        save_fragment_cache(cache)
+
+    if args.watch:
+        try:
+            watch(args.matrix, optimize, cache, args.trace)
+        except KeyboardInterrupt:
+            pass
+        save_fragment_cache(cache)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,82 @@
+import glob
+import json
+import os
+
+from build_manifest import hash_bytes, write_if_changed
+
+# Content-addressed language packs.
+#
+# Most configs have no ===...=== markers at all, and most of the rest only differ between languages in a few lines of
+# some files, so the per-language trees translate.py writes are largely identical. A pack directory holds every distinct
+# file once, named by its hash:
+#
+#   <pack_dir>/objects/<first two hex digits>/<sha256>
+#   <pack_dir>/<lang>.pack.json   {"version": 1, "language": lang, "files": {name: {"hash": .., "size": ..}}}
+#
+# A printer switching language or updating the mod only has to fetch the objects its current files don't already have,
+# see tools/apply_pack.py. Objects are never rewritten once they exist, and objects no pack references any more are
+# removed after a build.
+
+PACK_VERSION = 1
+PACK_SUFFIX = '.pack.json'
+OBJECTS_DIR = 'objects'
+
+def object_path(pack_dir, file_hash):
+    return os.path.join(pack_dir, OBJECTS_DIR, file_hash[:2], file_hash)
+
+def pack_path(pack_dir, language):
+    return os.path.join(pack_dir, f"{language}{PACK_SUFFIX}")
+
+def load_pack(pack_dir, language):
+    with open(pack_path(pack_dir, language), 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version', None) != PACK_VERSION:
+        raise ValueError(f"{pack_path(pack_dir, language)}: unsupported pack version {data.get('version', None)}")
+    return data
+
+class PackWriter:
+    __slots__ = ('pack_dir', 'objects_written', 'bytes_written', 'known')
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self.objects_written = 0
+        self.bytes_written = 0
+        # hashes known to be in the store
+        self.known = set()
+
+    def add(self, data):
+        # Stores data unless it is already there, returns (hash, size).
+        encoded = data.encode('utf-8')
+        file_hash = hash_bytes(encoded)
+        if file_hash not in self.known:
+            path = object_path(self.pack_dir, file_hash)
+            if not os.path.isfile(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_if_changed(path, encoded)
+                self.objects_written += 1
+                self.bytes_written += len(encoded)
+            self.known.add(file_hash)
+        return file_hash, len(encoded)
+
+    def write_pack(self, language, files):
+        # files: {name: (hash, size)}. Returns True if the pack changed.
+        data = {
+            'version': PACK_VERSION,
+            'language': language,
+            'files': dict((name, {'hash': file_hash, 'size': size}) for name, (file_hash, size) in sorted(files.items()))
+        }
+        return write_if_changed(pack_path(self.pack_dir, language), json.dumps(data, indent=1, ensure_ascii=False) + '\n')
+
+    def prune(self):
+        # Removes the objects no pack in pack_dir references, returns how many.
+        referenced = set()
+        for path in glob.glob(os.path.join(self.pack_dir, f"*{PACK_SUFFIX}")):
+            with open(path, 'r', encoding='utf-8') as f:
+                referenced.update(entry['hash'] for entry in json.load(f).get('files', {}).values())
+
+        removed = 0
+        for path in glob.glob(os.path.join(self.pack_dir, OBJECTS_DIR, '*', '*')):
+            if os.path.basename(path) not in referenced:
+                os.remove(path)
+                removed += 1
+        return removed
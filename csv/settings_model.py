@@ -0,0 +1,238 @@
+import json
+
+# Compiled form of zmod_settings.json.
+#
+# The emitters in make_config_macros.py used to re-derive every setting's options for every variant, re-parsing the
+# n/g/x/m condition suffixes each time. compile_settings() does all of that work once: condition suffixes are parsed
+# into (ad5x, native_screen) requirements when the JSON is loaded, and for each (is_ad5x, is_native_screen) combination
+# the variant matrix needs, the settable values, the next-value ring, the GLOBAL options and the GET_ZMOD_DATA texts are
+# resolved up front. The emitters then only walk the compiled lists.
+#
+# See the comment at the top of make_config_macros.py for the zmod_settings.json structure.
+
+DEFAULT_VALUE_ASSUMPTION = 0
+DEFAULT_STRING_ASSUMPTION = ""
+TYPE_ASSUMPTION = 'int'
+
+# (is_ad5x, is_native_screen) combinations compiled when no others are asked for, see variant_matrix.py.
+VARIANTS = ((False, True), (False, False), (True, True), (True, False))
+
+def validate_setup(ad5x_requirement, native_screen_requirement, is_ad5x, is_native_screen):
+    if ad5x_requirement < 0 and is_ad5x:
+        return False
+    if ad5x_requirement > 0 and not is_ad5x:
+        return False
+    if native_screen_requirement < 0 and is_native_screen:
+        return False
+    if native_screen_requirement > 0 and not is_native_screen:
+        return False
+    return True
+
+_STRIP_CONDITION_SUFFIXES = str.maketrans('', '', 'nxmg')
+
+class Condition:
+    # A single key of a get_zmod_data_text / global_text block, with its n/g/x/m suffixes already parsed.
+    __slots__ = ('value', 'require_ad5x', 'require_native_screen', 'text')
+
+    def __init__(self, raw_condition, text, is_string):
+        self.text = text
+        if is_string or raw_condition == '*':
+            self.value = raw_condition
+            self.require_ad5x = 0
+            self.require_native_screen = 0
+            return
+
+        self.require_ad5x = 1 if 'x' in raw_condition else -1 if 'm' in raw_condition else 0
+        self.require_native_screen = 1 if 'n' in raw_condition else -1 if 'g' in raw_condition else 0
+        self.value = raw_condition.translate(_STRIP_CONDITION_SUFFIXES)
+
+    def applies(self, is_ad5x, is_native_screen):
+        return validate_setup(self.require_ad5x, self.require_native_screen, is_ad5x, is_native_screen)
+
+class GlobalOption:
+    # One button state in GLOBAL. next_value is None when the value cannot be reached by cycling.
+    __slots__ = ('condition', 'text', 'next_value')
+
+    def __init__(self, condition, text, next_value):
+        self.condition = condition
+        self.text = text
+        self.next_value = next_value
+
+class SettingVariant:
+    # Everything about a setting that depends on (is_ad5x, is_native_screen).
+    __slots__ = ('visible', 'settable_values', 'next_values', 'global_options', 'valid_values', 'allow_generic',
+                 'zmod_data_texts')
+
+    def __init__(self, setting, is_ad5x, is_native_screen):
+        self.visible = validate_setup(setting.require_ad5x, setting.require_native_screen, is_ad5x, is_native_screen)
+
+        self.settable_values = self._settable_values(setting, is_ad5x, is_native_screen)
+        self.next_values = {}
+        for index, value in enumerate(self.settable_values):
+            self.next_values[value] = self.settable_values[(index + 1) % len(self.settable_values)]
+
+        self.global_options = self._global_options(setting, is_ad5x, is_native_screen)
+        self.valid_values = [option.condition for option in self.global_options if option.condition != '*']
+        self.allow_generic = len(self.valid_values) != len(self.global_options)
+
+        # GET_ZMOD_DATA texts that apply to this variant, in order, up to and including the "*" entry.
+        self.zmod_data_texts = []
+        for condition in setting.zmod_data_conditions:
+            if condition.value != '*' and not condition.applies(is_ad5x, is_native_screen):
+                continue
+            self.zmod_data_texts.append(condition)
+            if condition.value == '*':
+                break
+
+    @staticmethod
+    def _settable_values(setting, is_ad5x, is_native_screen):
+        can_set_values = setting.global_set_values
+        if is_ad5x and setting.global_set_values_ad5x is not None:
+            can_set_values = setting.global_set_values_ad5x
+        if is_native_screen and setting.global_set_values_native_screen is not None:
+            can_set_values = setting.global_set_values_native_screen
+        if is_ad5x and is_native_screen and setting.global_set_values_native_screen_ad5x is not None:
+            can_set_values = setting.global_set_values_native_screen_ad5x
+
+        if can_set_values is None:
+            can_set_values = []
+            for condition in setting.global_conditions:
+                if condition.value == '*':
+                    break
+                if not condition.applies(is_ad5x, is_native_screen):
+                    continue
+                can_set_values.append(condition.value)
+
+        return list(dict.fromkeys(str(value) for value in can_set_values))
+
+    def _global_options(self, setting, is_ad5x, is_native_screen):
+        result = []
+        done_conditions = set()
+
+        applicable = {}
+        for condition in setting.global_conditions:
+            if condition.applies(is_ad5x, is_native_screen):
+                applicable.setdefault(condition.value, condition)
+
+        for value in self.settable_values:
+            condition = applicable.get(value, None)
+            if condition is not None:
+                result.append(GlobalOption(value, condition.text, self.next_values[value]))
+                done_conditions.add(value)
+            else:
+                result.append(GlobalOption(value, setting.generic_global_text, self.next_values[value]))
+
+        for condition in setting.global_conditions:
+            if condition.value in done_conditions:
+                continue
+            if not condition.applies(is_ad5x, is_native_screen):
+                continue
+
+            result.append(GlobalOption(condition.value, condition.text, None))
+
+            if condition.value == '*':
+                break
+            done_conditions.add(condition.value)
+
+        return result
+
+def setting_source(set_data):
+    return json.dumps(set_data, sort_keys=True, ensure_ascii=False)
+
+class Setting:
+    __slots__ = ('name', 'lower', 'upper', 'type', 'default', 'category', 'show_condition', 'show_in_global',
+                 'exclude_from_reset', 'require_ad5x', 'require_native_screen', 'code', 'min_value', 'max_value',
+                 'global_set_values', 'global_set_values_ad5x', 'global_set_values_native_screen',
+                 'global_set_values_native_screen_ad5x', 'zmod_data_conditions', 'global_conditions',
+                 'generic_global_text', 'variants', 'source')
+
+    def __init__(self, name, set_data, variants=VARIANTS, source=None):
+        self.name = name
+        # The setting's JSON, what generated fragments of it are cached by.
+        self.source = source if source != None else setting_source(set_data)
+        self.lower = name.lower()
+        self.upper = name.upper()
+        self.type = set_data.get('type', TYPE_ASSUMPTION)
+        is_string = self.type == 'string'
+        self.default = set_data.get('default', DEFAULT_STRING_ASSUMPTION if is_string else DEFAULT_VALUE_ASSUMPTION)
+        self.category = set_data.get('category', '')
+        self.show_condition = set_data.get('show_condition', None)
+        self.show_in_global = set_data.get('show_in_global', True)
+        self.exclude_from_reset = set_data.get('exclude_from_reset', False)
+        self.require_ad5x = set_data.get('require_ad5x', 0)
+        self.require_native_screen = set_data.get('require_native_screen', 0)
+        self.code = set_data.get('code', '')
+        self.min_value = set_data.get('min_valid_value', None)
+        self.max_value = set_data.get('max_valid_value', None)
+        self.global_set_values = set_data.get('global_set_values', None)
+        self.global_set_values_ad5x = set_data.get('global_set_values_ad5x', None)
+        self.global_set_values_native_screen = set_data.get('global_set_values_native_screen', None)
+        self.global_set_values_native_screen_ad5x = set_data.get('global_set_values_native_screen_ad5x', None)
+
+        zmod_data_texts = set_data.get('get_zmod_data_text', {})
+        global_texts = set_data.get('global_text', None)
+        if global_texts is None:
+            global_texts = zmod_data_texts
+
+        self.zmod_data_conditions = [Condition(key, text, is_string) for key, text in zmod_data_texts.items()]
+        self.global_conditions = [Condition(key, text, is_string) for key, text in global_texts.items()]
+
+        self.generic_global_text = global_texts.get('*', None)
+        if self.generic_global_text is None:
+            self.generic_global_text = f"{self.upper} ===custom value:=== {{z{self.lower}}}"
+
+        self.variants = {}
+        if self.type != 'special':
+            for is_ad5x, is_native_screen in variants:
+                self.variants[(is_ad5x, is_native_screen)] = SettingVariant(self, is_ad5x, is_native_screen)
+
+    def visible(self, is_ad5x, is_native_screen):
+        return validate_setup(self.require_ad5x, self.require_native_screen, is_ad5x, is_native_screen)
+
+    def variant(self, is_ad5x, is_native_screen):
+        return self.variants[(is_ad5x, is_native_screen)]
+
+class Category:
+    __slots__ = ('name', 'get_zmod_data_text', 'global_text', 'settings')
+
+    def __init__(self, name, cat_data):
+        self.name = name
+        self.get_zmod_data_text = cat_data.get('get_zmod_data_text', '')
+        self.global_text = cat_data.get('global_text', None)
+        if self.global_text is None:
+            self.global_text = self.get_zmod_data_text
+        self.settings = []
+
+class SettingsModel:
+    __slots__ = ('categories', 'settings')
+
+    def __init__(self, categories, settings):
+        self.categories = categories
+        self.settings = settings
+
+def compile_settings(settings_json_data, variants=VARIANTS, known=None):
+    # known: the settings of an earlier compile_settings(), {name: Setting}. Those whose JSON did not change are reused
+    # as they are.
+    categories = {}
+    for name, cat_data in settings_json_data['Categories'].items():
+        categories[name] = Category(name, cat_data)
+
+    variants = list(variants)
+    settings = {}
+    for name, set_data in settings_json_data['Settings'].items():
+        source = setting_source(set_data)
+        setting = known.get(name, None) if known != None else None
+        if setting != None and setting.type != 'special' and list(setting.variants) != variants:
+            setting = None
+        if setting == None or setting.source != source:
+            setting = Setting(name, set_data, variants, source)
+        settings[name] = setting
+        category = categories.get(setting.category, None)
+        if category is not None:
+            category.settings.append(setting)
+
+    return SettingsModel(list(categories.values()), settings)
+
+def load_settings(file_name='zmod_settings.json', variants=VARIANTS, known=None):
+    with open(file_name, 'r', encoding='utf-8') as f:
+        return compile_settings(json.load(f), variants, known)
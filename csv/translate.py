@@ -1,62 +1,214 @@
-import csv
+import argparse
 import os
 import re
-import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-def main():
-    if len(sys.argv) < 2:
-        print("Использование: python script.py <файл_перевода.csv>")
-        return
+from build_manifest import BuildManifest, MANIFEST_NAME, combine_hashes, hash_bytes, hash_file, write_if_changed
+from catalogs import CoverageIndex, load_catalog
+from packs import PackWriter
 
-    translate_file = sys.argv[1]
-    translate_dir = sys.argv[2]
-    lang_dir = os.path.splitext(translate_file)[0]
+# Usage: python3 translate.py [--jobs N] [--pack] <lang.csv> [<lang.csv> ...] <translate_dir>
+#
+# All source configs and all language catalogs are read once up front. Rendering is then fanned out over a process
+# pool, one language per task, and the results are reported in the order the catalogs were given.
+#
+# Sources are tokenized once into templates: marker_pattern.split() yields literal text at even positions and
+# ===key=== contents at odd positions. Marker keys are interned into a MarkerTable shared by all files, so each
+# language only has to resolve every distinct key once and each file is rendered with a plain join.
+#
+# With --pack, translate_dir gets content-addressed language packs (see packs.py) instead of one tree per language:
+# every distinct file is stored once and each language is a manifest of file hashes.
 
-    if not translate_dir.strip():
-        translate_dir = "../../"
+marker_pattern = re.compile(r'===(.*?)===')
 
-    translate_dir = os.path.join(translate_dir) # enforce trailing slash
+def load_sources(source_dir, generated=None, tmp_overlays=False):
+    # generated maps file names to in-memory texts, which override the configs on disk and don't have to exist there.
+    # With tmp_overlays a *.cfg.tmp next to a config overrides it, generated texts still win. Only translate.py
+    # --tmp-overlays asks for that: a leftover .tmp must not slip into a build.
+    texts = dict(generated or {})
+    for cfg_file in Path(source_dir).glob('*.cfg'):
+        if cfg_file.name in texts:
+            continue
+        if tmp_overlays and Path(str(cfg_file) + ".tmp").is_file():
+            with open(str(cfg_file) + ".tmp", 'r', encoding='utf-8') as f_in:
+                texts[cfg_file.name] = f_in.read()
+        else:
+            with open(cfg_file, 'r', encoding='utf-8') as f_in:
+                texts[cfg_file.name] = f_in.read()
+    return sorted(texts.items())
 
-    os.makedirs(f"{translate_dir}%s" % (lang_dir), exist_ok=True)
+class MarkerTable:
+    __slots__ = ('ids', 'keys')
 
-    translations = {}
-    with open(translate_file, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f, delimiter=';')
-        for row in reader:
-            if len(row) >= 2:
-                original = row[0].strip()
-                translated = row[1].strip()
-                translations[original] = translated
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
 
-    pattern = re.compile(r'(===)(.*?)(===)')
+    def intern(self, key):
+        marker_id = self.ids.get(key, None)
+        if marker_id is None:
+            marker_id = len(self.keys)
+            self.ids[key] = marker_id
+            self.keys.append(key)
+        return marker_id
 
-    def translate_line(line):
-        def replace_match(match):
-            original_text = match.group(2).strip()
-            translated_text = translations.get(original_text, original_text)
-            return f"{translated_text}"
+    def resolve(self, translations):
+        # Untranslated markers fall back to their English text.
+        return [translations.get(key, key) for key in self.keys]
 
-        return pattern.sub(replace_match, line)
+class Template:
+    __slots__ = ('parts', 'marker_ids')
 
-    for cfg_file in Path('../').glob('*.cfg'):
-        if Path(str(cfg_file) + ".tmp").is_file():
-            with open(str(cfg_file) + ".tmp", 'r', encoding='utf-8') as f_in:
-                lines = f_in.readlines()
-        else:
-            with open(cfg_file, 'r', encoding='utf-8') as f_in:
-                lines = f_in.readlines()
+    def __init__(self, text, markers):
+        self.parts = marker_pattern.split(text)
+        self.marker_ids = [markers.intern(key.strip()) for key in self.parts[1::2]]
+
+    def render(self, resolved):
+        parts = self.parts[:]
+        parts[1::2] = [resolved[marker_id] for marker_id in self.marker_ids]
+        return ''.join(parts)
+
+# Set in each pool worker by _init_worker, so the templates are not pickled once per task.
+_worker_templates = None
+_worker_markers = None
+
+def _init_worker(templates, markers):
+    global _worker_templates, _worker_markers
+    _worker_templates = templates
+    _worker_markers = markers
+
+def render_language(output_dir, translations, file_names):
+    # Returns the names of the files that actually changed on disk.
+    resolved = _worker_markers.resolve(translations)
+    written = []
+    for name, template in _worker_templates:
+        if name not in file_names:
+            continue
+        if write_if_changed(os.path.join(output_dir, name), template.render(resolved)):
+            written.append(name)
+    return written
+
+def report(sources, catalog_files):
+    markers = MarkerTable()
+    templates = [(name, Template(text, markers)) for name, text in sources]
+    coverage = CoverageIndex(markers, templates)
+    for translate_file in catalog_files:
+        coverage.print_report(load_catalog(translate_file))
+
+def translate(sources, catalog_files, translate_dir, jobs=1):
+    source_hashes = {}
+    for name, text in sources:
+        source_hashes[name] = hash_bytes(text)
+
+    markers = MarkerTable()
+    templates = [(name, Template(text, markers)) for name, text in sources]
 
-        translated_lines = []
-        for line in lines:
-            translated_line = translate_line(line)
-            translated_lines.append(translated_line)
+    # Each output only depends on its source file, its language's CSV and the translator scripts.
+    manifest = BuildManifest(os.path.join(translate_dir, MANIFEST_NAME))
+    translator_hash = combine_hashes(hash_file(__file__),
+                                     hash_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalogs.py')))
+    for name, source_hash in source_hashes.items():
+        manifest.record_input(name, source_hash)
 
-        output_path = f"{translate_dir}%s/%s" % (Path(lang_dir), cfg_file.name)
-        with open(output_path, 'w', encoding='utf-8') as f_out:
-            f_out.writelines(translated_lines)
+    pending_jobs = []
+    for translate_file in catalog_files:
+        lang_dir = os.path.splitext(os.path.basename(translate_file))[0]
+        output_dir = os.path.join(translate_dir, lang_dir)
+        os.makedirs(output_dir, exist_ok=True)
+
+        catalog_hash = manifest.hash_input(os.path.basename(translate_file), translate_file)
+
+        stale = {}
+        for name, source_hash in source_hashes.items():
+            output_key = combine_hashes(translator_hash, catalog_hash, source_hash)
+            if not manifest.is_current(os.path.join(output_dir, name), output_key):
+                stale[name] = output_key
+
+        translations = load_catalog(translate_file).translations if stale else None
+        pending_jobs.append((lang_dir, output_dir, translations, stale))
+
+    pending = [job for job in pending_jobs if job[3]]
+    worker_count = max(1, min(jobs, len(pending)))
+    if worker_count == 1:
+        _init_worker(templates, markers)
+        results = [render_language(output_dir, translations, stale) for _, output_dir, translations, stale in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=worker_count, initializer=_init_worker,
+                                 initargs=(templates, markers)) as pool:
+            futures = [pool.submit(render_language, output_dir, translations, stale)
+                       for _, output_dir, translations, stale in pending]
+            results = [future.result() for future in futures]
+
+    written = {}
+    for job, result in zip(pending, results):
+        written[job[0]] = result
+
+    for lang_dir, output_dir, _, stale in pending_jobs:
+        for name, output_key in stale.items():
+            manifest.record(os.path.join(output_dir, name), output_key)
+        print(f"Переведено файлов: {len(stale)} (без изменений: {len(sources) - len(stale)}, "
+              f"перезаписано: {len(written.get(lang_dir, []))}) в каталог '{lang_dir}'")
+
+    manifest.save()
+
+def pack(sources, catalog_files, pack_dir):
+    # Rendering is cheap next to the per-language trees' file writes, so this runs in one process. Files without
+    # markers are the same in every language and are only rendered and hashed once.
+    markers = MarkerTable()
+    templates = [(name, Template(text, markers)) for name, text in sources]
+    os.makedirs(pack_dir, exist_ok=True)
+    writer = PackWriter(pack_dir)
+
+    shared = {}
+    for name, template in templates:
+        if not template.marker_ids:
+            shared[name] = writer.add(template.render([]))
+
+    total_bytes = 0
+    for translate_file in catalog_files:
+        language = os.path.splitext(os.path.basename(translate_file))[0]
+        objects_before = writer.objects_written
+        resolved = markers.resolve(load_catalog(translate_file).translations)
+        files = dict(shared)
+        for name, template in templates:
+            if name not in files:
+                files[name] = writer.add(template.render(resolved))
+        total_bytes += sum(size for _, size in files.values())
+        changed = writer.write_pack(language, files)
+        print(f"Язык '{language}': файлов: {len(files)}, новых объектов: {writer.objects_written - objects_before}"
+              f"{'' if changed else ' (без изменений)'}")
+
+    removed = writer.prune()
+    print(f"Записано объектов: {writer.objects_written} ({writer.bytes_written} байт), удалено неиспользуемых: "
+          f"{removed}, всего файлов во всех языках: {total_bytes} байт")
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate the ===...=== markers in ../*.cfg into the given languages.")
+    parser.add_argument('catalogs', nargs='+', metavar='lang.csv')
+    parser.add_argument('translate_dir')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help="number of languages rendered in parallel (default: number of CPUs)")
+    parser.add_argument('--source-dir', default='../')
+    parser.add_argument('--report', action='store_true',
+                        help="only report missing, unused and duplicate keys for each language, do not translate")
+    parser.add_argument('--pack', action='store_true',
+                        help="write content-addressed language packs to translate_dir instead of one tree per language")
+    parser.add_argument('--tmp-overlays', action='store_true',
+                        help="read <name>.cfg.tmp instead of <name>.cfg where one exists")
+    args = parser.parse_args()
+
+    translate_dir = args.translate_dir
+    if not translate_dir.strip():
+        translate_dir = "../../"
 
-    print(f"Переведено файлов: {len(list(Path('..').glob('*.cfg')))} в каталог '{lang_dir}'")
+    sources = load_sources(args.source_dir, tmp_overlays=args.tmp_overlays)
+    if args.report:
+        report(sources, args.catalogs)
+    elif args.pack:
+        pack(sources, args.catalogs, translate_dir)
+    else:
+        translate(sources, args.catalogs, translate_dir, args.jobs)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,102 @@
+import itertools
+import json
+
+# The declarative variant matrix read by make_config_macros.py and macro_bench.py.
+#
+# variants.json structure:
+# "Axes": Key-value pairs, one per axis of the matrix (printer, screen, Klipper version, ...). Every axis is a set of
+#         key-value pairs of its possible values, and every variant is one value of every axis. A value may set:
+#       "ad5x": Boolean, the generator's is_ad5x for variants with this value.
+#       "native_screen": Boolean, the generator's is_native_screen for variants with this value.
+#       "configs": List of the .cfg files, relative to the repository root, a printer with this value runs with on top
+#                  of base.cfg. Used to load a variant the way Klipper sees it. {axis} is replaced by the variant's value
+#                  of that axis, eg. "{printer}_klipper13.cfg".
+#       Every variant must end up with both ad5x and native_screen set by exactly one of its values.
+# "Exclude": List of partial variants that do not exist, eg. {"printer": "ad5x", "klipper": "11"}.
+# "Name": Name of a variant, formatted from its axis values.
+# "Output": Generated file of a variant, relative to the csv directory, formatted from its axis values.
+#
+# The generator only depends on (is_ad5x, is_native_screen). Variants that share those and their output file (eg. the
+# same printer and screen on different Klipper versions) share the generated file, so adding a Klipper version or a
+# printer that behaves like an existing one does not add generator work.
+
+GENERATOR_FLAGS = ('ad5x', 'native_screen')
+
+class Variant:
+    __slots__ = ('name', 'values', 'is_ad5x', 'is_native_screen', 'configs', 'output_file')
+
+    def __init__(self, name, values, is_ad5x, is_native_screen, configs, output_file):
+        self.name = name
+        self.values = values
+        self.is_ad5x = is_ad5x
+        self.is_native_screen = is_native_screen
+        self.configs = configs
+        self.output_file = output_file
+
+    @property
+    def key(self):
+        return (self.is_ad5x, self.is_native_screen)
+
+class VariantMatrix:
+    __slots__ = ('variants', 'outputs')
+
+    def __init__(self, variants):
+        self.variants = variants
+        # output file -> (is_ad5x, is_native_screen), in matrix order
+        self.outputs = {}
+        for variant in variants:
+            key = self.outputs.setdefault(variant.output_file, variant.key)
+            if key != variant.key:
+                raise ValueError(f"{variant.name}: {variant.output_file} is also generated for a different "
+                                 f"ad5x / native_screen combination")
+
+    def keys(self):
+        # The distinct (is_ad5x, is_native_screen) combinations, what the generator has to precompute.
+        return list(dict.fromkeys(self.outputs.values()))
+
+    def find(self, name):
+        for variant in self.variants:
+            if variant.name == name:
+                return variant
+        return None
+
+def _excluded(values, excludes):
+    for exclude in excludes:
+        if all(values.get(axis, None) == value for axis, value in exclude.items()):
+            return True
+    return False
+
+def compile_matrix(matrix_json_data):
+    axes = matrix_json_data['Axes']
+    excludes = matrix_json_data.get('Exclude', [])
+    name_format = matrix_json_data.get('Name', '_'.join(f"{{{axis}}}" for axis in axes))
+    output_format = matrix_json_data['Output']
+
+    variants = []
+    for combination in itertools.product(*[axis_values.items() for axis_values in axes.values()]):
+        values = dict(zip(axes.keys(), [value for value, _ in combination]))
+        if _excluded(values, excludes):
+            continue
+
+        name = name_format.format(**values)
+        flags = {}
+        configs = []
+        for value, value_data in combination:
+            for flag in GENERATOR_FLAGS:
+                if flag in value_data:
+                    if flag in flags:
+                        raise ValueError(f"{name}: {flag} is set by more than one axis")
+                    flags[flag] = bool(value_data[flag])
+            configs += [config.format(**values) for config in value_data.get('configs', [])]
+        for flag in GENERATOR_FLAGS:
+            if flag not in flags:
+                raise ValueError(f"{name}: none of the axes sets {flag}")
+
+        variants.append(Variant(name, values, flags['ad5x'], flags['native_screen'], configs,
+                                output_format.format(**values)))
+
+    return VariantMatrix(variants)
+
+def load_matrix(file_name='variants.json'):
+    with open(file_name, 'r', encoding='utf-8') as f:
+        return compile_matrix(json.load(f))
@@ -0,0 +1,245 @@
+# Background jobs that report back into the macro flow.
+#
+# (C) 2024-2026 ghzserg https://zmod.link/
+#
+# [zmod_jobs]
+# command_check_md5: python3 /opt/config/mod/tools/check_md5.py --progress
+#   command_<name> defines the job <name>: a command line, PARAMS of ZMOD_JOB are appended to it.
+# command_linearize_arcs: python3 /opt/config/mod/tools/linearize_arcs.py --progress
+#   With this job defined, CHECK_MD5 rewrites the arcs of a file it reports as 4 or 8 into G1 moves before the print
+#   instead of only warning about them (see tools/linearize_arcs.py).
+# timeout: 30
+#   Seconds a job may run, plus timeout_per_mb for every MB of the FILE it works on.
+# timeout_per_mb: 0.5
+# progress_interval: 5
+#   Seconds between progress reports.
+#
+# ZMOD_JOB NAME=<name> [PARAMS="<arguments>"] [FILE=<path>] [TIMEOUT=<seconds>]
+#   Starts the job and returns the moment it exits, so the next line of the calling macro runs right after it. While
+#   it runs, its progress is reported every progress_interval seconds. A job that runs longer than its timeout is
+#   killed. The result is in printer.zmod_jobs: name, state (done, failed, timeout), returncode, elapsed, progress and
+#   the key=value pairs of its last output line in result. jobs lists the names of the configured jobs.
+#
+# CHECK_MD5 used to start check_md5 with RUN_SHELL_COMMAND and poll the variables file 30 times a second apart: up
+# to a second lost after the check finished, and a fixed 30 s budget however large the file. With this module loaded
+# it runs the check as a job instead.
+#
+# The job itself runs in a subprocess watched by a thread, which hands the result to the reactor with
+# register_async_callback. JobRunner does not depend on Klipper, so the same code can be run from a shell:
+#   python3 zmod_jobs.py [--timeout S] [--file F] -- <command> [args]
+#   python3 zmod_jobs.py --stand-in 3        (a stand-in job that takes 3 s and reports progress)
+
+import argparse
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+DEFAULT_TIMEOUT = 30.
+DEFAULT_TIMEOUT_PER_MB = 0.5
+DEFAULT_PROGRESS_INTERVAL = 5.
+
+PROGRESS_LINE = re.compile(r'^progress=([0-9.]+)\s*$')
+RESULT_PAIR = re.compile(r'(\w+)=(\S*)')
+
+# Prints progress for argv[1] seconds, then a result line like check_md5.py does.
+STAND_IN_SCRIPT = """
+import sys, time
+duration = float(sys.argv[1])
+steps = 20
+for step in range(1, steps + 1):
+    time.sleep(duration / steps)
+    print(f"progress={step / steps:.3f}", flush=True)
+print("check_md5=5 stand_in=True", flush=True)
+"""
+
+def job_timeout(base, per_mb, filename=None):
+    # Seconds a job on filename may take.
+    size = 0
+    if filename:
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            pass
+    return base + per_mb * size / (1024. * 1024.)
+
+class Job:
+    def __init__(self, name, argv, timeout):
+        self.name = name
+        self.argv = argv
+        self.timeout = timeout
+        self.state = 'running'
+        self.returncode = None
+        self.progress = 0.
+        self.result = {}
+        self.output = []
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.process = None
+
+    def elapsed(self):
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    def get_status(self):
+        return {'name': self.name, 'state': self.state, 'returncode': self.returncode, 'progress': self.progress,
+                'elapsed': round(self.elapsed(), 3), 'timeout': self.timeout, 'result': dict(self.result)}
+
+class JobRunner:
+    # Runs one job at a time in a subprocess. on_done(job) is called from the watcher thread.
+    def __init__(self):
+        self.job = None
+
+    def busy(self):
+        return self.job is not None and self.job.state == 'running'
+
+    def start(self, job, on_done):
+        self.job = job
+        try:
+            job.process = subprocess.Popen(job.argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           stdin=subprocess.DEVNULL, text=True, bufsize=1)
+        except OSError as e:
+            job.output.append(str(e))
+            self._finish(job, 'failed', None)
+            on_done(job)
+            return
+        thread = threading.Thread(target=self._watch, args=(job, on_done), daemon=True)
+        thread.start()
+
+    def _watch(self, job, on_done):
+        for line in job.process.stdout:
+            line = line.rstrip('\n')
+            match = PROGRESS_LINE.match(line)
+            if match is not None:
+                job.progress = min(float(match.group(1)), 1.)
+                continue
+            job.output.append(line)
+            pairs = RESULT_PAIR.findall(line)
+            if pairs:
+                job.result = dict(pairs)
+        returncode = job.process.wait()
+        if job.state == 'running':
+            self._finish(job, 'done' if returncode == 0 else 'failed', returncode)
+        on_done(job)
+
+    def _finish(self, job, state, returncode):
+        job.state = state
+        job.returncode = returncode
+        job.end_time = time.monotonic()
+
+    def cancel(self, state='timeout'):
+        # Kills the running job. Its watcher thread still calls on_done.
+        job = self.job
+        if job is None or job.state != 'running':
+            return
+        self._finish(job, state, None)
+        if job.process is not None:
+            job.process.kill()
+
+class ZmodJobs:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.timeout = config.getfloat('timeout', DEFAULT_TIMEOUT, above=0.)
+        self.timeout_per_mb = config.getfloat('timeout_per_mb', DEFAULT_TIMEOUT_PER_MB, minval=0.)
+        self.progress_interval = config.getfloat('progress_interval', DEFAULT_PROGRESS_INTERVAL, above=0.)
+        self.commands = {}
+        for option in config.get_prefix_options('command_'):
+            self.commands[option[len('command_'):]] = shlex.split(config.get(option))
+        self.runner = JobRunner()
+        self.status = {'name': '', 'state': 'idle', 'returncode': None, 'progress': 0., 'elapsed': 0.,
+                       'timeout': 0., 'result': {}}
+        self.printer.register_event_handler('klippy:shutdown', self._handle_shutdown)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('ZMOD_JOB', self.cmd_ZMOD_JOB, desc="Run a background job and wait for it")
+
+    def _handle_shutdown(self):
+        self.runner.cancel('failed')
+
+    def cmd_ZMOD_JOB(self, gcmd):
+        name = gcmd.get('NAME')
+        if name not in self.commands:
+            raise gcmd.error("Unknown job '%s', known: %s" % (name, ', '.join(sorted(self.commands)) or '-'))
+        if self.runner.busy():
+            raise gcmd.error("Job '%s' is still running" % (self.runner.job.name,))
+        filename = gcmd.get('FILE', None)
+        timeout = gcmd.get_float('TIMEOUT', job_timeout(self.timeout, self.timeout_per_mb, filename), above=0.)
+        try:
+            params = shlex.split(gcmd.get('PARAMS', ''))
+        except ValueError as e:
+            raise gcmd.error("Job '%s': bad PARAMS: %s" % (name, e))
+        argv = self.commands[name] + params
+
+        completion = self.reactor.completion()
+
+        def on_done(job):
+            self.reactor.register_async_callback(lambda eventtime: completion.complete(job))
+
+        job = Job(name, argv, timeout)
+        self.runner.start(job, on_done)
+        deadline = self.reactor.monotonic() + timeout
+        while not completion.test():
+            eventtime = self.reactor.monotonic()
+            if eventtime >= deadline:
+                self.runner.cancel('timeout')
+                completion.wait()
+                break
+            completion.wait(min(deadline, eventtime + self.progress_interval))
+            if not completion.test():
+                gcmd.respond_info("%s: %d%% (%.0f s)" % (name, job.progress * 100., job.elapsed()))
+
+        self.status = job.get_status()
+        if job.state == 'timeout':
+            gcmd.respond_info("%s: timed out after %.0f s" % (name, timeout))
+        elif job.state == 'failed':
+            logging.info("zmod_jobs: %s failed (%s): %s", name, job.returncode, '\n'.join(job.output[-10:]))
+            gcmd.respond_info("%s: failed (%s)" % (name, job.returncode))
+        else:
+            gcmd.respond_info("%s: done in %.1f s" % (name, job.elapsed()))
+
+    def get_status(self, eventtime):
+        status = dict(self.status)
+        status['jobs'] = sorted(self.commands)
+        return status
+
+def load_config(config):
+    return ZmodJobs(config)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a job the way [zmod_jobs] does, outside of Klipper.")
+    parser.add_argument('command', nargs=argparse.REMAINDER, help="-- <command> [args]")
+    parser.add_argument('--stand-in', type=float, metavar='SECONDS', help="run a stand-in job instead of a command")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--timeout-per-mb', type=float, default=DEFAULT_TIMEOUT_PER_MB)
+    parser.add_argument('--file', help="file the job works on, scales the timeout")
+    parser.add_argument('--progress-interval', type=float, default=1.)
+    args = parser.parse_args()
+
+    argv = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if args.stand_in is not None:
+        argv = [sys.executable, '-c', STAND_IN_SCRIPT, str(args.stand_in)]
+    if not argv:
+        parser.error("no command given")
+
+    timeout = job_timeout(args.timeout, args.timeout_per_mb, args.file)
+    done = threading.Event()
+    runner = JobRunner()
+    job = Job(os.path.basename(argv[0]), argv, timeout)
+    runner.start(job, lambda job: done.set())
+    deadline = time.monotonic() + timeout
+    while not done.wait(max(0., min(args.progress_interval, deadline - time.monotonic()))):
+        if time.monotonic() >= deadline:
+            runner.cancel('timeout')
+            done.wait()
+            break
+        print(f"{job.name}: {job.progress * 100.:.0f}% ({job.elapsed():.1f} s)", flush=True)
+
+    print(f"{job.name}: {job.state} in {job.elapsed():.2f} s, returncode {job.returncode}, result {job.result}")
+    if job.state != 'done':
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
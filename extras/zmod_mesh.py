@@ -0,0 +1,736 @@
+# Bed mesh statistics and saved profile matching for the zmod print start.
+#
+# (C) 2024-2026 ghzserg https://zmod.link/
+#
+# [zmod_mesh]
+# tolerance: 0.21
+#   How far (mm) the last probe may be from the mesh at the probe point for a profile to fit. The same margin
+#   _MESH_COMPARE allows around the mesh extremes.
+#
+# ZMOD_MESH_STATS [X=<x> Y=<y>]
+#   Reports min, max and delta of the loaded mesh and its Z at the probe point.
+#
+# ZMOD_MESH_MATCH [X=<x> Y=<y> Z=<z> Z_OFFSET=<mm>] [TOLERANCE=<mm>] [LOAD=1]
+#   Scores every saved bed_mesh profile against the last probe. With LOAD=1 the best fitting profile is loaded when
+#   the current one does not fit. The result is in printer.zmod_mesh: fits, profile (the loaded one), best_profile,
+#   error and z (best_profile's Z at the probe point, with Z_OFFSET). _TEST_POINT and _MESH_COMPARE call it with
+#   LOAD=1 where they ran KAMP before, _MESH_MATCH_RESULT then runs KAMP only when no profile fits.
+#
+# X/Y default to the toolhead position, where the probe was taken, and Z to the last probe result.
+#
+# ZMOD_PROBE_ROUTE [MAX_POINTS=<count>] [RADIUS=<mm>] [TOLERANCE=<mm>] [DRY_RUN=1]
+#   Probes one mesh node for _FIND_POINT, the way _PROBE_POINT does, and leaves the verdict to _TEST_POINT. The
+#   MAX_POINTS (default route_points) nodes closest to the mesh center, within RADIUS of it if given, are the
+#   candidates and the one nearest to the toolhead is probed: the node near the center the toolhead gets to quickest.
+#   The result is in printer.zmod_mesh.route: probes, found (the probe is within TOLERANCE, default probe_tolerance, of
+#   the mesh) and x, y, z of the probed node (z with the probe's z_offset, as _TEST_POINT takes it). DRY_RUN=1 only
+#   reports the node.
+#
+#   _FIND_POINT without this module emits a _PROBE_POINT for every node of the mesh, sorted by distance from the
+#   center, and _PROBE_POINT gives up after the first one whether it matched or not. Probing more nodes until one
+#   matches would pass a wrong profile that happens to agree somewhere and cost extra probes before the same KAMP.
+#
+# [zmod_mesh] options for it:
+# probe_tolerance: 0.31
+#   The margin _TEST_POINT allows between the probe and the mesh.
+# route_points: 5
+#
+# The functions below only take the status dicts Klipper reports (printer.bed_mesh, printer.probe), so they can be
+# run against a stand-in printer state off the printer. NumPy is used when it is installed.
+#   python3 zmod_mesh.py [--size 9x9] [--max-points N] [--config-dir ..]
+# runs ZMOD_PROBE_ROUTE and ZMOD_MESH_MATCH over a synthetic mesh against a stand-in printer. With
+# jinja2 installed it also runs the base.cfg macros that call them (_FIND_POINT down to _TEST_POINT_APPLY and KAMP,
+# _MESH_COMPARE) the way Klipper's gcode_macro does, a macro called while it is still running being an error.
+
+import argparse
+import ast
+import collections
+import configparser
+import math
+import os
+import random
+import shlex
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+DEFAULT_TOLERANCE = 0.21
+DEFAULT_PROBE_TOLERANCE = 0.31
+DEFAULT_ROUTE_POINTS = 5
+
+def _grid_axis(low, high, count):
+    if count < 2:
+        return [low]
+    step = (high - low) / (count - 1)
+    return [low + step * index for index in range(count)]
+
+def _locate(axis, value):
+    # Index of the cell containing value and the position within it, clamped to the grid.
+    if len(axis) < 2:
+        return 0, 0.0
+    value = min(max(value, axis[0]), axis[-1])
+    index = 0
+    while index < len(axis) - 2 and value > axis[index + 1]:
+        index += 1
+    width = axis[index + 1] - axis[index]
+    return index, (value - axis[index]) / width if width else 0.0
+
+def interpolate(matrix, mesh_min, mesh_max, x, y):
+    # Bilinear Z of a mesh laid out like bed_mesh reports it: matrix[row y][column x] between mesh_min and mesh_max.
+    x_axis = _grid_axis(mesh_min[0], mesh_max[0], len(matrix[0]))
+    y_axis = _grid_axis(mesh_min[1], mesh_max[1], len(matrix))
+    column, tx = _locate(x_axis, x)
+    row, ty = _locate(y_axis, y)
+    next_column = min(column + 1, len(x_axis) - 1)
+    next_row = min(row + 1, len(y_axis) - 1)
+    z0 = matrix[row][column] * (1.0 - tx) + matrix[row][next_column] * tx
+    z1 = matrix[next_row][column] * (1.0 - tx) + matrix[next_row][next_column] * tx
+    return z0 * (1.0 - ty) + z1 * ty
+
+def mesh_statistics(matrix):
+    # (min, max, delta) in one pass over the matrix.
+    if numpy is not None:
+        values = numpy.asarray(matrix, dtype=float)
+        low, high = float(values.min()), float(values.max())
+    else:
+        low = min(min(row) for row in matrix)
+        high = max(max(row) for row in matrix)
+    return low, high, high - low
+
+def _profile_grid(profile):
+    params = profile.get('mesh_params', {})
+    points = profile.get('points', [])
+    if not points or not points[0]:
+        return None
+    mesh_min = (params.get('min_x', 0.0), params.get('min_y', 0.0))
+    mesh_max = (params.get('max_x', mesh_min[0]), params.get('max_y', mesh_min[1]))
+    return points, mesh_min, mesh_max
+
+def score_profiles(bed_mesh_status, x, y, z, z_offset=0.0):
+    # Returns [(error, name, mesh Z at x/y)] for every saved profile, best match first. error is how far the probe is
+    # from the profile's surface at the probe point.
+    scores = []
+    for name, profile in bed_mesh_status.get('profiles', {}).items():
+        grid = _profile_grid(profile)
+        if grid is None:
+            continue
+        mesh_z = interpolate(grid[0], grid[1], grid[2], x, y) + z_offset
+        scores.append((abs(z - mesh_z), name, mesh_z))
+    scores.sort()
+    return scores
+
+def current_statistics(bed_mesh_status, x, y, z_offset=0.0):
+    # min, max, delta and Z at x/y of the loaded mesh, None if no mesh is loaded.
+    matrix = bed_mesh_status.get('mesh_matrix', None)
+    if not bed_mesh_status.get('profile_name', '') or not matrix or not matrix[0]:
+        return None
+    low, high, delta = mesh_statistics(matrix)
+    mesh_z = interpolate(matrix, bed_mesh_status['mesh_min'], bed_mesh_status['mesh_max'], x, y)
+    return {
+        'min': low + z_offset,
+        'max': high + z_offset,
+        'delta': delta,
+        'z_at_probe': mesh_z + z_offset
+    }
+
+def last_probe(probe_status, probe_z_offset):
+    # (z, offset the mesh is compared with): Klipper 13 reports the probed position, older Klippers only the result
+    # relative to the probe's z_offset, which _MESH_COMPARE adds to the mesh.
+    position = probe_status.get('last_probe_position', None)
+    if position is not None:
+        return position[2], 0.0
+    return probe_status.get('last_z_result', 0.0), probe_z_offset
+
+def mesh_nodes(matrix, mesh_min, mesh_max):
+    # [(x, y, z)] of every probed node, row by row.
+    x_axis = _grid_axis(mesh_min[0], mesh_max[0], len(matrix[0]))
+    y_axis = _grid_axis(mesh_min[1], mesh_max[1], len(matrix))
+    return [(x, y, matrix[row][column]) for row, y in enumerate(y_axis) for column, x in enumerate(x_axis)]
+
+def _distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+def probe_node(matrix, mesh_min, mesh_max, start=None, max_points=DEFAULT_ROUTE_POINTS, radius=None):
+    # Of the max_points nodes closest to the mesh center (within radius of it if given) the one nearest to start, the
+    # center if not given. Returns (x, y, z), None without a node within radius.
+    center = ((mesh_min[0] + mesh_max[0]) / 2.0, (mesh_min[1] + mesh_max[1]) / 2.0)
+    nodes = sorted(mesh_nodes(matrix, mesh_min, mesh_max), key=lambda node: _distance(center, node))
+    if radius is not None:
+        nodes = [node for node in nodes if _distance(center, node) <= radius]
+    if start is None:
+        start = center
+    return min(nodes[:max(max_points, 1)], key=lambda node: _distance(start, node), default=None)
+
+class ZmodMesh:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.tolerance = config.getfloat('tolerance', DEFAULT_TOLERANCE, above=0.)
+        self.probe_tolerance = config.getfloat('probe_tolerance', DEFAULT_PROBE_TOLERANCE, above=0.)
+        self.route_points = config.getint('route_points', DEFAULT_ROUTE_POINTS, minval=1)
+        self.status = {'fits': True, 'profile': '', 'best_profile': '', 'error': 0.0, 'z': 0.0, 'loaded': False}
+        self.route = {'probes': 0, 'found': False, 'x': 0.0, 'y': 0.0, 'z': 0.0, 'error': 0.0, 'travel': 0.0}
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command('ZMOD_MESH_STATS', self.cmd_ZMOD_MESH_STATS,
+                                    desc="Report min, max and delta of the loaded mesh")
+        self.gcode.register_command('ZMOD_MESH_MATCH', self.cmd_ZMOD_MESH_MATCH,
+                                    desc="Find the saved mesh profile that fits the last probe")
+        self.gcode.register_command('ZMOD_PROBE_ROUTE', self.cmd_ZMOD_PROBE_ROUTE,
+                                    desc="Probe the mesh node near the center the toolhead gets to quickest")
+
+    def _probe_point(self, gcmd):
+        eventtime = self.printer.get_reactor().monotonic()
+        toolhead = self.printer.lookup_object('toolhead')
+        position = toolhead.get_position()
+        probe = self.printer.lookup_object('probe', None)
+        probe_status = probe.get_status(eventtime) if probe is not None else {}
+        settings = self.printer.lookup_object('configfile').get_status(eventtime)['settings']
+        z, z_offset = last_probe(probe_status, settings.get('probe', {}).get('z_offset', 0.0))
+        x = gcmd.get_float('X', position[0])
+        y = gcmd.get_float('Y', position[1])
+        z = gcmd.get_float('Z', z)
+        z_offset = gcmd.get_float('Z_OFFSET', z_offset)
+        bed_mesh = self.printer.lookup_object('bed_mesh')
+        return bed_mesh.get_status(eventtime), x, y, z, z_offset
+
+    def cmd_ZMOD_MESH_STATS(self, gcmd):
+        bed_mesh_status, x, y, z, z_offset = self._probe_point(gcmd)
+        stats = current_statistics(bed_mesh_status, x, y, z_offset)
+        if stats is None:
+            raise gcmd.error("No bed mesh loaded")
+        gcmd.respond_info("Profile: %s\nMin: %.3f mm | Max: %.3f mm | Delta: %.3f mm\n"
+                          "Mesh at X%.1f Y%.1f: %.3f mm | Last probe: %.3f mm"
+                          % (bed_mesh_status['profile_name'], stats['min'], stats['max'], stats['delta'],
+                             x, y, stats['z_at_probe'], z))
+
+    def cmd_ZMOD_MESH_MATCH(self, gcmd):
+        bed_mesh_status, x, y, z, z_offset = self._probe_point(gcmd)
+        tolerance = gcmd.get_float('TOLERANCE', self.tolerance, above=0.)
+        current = bed_mesh_status.get('profile_name', '')
+        scores = score_profiles(bed_mesh_status, x, y, z, z_offset)
+
+        errors = dict((name, (error, mesh_z)) for error, name, mesh_z in scores)
+        self.status = {'fits': False, 'profile': current, 'best_profile': '', 'error': 0.0, 'z': 0.0, 'loaded': False}
+        if scores:
+            self.status['best_profile'] = scores[0][1]
+            self.status['error'] = scores[0][0]
+            self.status['z'] = scores[0][2]
+
+        if current in errors and errors[current][0] <= tolerance:
+            self.status['fits'] = True
+            self.status['best_profile'] = current
+            self.status['error'], self.status['z'] = errors[current]
+            gcmd.respond_info("Profile %s fits the last probe (%.3f mm)" % (current, errors[current][0]))
+            return
+        if not scores or scores[0][0] > tolerance:
+            gcmd.respond_info("No saved profile fits the last probe (best: %s, %.3f mm), a new mesh is needed"
+                              % (self.status['best_profile'] or '-', self.status['error']))
+            return
+
+        self.status['fits'] = True
+        best = scores[0][1]
+        gcmd.respond_info("Profile %s fits the last probe (%.3f mm)" % (best, scores[0][0]))
+        if gcmd.get_int('LOAD', 0):
+            self.gcode.run_script_from_command("BED_MESH_PROFILE LOAD=\"%s\"" % (best,))
+            self.status['profile'] = best
+            self.status['loaded'] = True
+
+    def _last_probe(self):
+        eventtime = self.printer.get_reactor().monotonic()
+        probe = self.printer.lookup_object('probe')
+        settings = self.printer.lookup_object('configfile').get_status(eventtime)['settings']
+        return last_probe(probe.get_status(eventtime), settings.get('probe', {}).get('z_offset', 0.0))
+
+    def cmd_ZMOD_PROBE_ROUTE(self, gcmd):
+        eventtime = self.printer.get_reactor().monotonic()
+        bed_mesh_status = self.printer.lookup_object('bed_mesh').get_status(eventtime)
+        matrix = bed_mesh_status.get('probed_matrix', None)
+        if not bed_mesh_status.get('profile_name', '') or not matrix or not matrix[0]:
+            raise gcmd.error("No bed mesh loaded")
+        max_points = gcmd.get_int('MAX_POINTS', self.route_points, minval=1)
+        radius = gcmd.get_float('RADIUS', None, above=0.)
+        tolerance = gcmd.get_float('TOLERANCE', self.probe_tolerance, above=0.)
+
+        position = self.printer.lookup_object('toolhead').get_position()
+        start = (position[0], position[1])
+        node = probe_node(matrix, bed_mesh_status['mesh_min'], bed_mesh_status['mesh_max'], start, max_points, radius)
+        if node is None:
+            raise gcmd.error("No mesh node within RADIUS of the mesh center")
+        self.route = {'probes': 0, 'found': False, 'x': 0.0, 'y': 0.0, 'z': 0.0, 'error': 0.0,
+                      'travel': _distance(start, node)}
+        if gcmd.get_int('DRY_RUN', 0):
+            gcmd.respond_info("Probe X%.1f Y%.1f, %.1f mm of travel" % (node[0], node[1], self.route['travel']))
+            return
+
+        # What _PROBE_POINT does around its probe.
+        x, y, z = node
+        self.gcode.run_script_from_command(
+            "_G28\n"
+            "M400\n"
+            "_TEST_MIN_MAX\n"
+            "SAVE_GCODE_STATE NAME=_probe_route\n"
+            "G1 X%.3f Y%.3f F6000\n"
+            "M400\n"
+            "LOAD_CELL_TARE\n"
+            "PROBE\n"
+            "G1 Z5 F300\n"
+            "RESTORE_GCODE_STATE MOVE=0 NAME=_probe_route" % (x, y))
+        probe_z, z_offset = self._last_probe()
+        error = abs(probe_z - (z + z_offset))
+        self.route.update({'probes': 1, 'found': error < tolerance, 'x': x, 'y': y, 'z': z + z_offset,
+                           'error': error})
+        gcmd.respond_info("X: %.4f\tY: %.4f\tZ: %.4f" % (x, y, z + z_offset))
+
+    def get_status(self, eventtime):
+        status = dict(self.status)
+        status['route'] = dict(self.route)
+        return status
+
+def load_config(config):
+    return ZmodMesh(config)
+
+def synthetic_mesh(columns, rows, seed=1):
+    # A tilted, slightly bowed bed with some noise, laid out like bed_mesh reports it.
+    generator = random.Random(seed)
+    mesh_min, mesh_max = (15.0, 15.0), (205.0, 205.0)
+    matrix = []
+    for row in range(rows):
+        v = row / max(rows - 1, 1)
+        matrix.append([0.08 * v - 0.05 * (column / max(columns - 1, 1)) + 0.1 * ((v - 0.5) ** 2)
+                       + generator.uniform(-0.01, 0.01) for column in range(columns)])
+    return matrix, mesh_min, mesh_max
+
+class StandInError(Exception):
+    pass
+
+class StandInGCodeCommand:
+    # What the commands use of Klipper's GCodeCommand.
+    error = StandInError
+
+    def __init__(self, params):
+        self.params = dict((key.upper(), str(value)) for key, value in params.items())
+        self.responses = []
+
+    def get(self, name, default=None):
+        return self.params.get(name, default)
+
+    def get_float(self, name, default=None, above=None, minval=None):
+        value = self.params.get(name, None)
+        if value is None:
+            return default
+        value = float(value)
+        if (above is not None and value <= above) or (minval is not None and value < minval):
+            raise self.error("Error on '%s': out of range" % (name,))
+        return value
+
+    def get_int(self, name, default=None, minval=None, maxval=None):
+        value = self.params.get(name, None)
+        if value is None:
+            return default
+        value = int(value)
+        if (minval is not None and value < minval) or (maxval is not None and value > maxval):
+            raise self.error("Error on '%s': out of range" % (name,))
+        return value
+
+    def respond_info(self, msg):
+        self.responses.append(msg)
+
+# Klipper reports positions as a Coord namedtuple, macros use both .z and [2].
+Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e'))
+
+class StandInPrinter:
+    # The printer objects ZmodMesh looks up, with a bed whose surface is surface(x, y). PROBE measures it the way
+    # Klipper 11 reports it (relative to the probe's z_offset) or Klipper 13 does (the probed position), BED_MESH_PROFILE
+    # LOAD switches the loaded mesh.
+    def __init__(self, profiles, profile_name, surface, z_offset=0.1, position=(0.0, 0.0), klipper13=False):
+        self.profiles = profiles
+        self.profile_name = profile_name
+        self.surface = surface
+        self.z_offset = z_offset
+        self.klipper13 = klipper13
+        self.position = [position[0], position[1], 5.0, 0.0]
+        self.probe_status = {'last_z_result': 0.0}
+        self.scripts = []
+        self.probes = []
+        self.commands = {}
+        # StandInMacros running the scripts, None to only execute the moves, probes and profile loads in them.
+        self.macros = None
+
+    # printer
+    def get_reactor(self):
+        return self
+
+    def monotonic(self):
+        return 0.0
+
+    def lookup_object(self, name, default=None):
+        if name in ('gcode', 'toolhead', 'probe', 'bed_mesh', 'configfile'):
+            return self
+        return default
+
+    # gcode
+    def register_command(self, name, func, desc=None):
+        self.commands[name] = func
+
+    def run(self, command, **params):
+        gcmd = StandInGCodeCommand(params)
+        self.commands[command](gcmd)
+        return gcmd
+
+    def run_script_from_command(self, script):
+        self.scripts.append(script)
+        if self.macros is not None:
+            self.macros.run_script(script)
+            return
+        for line in script.split('\n'):
+            self.execute(line)
+
+    def execute(self, line):
+        words = line.split()
+        if words:
+            if words[0] == 'G1':
+                for word in words[1:]:
+                    if word[0] in 'XY':
+                        self.position['XY'.index(word[0])] = float(word[1:])
+            elif words[0] == 'PROBE':
+                self.probes.append((self.position[0], self.position[1]))
+                z = self.surface(self.position[0], self.position[1])
+                if self.klipper13:
+                    self.probe_status = {'last_z_result': z,
+                                         'last_probe_position': Coord(self.position[0], self.position[1], z, 0.0)}
+                else:
+                    self.probe_status = {'last_z_result': z + self.z_offset}
+            elif words[0] == 'BED_MESH_PROFILE':
+                self.profile_name = words[1].split('=', 1)[1].strip('"')
+
+    # toolhead
+    def get_position(self):
+        return list(self.position)
+
+    # probe, bed_mesh and configfile
+    def get_status(self, eventtime):
+        profile = self.profiles[self.profile_name]
+        params = profile['mesh_params']
+        status = {
+            'last_z_result': self.probe_status['last_z_result'],
+            'settings': {'probe': {'z_offset': self.z_offset}},
+            'profile_name': self.profile_name,
+            'mesh_min': (params['min_x'], params['min_y']),
+            'mesh_max': (params['max_x'], params['max_y']),
+            'probed_matrix': profile['points'],
+            'mesh_matrix': profile['points'],
+            'profiles': self.profiles
+        }
+        if 'last_probe_position' in self.probe_status:
+            status['last_probe_position'] = self.probe_status['last_probe_position']
+        return status
+
+    def config(self, **options):
+        # The [zmod_mesh] section.
+        printer = self
+
+        class StandInConfig:
+            def get_printer(self):
+                return printer
+
+            def getfloat(self, name, default, above=None):
+                return float(options.get(name, default))
+
+            def getint(self, name, default, minval=None):
+                return int(options.get(name, default))
+
+        return StandInConfig()
+
+def _parse_command(line):
+    # "NAME KEY=VALUE ..." -> (NAME, {KEY: VALUE}), the way Klipper splits extended commands.
+    parts = line.split(None, 1)
+    params = {}
+    for argument in shlex.split(parts[1]) if len(parts) > 1 else []:
+        if '=' in argument:
+            key, value = argument.split('=', 1)
+            params[key.upper()] = value
+    return parts[0].upper(), params
+
+class StandInMacros:
+    # The [gcode_macro] sections of config files run the way Klipper's gcode_macro runs them: the template is rendered
+    # with the printer status of the moment and its lines run one by one, and a macro still running cannot be called
+    # again. Only the macros in walked are run, any other command is recorded in commands and handed to the printer.
+    def __init__(self, printer, zmod_mesh, paths, walked, save_variables):
+        self.printer = printer
+        self.zmod_mesh = zmod_mesh
+        self.walked = set(walked)
+        self.save_variables = save_variables
+        self.templates = {}
+        self.names = {}
+        self.variables = {}
+        self.running = set()
+        self.commands = []
+        env = jinja2.Environment('{%', '%}', '{', '}')
+        env.add_extension('jinja2.ext.do')
+        for path in paths:
+            config = configparser.RawConfigParser(strict=False, inline_comment_prefixes=(';', '#'))
+            with open(path, 'r', encoding='utf-8') as f:
+                config.read_file(f, path)
+            for section in config.sections():
+                if not section.startswith('gcode_macro '):
+                    continue
+                name = section.split(None, 1)[1].strip()
+                options = dict(config.items(section))
+                self.names[name.upper()] = name
+                self.templates[name.upper()] = env.from_string(options.get('gcode', ''))
+                self.variables[name.upper()] = dict((option[len('variable_'):], ast.literal_eval(value))
+                                                    for option, value in options.items()
+                                                    if option.startswith('variable_'))
+        printer.macros = self
+
+    def status(self):
+        bed_mesh = self.printer.get_status(0.0)
+        status = dict(('gcode_macro ' + self.names[name], variables) for name, variables in self.variables.items())
+        status.update({
+            'save_variables': {'variables': self.save_variables},
+            'probe': dict(self.printer.probe_status),
+            'configfile': {'settings': {'probe': {'z_offset': self.printer.z_offset}}},
+            'bed_mesh': dict((key, bed_mesh[key]) for key in ('profile_name', 'mesh_min', 'mesh_max',
+                                                              'probed_matrix', 'mesh_matrix', 'profiles')),
+            'zmod_mesh': self.zmod_mesh.get_status(0.0)
+        })
+        return status
+
+    def run_script(self, script):
+        for line in script.split('\n'):
+            line = line.strip()
+            if not line or line[0] in ';#':
+                continue
+            name, params = _parse_command(line)
+            if name in self.walked:
+                self.run_macro(name, params)
+            elif name in self.printer.commands:
+                self.printer.commands[name](StandInGCodeCommand(params))
+            elif name == 'SET_GCODE_VARIABLE':
+                self.variables[params['MACRO'].upper()][params['VARIABLE'].lower()] = ast.literal_eval(params['VALUE'])
+            else:
+                self.commands.append(line)
+                self.printer.execute(line)
+
+    def run_macro(self, name, params):
+        if name in self.running:
+            raise StandInError("Macro %s called recursively" % (self.names[name],))
+
+        def raise_error(msg):
+            raise StandInError(msg)
+
+        context = dict(self.variables[name])
+        context.update({'printer': self.status(), 'params': params, 'action_respond_info': lambda msg: '',
+                        'action_raise_error': raise_error})
+        self.running.add(name)
+        try:
+            self.run_script(self.templates[name].render(context))
+        finally:
+            self.running.discard(name)
+
+    def called(self, name):
+        return [line for line in self.commands if _parse_command(line)[0] == name]
+
+def synthetic_profile(columns, rows, seed=1):
+    matrix, mesh_min, mesh_max = synthetic_mesh(columns, rows, seed)
+    return {
+        'points': matrix,
+        'mesh_params': {'min_x': mesh_min[0], 'min_y': mesh_min[1], 'max_x': mesh_max[0], 'max_y': mesh_max[1],
+                        'x_count': columns, 'y_count': rows}
+    }
+
+def profile_surface(profile, shift=0.0):
+    grid = _profile_grid(profile)
+    return lambda x, y: interpolate(grid[0], grid[1], grid[2], x, y) + shift
+
+def check_probe_route(columns, rows):
+    # ZMOD_PROBE_ROUTE against a stand-in printer. Returns a list of failures.
+    failures = []
+    profiles = {'default': synthetic_profile(columns, rows, 1)}
+    start = (205.0, 5.0)
+    for shift, found in ((0.0, True), (0.5, False)):
+        printer = StandInPrinter(profiles, 'default', profile_surface(profiles['default'], shift), position=start)
+        zmod_mesh = ZmodMesh(printer.config())
+        printer.run('ZMOD_PROBE_ROUTE', DRY_RUN=1)
+        if printer.probes:
+            failures.append("DRY_RUN=1 probed")
+        printer.run('ZMOD_PROBE_ROUTE')
+        route = zmod_mesh.get_status(0.0)['route']
+        # The candidate nearest to the toolhead, counted out here without probe_node.
+        nodes = mesh_nodes(profiles['default']['points'], (15.0, 15.0), (205.0, 205.0))
+        candidates = sorted(nodes, key=lambda node: math.hypot(node[0] - 110.0, node[1] - 110.0))[:DEFAULT_ROUTE_POINTS]
+        expected = sorted(candidates, key=lambda node: math.hypot(node[0] - start[0], node[1] - start[1]))[0]
+        name = 'a matching plate' if found else 'a wrong plate'
+        if len(printer.probes) != 1 or route['probes'] != 1:
+            failures.append(f"{name}: {len(printer.probes)} probes, the route says {route['probes']}, instead of one")
+        if printer.probes and _distance(printer.probes[0], expected) > 0.001:
+            failures.append(f"{name}: probed {printer.probes[0]} instead of {expected[:2]}")
+        if route['found'] != found:
+            failures.append(f"{name}: found is {route['found']}")
+        if abs(route['z'] - (expected[2] + printer.z_offset)) > 1e-9:
+            failures.append(f"{name}: z {route['z']} is not the mesh at the node with the probe's z_offset")
+    # No node of a 4x4 mesh is at the center.
+    profiles = {'default': synthetic_profile(4, 4, 1)}
+    printer = StandInPrinter(profiles, 'default', profile_surface(profiles['default']), position=start)
+    ZmodMesh(printer.config())
+    try:
+        printer.run('ZMOD_PROBE_ROUTE', RADIUS=1)
+        failures.append("RADIUS without a node in it did not fail")
+    except StandInError:
+        pass
+    if printer.probes:
+        failures.append("RADIUS without a node in it probed")
+    return failures
+
+def check_mesh_match(columns, rows):
+    # ZMOD_MESH_MATCH LOAD=1 the way _TEST_POINT and _MESH_COMPARE call it, against a stand-in printer with three
+    # saved plates. Returns a list of failures.
+    failures = []
+    profiles = {
+        'default': synthetic_profile(columns, rows, 1),
+        'smooth': synthetic_profile(columns, rows, 2),
+        'textured': synthetic_profile(columns, rows, 3)
+    }
+    # Different plates sit at different heights.
+    for shift, name in ((0.0, 'smooth'), (0.4, 'textured')):
+        for row in profiles[name]['points']:
+            row[:] = [z + shift + 0.3 for z in row]
+    point = (110.0, 110.0)
+    # plate on the bed, loaded profile: (fits, profile loaded afterwards)
+    cases = (
+        ('default', 'default', True, 'default'),
+        ('smooth', 'default', True, 'smooth'),
+        ('textured', 'smooth', True, 'textured'),
+        (None, 'default', False, 'default')
+    )
+    for klipper13 in (False, True):
+        for plate, loaded, fits, expected in cases:
+            surface = profile_surface(profiles[plate]) if plate else profile_surface(profiles['default'], 1.5)
+            printer = StandInPrinter(profiles, loaded, surface, position=point, klipper13=klipper13)
+            zmod_mesh = ZmodMesh(printer.config())
+            printer.run_script_from_command("PROBE")
+            scripts = len(printer.scripts)
+            printer.run('ZMOD_MESH_MATCH', X=point[0], Y=point[1], LOAD=1)
+            status = zmod_mesh.get_status(0.0)
+            name = f"klipper13={klipper13} plate {plate or 'unknown'} with {loaded} loaded"
+            if status['fits'] != fits:
+                failures.append(f"{name}: fits is {status['fits']}")
+            if printer.profile_name != expected or status['profile'] != expected:
+                failures.append(f"{name}: {printer.profile_name} loaded, status says {status['profile']}")
+            if status['loaded'] != (expected != loaded) or (len(printer.scripts) > scripts) != (expected != loaded):
+                failures.append(f"{name}: loaded is {status['loaded']} after {len(printer.scripts) - scripts} scripts")
+            if fits:
+                # What _MESH_MATCH_RESULT hands to _TEST_POINT: the mesh at the probe point as _TEST_POINT compares it.
+                probe_z = printer.probe_status['last_z_result']
+                if abs(probe_z - status['z']) > 0.001:
+                    failures.append(f"{name}: z {status['z']:.4f} does not match the probe {probe_z:.4f}")
+    return failures
+
+# The macros of the probe and mesh checks, everything they call beyond these only moves or heats.
+CHAIN_MACROS = ('_FIND_POINT', '_FIND_POINT_RESULT', '_PROBE_POINT', '_TEST_POINT', '_TEST_POINT_APPLY',
+                '_MESH_MATCH_RESULT', '_MESH_COMPARE')
+
+def check_macro_chain(config_dir, columns, rows):
+    # Runs _FIND_POINT (mesh_test 3 and 4) and _MESH_COMPARE (mesh_test 2) from base.cfg with [zmod_mesh] loaded,
+    # for a plate that fits the loaded profile, one that fits another saved profile and one that fits none. Returns a
+    # list of failures.
+    failures = []
+    paths = [os.path.join(config_dir, name) for name in ('base.cfg', 'base_display_off.cfg')]
+    profiles = {'default': synthetic_profile(columns, rows, 1), 'smooth': synthetic_profile(columns, rows, 2)}
+    # Well outside the 0.31 mm _TEST_POINT allows.
+    for row in profiles['smooth']['points']:
+        row[:] = [z + 0.6 for z in row]
+    plates = (('default', profile_surface(profiles['default'])), ('smooth', profile_surface(profiles['smooth'])),
+              (None, profile_surface(profiles['default'], 1.5)))
+    for klipper13 in (False, True):
+        for command, mesh_test in (('_FIND_POINT', 4), ('_FIND_POINT', 3), ('_MESH_COMPARE', 2)):
+            for plate, surface in plates:
+                printer = StandInPrinter(dict((name, profiles[name]) for name in profiles), 'default', surface,
+                                         position=(110.0, 110.0), klipper13=klipper13)
+                zmod_mesh = ZmodMesh(printer.config())
+                macros = StandInMacros(printer, zmod_mesh, paths, CHAIN_MACROS,
+                                       {'mesh_test': mesh_test, 'klipper13': int(klipper13)})
+                name = f"klipper13={klipper13} {command} mesh_test={mesh_test} plate {plate or 'unknown'}"
+                error = None
+                try:
+                    if command == '_MESH_COMPARE':
+                        # What _MESH_PROBE leaves behind.
+                        printer.execute("PROBE")
+                    macros.run_script(command)
+                except StandInError as e:
+                    error = str(e)
+                kamp = len(macros.called('KAMP'))
+                offsets = macros.called('_SET_GCODE_OFFSET_FAST')
+                if mesh_test == 3 and plate != 'default':
+                    # mesh_test 3 stops at any mismatch, without looking for another profile.
+                    if error is None or 'WARNING' not in error:
+                        failures.append(f"{name}: did not stop the print start ({error})")
+                    continue
+                if error is not None:
+                    failures.append(f"{name}: {error}")
+                    continue
+                if kamp != (0 if plate else 1):
+                    failures.append(f"{name}: KAMP ran {kamp} times")
+                expected = plate or 'default'
+                if printer.profile_name != expected:
+                    failures.append(f"{name}: {printer.profile_name} loaded instead of {expected}")
+                if command == '_FIND_POINT':
+                    if len(printer.probes) != 1:
+                        failures.append(f"{name}: {len(printer.probes)} probes")
+                    if len(offsets) != (1 if plate else 0):
+                        failures.append(f"{name}: Z-Offset adjusted {len(offsets)} times")
+                    elif offsets:
+                        z_adjust = float(_parse_command(offsets[0])[1]['Z_ADJUST'])
+                        stored = macros.variables['_TEST_POINT']['temp_z_offset']
+                        if abs(z_adjust) > 0.01 or stored != z_adjust:
+                            failures.append(f"{name}: Z_ADJUST {z_adjust:.4f}, temp_z_offset {stored}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Run ZMOD_PROBE_ROUTE and ZMOD_MESH_MATCH over a synthetic mesh "
+                                                 "against a stand-in printer.")
+    parser.add_argument('--size', default='9x9', help="columns x rows (default: 9x9)")
+    parser.add_argument('--max-points', type=int, default=DEFAULT_ROUTE_POINTS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--config-dir', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'),
+                        help="where base.cfg is (default: ..)")
+    args = parser.parse_args()
+
+    columns, rows = (int(value) for value in args.size.lower().split('x'))
+    matrix, mesh_min, mesh_max = synthetic_mesh(columns, rows, args.seed)
+    center = ((mesh_min[0] + mesh_max[0]) / 2.0, (mesh_min[1] + mesh_max[1]) / 2.0)
+    # The toolhead after _ORIG_CLEAR_NOZZLE, somewhere at the front.
+    start = (mesh_max[0], mesh_min[1] - 10.0)
+
+    nodes = mesh_nodes(matrix, mesh_min, mesh_max)
+    node = probe_node(matrix, mesh_min, mesh_max, start, args.max_points)
+    by_distance = sorted(nodes, key=lambda node: _distance(center, node))
+    print(f"{columns}x{rows} mesh, {len(nodes)} nodes, {min(args.max_points, len(nodes))} candidates")
+    print(f"  the center node:     {_distance(start, by_distance[0]):8.1f} mm of travel")
+    print(f"  the probed node:     {_distance(start, node):8.1f} mm of travel")
+
+    failures = check_probe_route(columns, rows)
+    print(f"ZMOD_PROBE_ROUTE: {'ok' if not failures else f'{len(failures)} failures'}")
+    match_failures = check_mesh_match(columns, rows)
+    print(f"ZMOD_MESH_MATCH: {'ok' if not match_failures else f'{len(match_failures)} failures'}")
+    failures += match_failures
+    if jinja2 is None:
+        print("base.cfg macros: skipped, jinja2 is not installed")
+    else:
+        chain_failures = check_macro_chain(args.config_dir, columns, rows)
+        print(f"base.cfg macros: {'ok' if not chain_failures else f'{len(chain_failures)} failures'}")
+        failures += chain_failures
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
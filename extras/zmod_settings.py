@@ -0,0 +1,397 @@
+# The zmod settings as one typed, validated status object.
+#
+# (C) 2024-2026 ghzserg https://zmod.link/
+#
+# [zmod_settings]
+#   Needs [save_variables].
+# settings_file: /opt/config/mod/csv/zmod_settings.json
+#   The settings the macros are generated from. settings_model.py next to it compiles them, the same code
+#   make_config_macros.py generates the macros with.
+# ad5x:
+# native_screen:
+#   Which printer variant to validate for. Default: variable_ad5x of _CLIENT_VARIABLE and variable_screen of _SCREEN.
+#
+# printer.zmod_settings holds the value of every setting, read from the variables file with its type and default and
+# checked the way GET_ZMOD_DATA checks it: clamped to min_valid_value / max_valid_value where the setting takes
+# custom values, reset to the default where it only takes the values listed for this variant. A macro reads a
+# setting with
+#   {% set led = printer.zmod_settings.led %}
+# instead of printer.save_variables.variables['led']|default(50)|int and the checks after it. The values are only
+# worked out again when the variables file was reloaded (every SAVE_VARIABLE replaces the dict save_variables keeps),
+# any other read is a dict lookup.
+#
+# ZMOD_SET [<SETTING>=<value> ...] [NEXT=<setting>] [RESET=1]
+#   Saves the given settings, rejecting values the setting does not take. NEXT=<setting> saves the value GLOBAL would
+#   switch to, RESET=1 the defaults _RESET_ZMOD saves. Without arguments it lists every setting. Values are written
+#   with ZMOD_SAVE_VARIABLE / ZMOD_FLUSH_VARIABLES when [zmod_variables] is loaded, with SAVE_VARIABLE otherwise.
+#
+# The registry does not depend on Klipper:
+#   python3 zmod_settings.py [--settings ../csv/zmod_settings.json] [--variables variables.cfg]
+# compiles it for every variant and runs ZMOD_SET against a stand-in save_variables, checking what it stored.
+
+import argparse
+import ast
+import configparser
+import importlib.util
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+
+DEFAULT_SETTINGS_FILE = '/opt/config/mod/csv/zmod_settings.json'
+# Parameters of ZMOD_SET that are not settings.
+COMMAND_PARAMETERS = ('NEXT', 'RESET')
+
+class SettingError(Exception):
+    pass
+
+def load_settings_model(settings_file):
+    # settings_model.py from the directory of settings_file, under a name of its own so it cannot clash.
+    path = os.path.join(os.path.dirname(os.path.abspath(settings_file)), 'settings_model.py')
+    spec = importlib.util.spec_from_file_location('zmod_settings_model', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class RegisteredSetting:
+    __slots__ = ('name', 'type', 'default', 'min_value', 'max_value', 'allow_generic', 'valid_values', 'next_values',
+                 'settable_values', 'resettable')
+
+    def __init__(self, setting, variant, visible):
+        self.name = setting.lower
+        self.type = setting.type
+        self.min_value = setting.min_value
+        self.max_value = setting.max_value
+        self.default = self.coerce(setting.default)
+        # An invisible setting is not checked by GET_ZMOD_DATA either, it keeps whatever it holds.
+        self.allow_generic = variant.allow_generic or not visible
+        self.valid_values = frozenset(variant.valid_values)
+        self.next_values = dict((value, self.coerce(next_value)) for value, next_value in variant.next_values.items())
+        self.settable_values = frozenset(variant.settable_values)
+        self.resettable = visible and setting.show_in_global and not setting.exclude_from_reset and \
+            len(variant.settable_values) > 0
+
+    def coerce(self, value):
+        # value as the setting's type, None if it is not one.
+        if self.type == 'string':
+            return '' if value is None else str(value)
+        try:
+            if self.type == 'float':
+                return float(value)
+            if isinstance(value, int):
+                return int(value)
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+    def validate(self, value):
+        # The value GET_ZMOD_DATA would show for a stored value.
+        value = self.coerce(value)
+        if value is None:
+            return self.default
+        if self.allow_generic:
+            if self.type != 'string':
+                if self.min_value is not None and value < self.min_value:
+                    value = self.coerce(self.min_value)
+                if self.max_value is not None and value > self.max_value:
+                    value = self.coerce(self.max_value)
+        elif self.valid_values and str(value) not in self.valid_values:
+            return self.default
+        return value
+
+    def parse(self, text):
+        # A value given to ZMOD_SET, raises SettingError if the setting does not take it.
+        if self.type == 'string':
+            # SAVE_ZMOD_DATA clears a string setting with 0.
+            value = '' if text == '0' else text
+        else:
+            value = self.coerce(text)
+            if value is None:
+                raise SettingError(f"{self.name.upper()}: '{text}' is not a {self.type}")
+        if self.allow_generic:
+            if self.type != 'string' and self.min_value is not None and value < self.min_value:
+                raise SettingError(f"{self.name.upper()}: {value} is below {self.min_value}")
+            if self.type != 'string' and self.max_value is not None and value > self.max_value:
+                raise SettingError(f"{self.name.upper()}: {value} is above {self.max_value}")
+        elif self.valid_values and str(value) not in self.valid_values:
+            raise SettingError(f"{self.name.upper()}: {value} is not one of {', '.join(sorted(self.valid_values))}")
+        return value
+
+    def next_value(self, value):
+        # What GLOBAL switches to from value, None if the value cannot be cycled from.
+        return self.next_values.get(str(value), None)
+
+    def reset_value(self, value):
+        # What _RESET_ZMOD stores for the stored value, None to leave it. A custom value (one GLOBAL cannot switch
+        # to) survives a reset.
+        if not self.resettable:
+            return None
+        if self.allow_generic and str(value) not in self.settable_values:
+            return None
+        return self.default
+
+class SettingsRegistry:
+    __slots__ = ('settings', 'is_ad5x', 'is_native_screen')
+
+    def __init__(self, model, is_ad5x, is_native_screen):
+        self.is_ad5x = is_ad5x
+        self.is_native_screen = is_native_screen
+        self.settings = {}
+        for setting in model.settings.values():
+            if setting.type == 'special':
+                continue
+            variant = setting.variant(is_ad5x, is_native_screen)
+            self.settings[setting.lower] = RegisteredSetting(setting, variant,
+                                                             setting.visible(is_ad5x, is_native_screen))
+
+    def lookup(self, name):
+        setting = self.settings.get(name.lower(), None)
+        if setting is None:
+            raise SettingError(f"Unknown setting '{name}'")
+        return setting
+
+    def values(self, variables):
+        # {name: value} for the save_variables dict.
+        result = {}
+        for name, setting in self.settings.items():
+            value = variables.get(name, None)
+            result[name] = setting.default if value is None else setting.validate(value)
+        return result
+
+    def changes(self, variables, params=None, next_name=None, reset=False):
+        # {name: value to store} for a ZMOD_SET with params ({SETTING: text}), NEXT=next_name and RESET=1. Raises
+        # SettingError, before anything is stored, if any of it is not accepted.
+        current = self.values(variables)
+        result = {}
+        if reset:
+            for name, setting in self.settings.items():
+                value = setting.reset_value(variables.get(name, setting.default))
+                if value is not None:
+                    result[name] = value
+        for key, text in (params or {}).items():
+            setting = self.lookup(key)
+            result[setting.name] = setting.parse(text)
+        if next_name is not None:
+            setting = self.lookup(next_name)
+            value = setting.next_value(result.get(setting.name, current[setting.name]))
+            if value is None:
+                raise SettingError(f"{setting.name.upper()} cannot be switched from {current[setting.name]}")
+            result[setting.name] = value
+        # Only what actually differs from the file.
+        return dict((name, value) for name, value in result.items()
+                    if name not in variables or repr(variables[name]) != repr(value))
+
+def compile_registry(settings_file, is_ad5x, is_native_screen):
+    settings_model = load_settings_model(settings_file)
+    model = settings_model.load_settings(settings_file, [(is_ad5x, is_native_screen)])
+    return SettingsRegistry(model, is_ad5x, is_native_screen)
+
+def _macro_variable(config, section, name, default):
+    if not config.has_section(section):
+        return default
+    return config.getsection(section).getboolean('variable_' + name, default)
+
+class ZmodSettings:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.save_variables = self.printer.load_object(config, 'save_variables')
+        is_ad5x = config.getboolean('ad5x', None)
+        if is_ad5x is None:
+            is_ad5x = _macro_variable(config, 'gcode_macro _CLIENT_VARIABLE', 'ad5x', False)
+        is_native_screen = config.getboolean('native_screen', None)
+        if is_native_screen is None:
+            is_native_screen = _macro_variable(config, 'gcode_macro _SCREEN', 'screen', True)
+        settings_file = config.get('settings_file', DEFAULT_SETTINGS_FILE)
+        try:
+            self.registry = compile_registry(settings_file, is_ad5x, is_native_screen)
+        except (OSError, ValueError, KeyError, AttributeError, ImportError) as e:
+            raise config.error("zmod_settings: cannot compile %s: %s" % (settings_file, e))
+        for name in COMMAND_PARAMETERS:
+            if name.lower() in self.registry.settings:
+                raise config.error("zmod_settings: setting '%s' clashes with ZMOD_SET %s=" % (name.lower(), name))
+        # The save_variables dict the status was worked out from.
+        self.source = None
+        self.status = {}
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('ZMOD_SET', self.cmd_ZMOD_SET, desc="Save zmod settings, validated")
+
+    def _store(self, changes):
+        gcode = self.printer.lookup_object('gcode')
+        zmod_variables = self.printer.lookup_object('zmod_variables', None)
+        if zmod_variables is not None:
+            for name, value in changes.items():
+                zmod_variables.stage(name, value)
+            zmod_variables.flush()
+            return
+        for name, value in changes.items():
+            gcode.run_script_from_command("SAVE_VARIABLE VARIABLE=%s VALUE=%s" % (name, shlex.quote(repr(value))))
+
+    def cmd_ZMOD_SET(self, gcmd):
+        params = gcmd.get_command_parameters()
+        settings = dict((key, value) for key, value in params.items() if key not in COMMAND_PARAMETERS)
+        next_name = gcmd.get('NEXT', None)
+        reset = gcmd.get_int('RESET', 0, minval=0, maxval=1) == 1
+        if not settings and next_name is None and not reset:
+            status = self.get_status(self.printer.get_reactor().monotonic())
+            gcmd.respond_info('\n'.join("%s=%s" % (name.upper(), status[name]) for name in sorted(status)))
+            return
+        try:
+            changes = self.registry.changes(self.save_variables.allVariables, settings, next_name, reset)
+        except SettingError as e:
+            raise gcmd.error(str(e))
+        if changes:
+            self._store(changes)
+        gcmd.respond_info("zmod_settings: %s" % (' '.join("%s=%s" % (name.upper(), value)
+                                                           for name, value in sorted(changes.items())) or 'unchanged',))
+
+    def get_status(self, eventtime):
+        # The dict is replaced, never changed, so a status handed out earlier stays what it was.
+        variables = self.save_variables.allVariables
+        if variables is not self.source:
+            self.status = self.registry.values(variables)
+            self.source = variables
+        return self.status
+
+def load_config(config):
+    return ZmodSettings(config)
+
+class StandInSaveVariables:
+    # What ZmodSettings uses of Klipper's save_variables: a variables file, allVariables replaced on every load.
+    def __init__(self, filename):
+        self.filename = filename
+        self.allVariables = {}
+        self.loadVariables()
+
+    def loadVariables(self):
+        variables = {}
+        varfile = configparser.ConfigParser()
+        varfile.read(self.filename)
+        if varfile.has_section('Variables'):
+            for name, value in varfile.items('Variables'):
+                variables[name] = ast.literal_eval(value)
+        self.allVariables = variables
+
+    def save(self, name, value):
+        # SAVE_VARIABLE
+        varfile = configparser.ConfigParser()
+        varfile.add_section('Variables')
+        variables = dict(self.allVariables)
+        variables[name] = value
+        for key, stored in sorted(variables.items()):
+            varfile.set('Variables', key, repr(stored))
+        with open(self.filename, 'w') as f:
+            varfile.write(f)
+        self.loadVariables()
+
+def _stand_in_set(registry, save_variables, params=None, next_name=None, reset=False):
+    # ZMOD_SET without Klipper, returns the changes written.
+    changes = registry.changes(save_variables.allVariables, params, next_name, reset)
+    for name, value in changes.items():
+        # The way SAVE_VARIABLE gets it: quoted for the G-code line, parsed back with literal_eval.
+        save_variables.save(name, ast.literal_eval(shlex.split(shlex.quote(repr(value)))[0]))
+    return changes
+
+def check_registry(registry, save_variables):
+    # Returns a list of failures.
+    failures = []
+    for name, setting in registry.settings.items():
+        status = registry.values(save_variables.allVariables)
+        if status[name] != setting.validate(save_variables.allVariables.get(name, setting.default)):
+            failures.append(f"{name}: status {status[name]!r} is not the validated stored value")
+
+        # GLOBAL's ring comes back where it started.
+        if setting.next_values:
+            start = next(iter(setting.next_values))
+            _stand_in_set(registry, save_variables, {name.upper(): start})
+            seen = []
+            for _ in range(len(setting.next_values)):
+                _stand_in_set(registry, save_variables, next_name=name)
+                seen.append(registry.values(save_variables.allVariables)[name])
+            if str(seen[-1]) != start or len(set(map(str, seen))) != len(setting.next_values):
+                failures.append(f"{name}: NEXT visits {seen} from {start}")
+
+        # Out of range or unlisted values are rejected and nothing is stored.
+        before = dict(save_variables.allVariables)
+        rejected = []
+        if setting.type != 'string':
+            rejected.append('not-a-number')
+            if setting.allow_generic and setting.min_value is not None:
+                rejected.append(str(setting.min_value - 1))
+            if setting.allow_generic and setting.max_value is not None:
+                rejected.append(str(setting.max_value + 1))
+            if not setting.allow_generic and setting.valid_values:
+                rejected.append('12345')
+        for text in rejected:
+            try:
+                _stand_in_set(registry, save_variables, {name.upper(): text})
+                failures.append(f"{name}: {text} was accepted")
+            except SettingError:
+                pass
+        if save_variables.allVariables != before:
+            failures.append(f"{name}: a rejected value changed the file")
+
+        # A value stored by something else is reported as GET_ZMOD_DATA shows it.
+        if setting.type != 'string' and setting.allow_generic and setting.max_value is not None:
+            save_variables.save(name, setting.max_value + 10)
+            if registry.values(save_variables.allVariables)[name] != setting.max_value:
+                failures.append(f"{name}: {setting.max_value + 10} is not clamped to {setting.max_value}")
+        elif setting.type != 'string' and setting.valid_values and not setting.allow_generic:
+            save_variables.save(name, 12345)
+            if registry.values(save_variables.allVariables)[name] != setting.default:
+                failures.append(f"{name}: 12345 is not reset to the default {setting.default}")
+
+    _stand_in_set(registry, save_variables, reset=True)
+    status = registry.values(save_variables.allVariables)
+    for name, setting in registry.settings.items():
+        if setting.resettable and not setting.allow_generic and status[name] != setting.default:
+            failures.append(f"{name}: RESET=1 left {status[name]!r}")
+    if _stand_in_set(registry, save_variables, reset=True):
+        failures.append("a second RESET=1 still changed values")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the zmod settings registry and check ZMOD_SET against a "
+                                                 "stand-in save_variables.")
+    default_settings = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'csv', 'zmod_settings.json')
+    parser.add_argument('--settings', default=default_settings)
+    parser.add_argument('--variables', help="variables.cfg to start from (it is not modified)")
+    args = parser.parse_args()
+
+    with open(args.settings, 'r', encoding='utf-8') as f:
+        count = len(json.load(f)['Settings'])
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='zmod_settings_') as work_dir:
+        for is_ad5x in (False, True):
+            for is_native_screen in (True, False):
+                start = time.monotonic()
+                registry = compile_registry(args.settings, is_ad5x, is_native_screen)
+                elapsed = time.monotonic() - start
+
+                filename = os.path.join(work_dir, 'variables.cfg')
+                with open(filename, 'w') as f:
+                    if args.variables:
+                        with open(args.variables, 'r') as source:
+                            f.write(source.read())
+                save_variables = StandInSaveVariables(filename)
+
+                # What get_status pays after the file was reloaded, any other read is a dict lookup.
+                start = time.monotonic()
+                registry.values(save_variables.allVariables)
+                values_time = time.monotonic() - start
+
+                variant_failures = check_registry(registry, save_variables)
+                print(f"ad5x={is_ad5x!s:5} native_screen={is_native_screen!s:5} {len(registry.settings)} of {count} "
+                      f"settings, compiled in {elapsed * 1000:.1f} ms, values in {values_time * 1e6:.0f} us, "
+                      f"{'ok' if not variant_failures else f'{len(variant_failures)} failures'}")
+                failures += [f"ad5x={is_ad5x} native_screen={is_native_screen}: {failure}"
+                             for failure in variant_failures]
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
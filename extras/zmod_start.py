@@ -0,0 +1,656 @@
+# Print start heater scheduling: both heaters reach temperature when the first phase that needs them does.
+#
+# (C) 2024-2026 ghzserg https://zmod.link/
+#
+# [zmod_start]
+# margin: 10
+#   Seconds a heater is planned to be ready before it is needed.
+# timeline_file:
+#   Where the recorded print starts are kept. Default: zmod_start.json next to the save_variables file.
+# recordings: 20
+#   How many print starts are kept. The heater model and the phase durations are fitted to them.
+# ad5x:
+# native_screen:
+#   Default: variable_ad5x of _CLIENT_VARIABLE and variable_screen of _SCREEN, as in [zmod_settings].
+#
+# ZMOD_START_HEAT BED=<temp> EXTRUDER=<temp> [FORCE_KAMP=0] [FORCE_LEVELING=0] [SKIP_LEVELING=0] [MESH=<profile>]
+#   Called by _START_PRINT before anything else. Works out the phases the print start will go through from the
+#   settings (print_leveling, use_kamp, mesh_test, clear, disable_priming, force_md5) and the START_PRINT parameters,
+#   the way _START_PRINT picks them, and starts every heater at the latest moment that still has it at temperature
+#   when the first phase needing heat begins. The plan is redone every second from the live temperatures.
+# ZMOD_START_PHASE NAME=<phase>
+#   Marks the start of a phase. A heater the phase needs that is not on yet is switched on there and then, so a wrong
+#   plan can only cost the time the macros took before.
+# ZMOD_START_DONE
+#   The first layer starts. Stops the plan and records the timeline.
+#
+# Before, _START_PRINT started the bed after the MD5 check and every phase that needs heat waited for the bed and
+# only then heated the nozzle (_ORIG_CLEAR_NOZZLE and _WAIT_TEMP on the FF5M, _WAIT_TEMP on the AD5X from 20 degrees
+# below the bed temperature). The nozzle takes a minute and a half to heat, all of it added to every print start.
+#
+# Heaters follow a first order model: at full power the temperature approaches t_max with the time constant tau,
+#   T(t) = t_max - (t_max - T0) * exp(-t / tau),
+# so reaching the target from T0 takes tau * ln((t_max - T0) / (t_max - target)). tau and t_max are fitted to the
+# recorded heat-ups (dT/dt is linear in T), the phase durations are the median of the recorded ones without the time
+# spent waiting for heat.
+#
+# The simulator does not depend on Klipper:
+#   python3 zmod_start.py [--bed 80] [--extruder 245] [--use-kamp 1] [--clear LINE_PURGE] [--mesh-test 1] [--ad5x]
+# prints the timeline of a print start the way the macros ran it before and the way this module schedules it, and
+#   python3 zmod_start.py --timeline zmod_start.json
+# replays recorded print starts. --record writes synthetic recordings in the same format.
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+
+TIMELINE_VERSION = 1
+TIMELINE_NAME = 'zmod_start.json'
+DEFAULT_MARGIN = 10.
+DEFAULT_RECORDINGS = 20
+TICK = 1.
+SAMPLE_INTERVAL = 2.
+# A plan still running after this long is given up.
+MAX_PLAN_TIME = 3600.
+AMBIENT = 25.
+
+# The ranges TEMPERATURE_WAIT in _WAIT_TEMP accepts.
+READY_BELOW = {'heater_bed': 3., 'extruder': 2.}
+# Heat-ups below target - FIT_MARGIN run at full power, the rest is the PID settling.
+FIT_MARGIN = 5.
+MIN_FIT_SAMPLES = 5
+
+# heater: (tau, t_max, cooling tau), seconds and degrees, used until there are recordings to fit them to.
+DEFAULT_MODELS = {
+    'heater_bed': (600., 140., 1500.),
+    'extruder': (110., 400., 180.)
+}
+
+# Phase work in seconds, without waiting for heat, used until there are recordings.
+DEFAULT_DURATIONS = {
+    'md5': 4.,
+    'home': 25.,
+    'kamp': 120.,
+    'full_mesh': 420.,
+    'wait': 3.,
+    'clear_nozzle': 45.,
+    'mesh_test': 40.,
+    'purge': 25.
+}
+PURGE_DURATIONS = {'LINE_PURGE': 25., 'CLEAR_TRAP': 45.}
+DEFAULT_CLEAR_DURATION = 60.
+
+# What a phase needs at temperature before its work can start. KAMP, the full mesh and the mesh test start with
+# _ORIG_CLEAR_NOZZLE, which heats both.
+PHASE_HEATERS = {
+    'md5': (),
+    'home': (),
+    'kamp': ('heater_bed', 'extruder'),
+    'full_mesh': ('heater_bed', 'extruder'),
+    'wait': ('heater_bed', 'extruder'),
+    'clear_nozzle': ('extruder',),
+    'mesh_test': ('heater_bed', 'extruder'),
+    'purge': ('heater_bed', 'extruder')
+}
+
+# The defaults _START_PRINT reads the settings with.
+START_SETTINGS = {
+    'force_md5': 1,
+    'print_leveling': 0,
+    'use_kamp': 0,
+    'mesh_test': 1,
+    'clear': 'LINE_PURGE',
+    'disable_priming': 0
+}
+
+class HeaterModel:
+    __slots__ = ('tau', 't_max', 'cool_tau')
+
+    def __init__(self, tau, t_max, cool_tau):
+        self.tau = tau
+        self.t_max = t_max
+        self.cool_tau = cool_tau
+
+    def time_to(self, temp, target):
+        # Seconds from temp to target at full power.
+        if target <= temp:
+            return 0.
+        if target >= self.t_max:
+            return float('inf')
+        return self.tau * math.log((self.t_max - temp) / (self.t_max - target))
+
+    def advance(self, temp, target, dt):
+        if target > temp:
+            return min(self.t_max - (self.t_max - temp) * math.exp(-dt / self.tau), target)
+        if target > 0.:
+            return target
+        return AMBIENT + (temp - AMBIENT) * math.exp(-dt / self.cool_tau)
+
+def fit_heater(samples, default):
+    # samples: [(time, temp, target)]. Least squares of dT/dt = (t_max - T) / tau over the full power heat-ups.
+    points = []
+    for (t1, temp1, target1), (t2, temp2, target2) in zip(samples, samples[1:]):
+        if t2 <= t1 or target1 <= 0. or target1 != target2 or temp2 > target1 - FIT_MARGIN or temp2 <= temp1:
+            continue
+        points.append(((temp1 + temp2) / 2., (temp2 - temp1) / (t2 - t1)))
+    if len(points) < MIN_FIT_SAMPLES:
+        return default
+    mean_temp = sum(temp for temp, rate in points) / len(points)
+    mean_rate = sum(rate for temp, rate in points) / len(points)
+    spread = sum((temp - mean_temp) ** 2 for temp, rate in points)
+    if spread <= 0.:
+        return default
+    slope = sum((temp - mean_temp) * (rate - mean_rate) for temp, rate in points) / spread
+    if slope >= 0.:
+        return default
+    intercept = mean_rate - slope * mean_temp
+    return HeaterModel(-1. / slope, -intercept / slope, default.cool_tau)
+
+def phase_duration(name, clear):
+    if name == 'purge':
+        return PURGE_DURATIONS.get(clear, DEFAULT_CLEAR_DURATION)
+    return DEFAULT_DURATIONS[name]
+
+def start_phases(settings, force_kamp=False, force_leveling=False, skip_leveling=False, mesh_loaded=True,
+                 check_md5=False, is_ad5x=False, native_screen=True):
+    # The phases _START_PRINT runs, in order, for the settings ({name: value}, START_SETTINGS for missing ones).
+    value = lambda name: settings.get(name, START_SETTINGS[name])
+    print_leveling = value('print_leveling')
+    use_kamp = value('use_kamp')
+    phases = []
+    if value('force_md5') == 1 and check_md5:
+        phases.append('md5')
+    phases.append('home')
+    if print_leveling == 1:
+        if not native_screen:
+            phases.append('kamp' if use_kamp == 1 else 'full_mesh')
+    elif not skip_leveling:
+        if force_kamp:
+            phases.append('kamp')
+        elif not mesh_loaded or force_leveling:
+            phases.append('full_mesh')
+    phases.append('wait')
+    kamp_used = (print_leveling == 0 and force_kamp) or (print_leveling == 1 and not native_screen and use_kamp == 1)
+    if is_ad5x and not kamp_used:
+        phases.append('clear_nozzle')
+    if not (value('mesh_test') == 0 or force_kamp or print_leveling == 1 or force_leveling):
+        phases.append('mesh_test')
+    if value('disable_priming') == 0:
+        phases.append('purge')
+    return phases
+
+def plan_starts(models, temps, targets, durations_ahead, phases_ahead, margin):
+    # Seconds from now each heater has to be switched on, 0 for at once. durations_ahead[i] is the work of
+    # phases_ahead[i] still to do. A phase waits for the slowest heater it needs, which delays every phase after it.
+    elapsed = 0.
+    delay = 0.
+    deadlines = {}
+    for name, duration in zip(phases_ahead, durations_ahead):
+        new = [heater for heater in PHASE_HEATERS[name]
+               if heater not in deadlines and targets.get(heater, 0.) > 0.]
+        if new:
+            now = elapsed + delay
+            ready = max([now] + [models[heater].time_to(temps[heater], targets[heater]) for heater in new])
+            delay += ready - now
+            for heater in new:
+                deadlines[heater] = ready
+        elapsed += duration
+    return dict((heater, max(0., deadline - models[heater].time_to(temps[heater], targets[heater]) - margin))
+                for heater, deadline in deadlines.items())
+
+class Simulation:
+    # A print start on the heater model. policy is 'serial' (the macros without this module) or 'scheduled'.
+    def __init__(self, models, phases, durations, targets, policy, is_ad5x=False, margin=DEFAULT_MARGIN, temps=None,
+                 jitter=None):
+        self.models = models
+        self.phases = phases
+        self.durations = durations
+        self.targets = targets
+        self.policy = policy
+        self.is_ad5x = is_ad5x
+        self.margin = margin
+        self.temps = dict(temps) if temps else dict((heater, AMBIENT) for heater in targets)
+        self.jitter = jitter
+
+    def run(self):
+        # Returns (time to the first layer, [(phase, start, waited)], samples).
+        time = 0.
+        set_to = dict((heater, 0.) for heater in self.targets)
+        phase_log = []
+        samples = []
+        dt = 0.5
+        index = 0
+        done = 0.
+        waited = 0.
+        started = False
+        next_sample = 0.
+        while index < len(self.phases):
+            name = self.phases[index]
+            if not started:
+                phase_log.append([name, time, 0.])
+                started = True
+                done = 0.
+                waited = 0.
+            self._control(set_to, index, done, time)
+            needed = PHASE_HEATERS[name]
+            if done == 0. and any(self.targets[heater] > 0. and self.temps[heater] < self.targets[heater] -
+                                  READY_BELOW[heater] for heater in needed):
+                waited += dt
+            else:
+                done += dt
+            for heater in self.temps:
+                self.temps[heater] = self.models[heater].advance(self.temps[heater], set_to[heater], dt)
+            time += dt
+            if time >= next_sample:
+                samples.append([round(time, 1)] + [round(value, 2) for heater in sorted(self.temps)
+                                                    for value in (self.temps[heater], set_to[heater])])
+                next_sample += SAMPLE_INTERVAL
+            if done >= self.durations[index]:
+                phase_log[-1][2] = waited
+                index += 1
+                started = False
+        return time, phase_log, samples
+
+    def _control(self, set_to, index, done, time):
+        name = self.phases[index]
+        needed = PHASE_HEATERS[name]
+        if self.policy == 'scheduled':
+            durations_ahead = [max(self.durations[index] - done, 0.)] + self.durations[index + 1:]
+            starts = plan_starts(self.models, self.temps, self.targets, durations_ahead, self.phases[index:],
+                                 self.margin)
+            for heater, start in starts.items():
+                if start <= 0.:
+                    set_to[heater] = self.targets[heater]
+            for heater in needed:
+                set_to[heater] = self.targets[heater]
+            return
+
+        # M140 right after the MD5 check.
+        if name != 'md5':
+            set_to['heater_bed'] = self.targets['heater_bed']
+        if 'extruder' in needed:
+            bed = self.temps['heater_bed']
+            bed_target = self.targets['heater_bed']
+            if self.is_ad5x and name != 'wait':
+                # The AD5X _ORIG_CLEAR_NOZZLE sets both at once.
+                set_to['extruder'] = self.targets['extruder']
+            elif self.is_ad5x:
+                if bed >= bed_target - 20.:
+                    set_to['extruder'] = self.targets['extruder']
+            elif bed >= bed_target - READY_BELOW['heater_bed']:
+                set_to['extruder'] = self.targets['extruder']
+
+def load_timeline(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version', None) == TIMELINE_VERSION:
+            return data.get('recordings', [])
+    except (OSError, ValueError):
+        pass
+    return []
+
+def save_timeline(path, recordings):
+    part_path = f"{path}.{os.getpid()}.part"
+    with open(part_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': TIMELINE_VERSION, 'recordings': recordings}, f, separators=(',', ':'))
+    os.replace(part_path, path)
+
+def _heater_samples(recording, heater):
+    # samples hold [time, <temp, target> for every heater in sorted order]
+    column = 1 + 2 * sorted(recording['heaters']).index(heater)
+    return [(sample[0], sample[column], sample[column + 1]) for sample in recording['samples']]
+
+def fit_models(recordings):
+    models = {}
+    for heater, (tau, t_max, cool_tau) in DEFAULT_MODELS.items():
+        default = HeaterModel(tau, t_max, cool_tau)
+        fitted = []
+        for recording in recordings:
+            if heater in recording.get('heaters', []):
+                model = fit_heater(_heater_samples(recording, heater), default)
+                if model is not default:
+                    fitted.append(model)
+        if fitted:
+            models[heater] = HeaterModel(statistics.median(model.tau for model in fitted),
+                                         statistics.median(model.t_max for model in fitted), cool_tau)
+        else:
+            models[heater] = default
+    return models
+
+def fit_durations(recordings):
+    # {phase: median work seconds}, phases never recorded keep their defaults.
+    measured = {}
+    for recording in recordings:
+        phases = recording['phases']
+        for position, (name, start, waited) in enumerate(phases):
+            end = phases[position + 1][1] if position + 1 < len(phases) else recording['end']
+            measured.setdefault(name, []).append(max(end - start - waited, 0.))
+    return dict((name, statistics.median(values)) for name, values in measured.items())
+
+def _waited(samples_since, needed, targets):
+    # Seconds of samples_since ([(dt, {heater: temp})]) in which a needed heater was not at temperature.
+    waited = 0.
+    for dt, temps in samples_since:
+        if any(targets.get(heater, 0.) > 0. and temps[heater] < targets[heater] - READY_BELOW[heater]
+               for heater in needed):
+            waited += dt
+    return waited
+
+def _macro_variable(config, section, name, default):
+    if not config.has_section(section):
+        return default
+    return config.getsection(section).getboolean('variable_' + name, default)
+
+class ZmodStart:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.margin = config.getfloat('margin', DEFAULT_MARGIN, minval=0.)
+        self.max_recordings = config.getint('recordings', DEFAULT_RECORDINGS, minval=1)
+        self.timeline_file = config.get('timeline_file', None)
+        self.is_ad5x = config.getboolean('ad5x', None)
+        if self.is_ad5x is None:
+            self.is_ad5x = _macro_variable(config, 'gcode_macro _CLIENT_VARIABLE', 'ad5x', False)
+        self.native_screen = config.getboolean('native_screen', None)
+        if self.native_screen is None:
+            self.native_screen = _macro_variable(config, 'gcode_macro _SCREEN', 'screen', True)
+        self.timer = None
+        self.reset()
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('ZMOD_START_HEAT', self.cmd_ZMOD_START_HEAT,
+                               desc="Plan the print start heating and start it")
+        gcode.register_command('ZMOD_START_PHASE', self.cmd_ZMOD_START_PHASE, desc="Mark a print start phase")
+        gcode.register_command('ZMOD_START_DONE', self.cmd_ZMOD_START_DONE, desc="End the print start plan")
+        self.printer.register_event_handler('klippy:shutdown', self._stop)
+
+    def reset(self):
+        self.phases = []
+        self.durations = []
+        self.phase_index = -1
+        self.phase_start = 0.
+        self.targets = {}
+        self.switched_on = set()
+        self.start_time = None
+        self.recording = None
+        self.last_sample = None
+        # [(seconds, {heater: temp})] since the phase started
+        self.waiting = []
+        self.plan = {}
+        self.print_state = None
+
+    def _settings(self):
+        zmod_settings = self.printer.lookup_object('zmod_settings', None)
+        if zmod_settings is not None:
+            return zmod_settings.get_status(self.reactor.monotonic())
+        save_variables = self.printer.lookup_object('save_variables', None)
+        return dict(save_variables.allVariables) if save_variables is not None else {}
+
+    def _timeline_path(self):
+        if self.timeline_file:
+            return self.timeline_file
+        save_variables = self.printer.lookup_object('save_variables', None)
+        if save_variables is None:
+            return None
+        return os.path.join(os.path.dirname(save_variables.filename), TIMELINE_NAME)
+
+    def _heaters(self):
+        pheaters = self.printer.lookup_object('heaters')
+        return dict((name, pheaters.lookup_heater(name)) for name in self.targets)
+
+    def _switch_on(self, name, eventtime):
+        if name in self.switched_on:
+            return
+        self.switched_on.add(name)
+        heater = self._heaters()[name]
+        try:
+            heater.set_temp(self.targets[name])
+        except self.printer.command_error as e:
+            logging.info("zmod_start: cannot heat %s: %s", name, e)
+            return
+        if self.recording is not None:
+            self.recording['switched_on'][name] = round(eventtime - self.start_time, 1)
+
+    def cmd_ZMOD_START_HEAT(self, gcmd):
+        self._stop()
+        self.reset()
+        eventtime = self.reactor.monotonic()
+        self.targets = {'heater_bed': gcmd.get_float('BED', 0., minval=0.),
+                        'extruder': gcmd.get_float('EXTRUDER', 0., minval=0.)}
+        bed_mesh = self.printer.lookup_object('bed_mesh', None)
+        mesh = gcmd.get('MESH', '')
+        mesh_loaded = bool(mesh) or (bed_mesh is not None and bool(bed_mesh.get_status(eventtime)['profile_name']))
+        settings = self._settings()
+        save_variables = self.printer.lookup_object('save_variables', None)
+        variables = save_variables.allVariables if save_variables is not None else {}
+        check_md5 = variables.get('check_md5', 0) == 0
+        clear = str(settings.get('clear', START_SETTINGS['clear']))
+        self.phases = start_phases(settings, gcmd.get_int('FORCE_KAMP', 0) == 1, gcmd.get_int('FORCE_LEVELING', 0) == 1,
+                                   gcmd.get_int('SKIP_LEVELING', 0) == 1, mesh_loaded, check_md5, self.is_ad5x,
+                                   self.native_screen)
+
+        path = self._timeline_path()
+        recordings = load_timeline(path) if path else []
+        self.models = fit_models(recordings)
+        measured = fit_durations(recordings)
+        self.durations = [measured.get(name, phase_duration(name, clear)) for name in self.phases]
+
+        print_stats = self.printer.lookup_object('print_stats', None)
+        self.print_state = print_stats.get_status(eventtime)['state'] if print_stats is not None else None
+        self.start_time = eventtime
+        self.recording = {'heaters': sorted(self.targets), 'targets': dict(self.targets), 'phases': [], 'samples': [],
+                          'switched_on': {}, 'policy': 'scheduled', 'end': None}
+        self.timer = self.reactor.register_timer(self._tick, self.reactor.NOW)
+        gcmd.respond_info("zmod_start: %s" % (' > '.join(self.phases),))
+
+    def cmd_ZMOD_START_PHASE(self, gcmd):
+        if self.start_time is None:
+            return
+        name = gcmd.get('NAME')
+        if name not in PHASE_HEATERS:
+            raise gcmd.error("Unknown phase '%s', known: %s" % (name, ', '.join(PHASE_HEATERS)))
+        eventtime = self.reactor.monotonic()
+        self._close_phase(eventtime)
+        if name in self.phases[self.phase_index + 1:]:
+            self.phase_index = self.phases.index(name, self.phase_index + 1)
+        self.phase_start = eventtime
+        self.recording['phases'].append([name, round(eventtime - self.start_time, 1), 0.])
+        self.waiting = []
+        for heater in PHASE_HEATERS[name]:
+            if self.targets.get(heater, 0.) > 0.:
+                self._switch_on(heater, eventtime)
+
+    def _close_phase(self, eventtime):
+        if not self.recording['phases']:
+            return
+        phase = self.recording['phases'][-1]
+        phase[2] = round(_waited(self.waiting, PHASE_HEATERS[phase[0]], self.targets), 1)
+
+    def cmd_ZMOD_START_DONE(self, gcmd):
+        if self.start_time is None:
+            return
+        eventtime = self.reactor.monotonic()
+        self._close_phase(eventtime)
+        self.recording['end'] = round(eventtime - self.start_time, 1)
+        self._stop()
+        path = self._timeline_path()
+        if path:
+            recordings = load_timeline(path) + [self.recording]
+            try:
+                save_timeline(path, recordings[-self.max_recordings:])
+            except OSError:
+                logging.exception("zmod_start: unable to save %s", path)
+        gcmd.respond_info("zmod_start: %.0f s to the first layer" % (self.recording['end'],))
+        self.reset()
+
+    def _stop(self):
+        if self.timer is not None:
+            self.reactor.unregister_timer(self.timer)
+            self.timer = None
+
+    def _tick(self, eventtime):
+        if self.start_time is None or eventtime - self.start_time > MAX_PLAN_TIME:
+            self.timer = None
+            return self.reactor.NEVER
+        # Cancelled or failed while the plan runs: no heater may be switched on after that.
+        print_stats = self.printer.lookup_object('print_stats', None)
+        if print_stats is not None and print_stats.get_status(eventtime)['state'] != self.print_state:
+            self.start_time = None
+            self.timer = None
+            return self.reactor.NEVER
+        heaters = self._heaters()
+        temps = {}
+        for name, heater in heaters.items():
+            temp, target = heater.get_temp(eventtime)
+            # Switched off by someone else (CANCEL_PRINT, an error): the plan is over.
+            if name in self.switched_on and target <= 0.:
+                self.start_time = None
+                self.timer = None
+                return self.reactor.NEVER
+            temps[name] = temp
+        if self.last_sample is not None:
+            self.waiting.append((eventtime - self.last_sample, temps))
+        if self.last_sample is None or eventtime - self.last_sample >= SAMPLE_INTERVAL:
+            self.recording['samples'].append(
+                [round(eventtime - self.start_time, 1)] + [round(value, 2) for name in sorted(heaters)
+                                                           for value in heaters[name].get_temp(eventtime)])
+        self.last_sample = eventtime
+
+        index = max(self.phase_index, 0)
+        done = eventtime - self.phase_start if self.phase_index >= 0 else 0.
+        durations_ahead = [max(self.durations[index] - done, 0.)] + self.durations[index + 1:]
+        self.plan = plan_starts(self.models, temps, self.targets, durations_ahead, self.phases[index:], self.margin)
+        for name, start in self.plan.items():
+            if start <= 0.:
+                self._switch_on(name, eventtime)
+        return eventtime + TICK
+
+    def get_status(self, eventtime):
+        phase = self.phases[self.phase_index] if 0 <= self.phase_index < len(self.phases) else ''
+        return {'active': self.start_time is not None, 'phases': list(self.phases), 'phase': phase,
+                'plan': dict((name, round(start, 1)) for name, start in self.plan.items()),
+                'switched_on': sorted(self.switched_on)}
+
+def load_config(config):
+    return ZmodStart(config)
+
+def simulate(models, phases, durations, targets, is_ad5x, margin, temps=None):
+    results = {}
+    for policy in ('serial', 'scheduled'):
+        results[policy] = Simulation(models, phases, durations, targets, policy, is_ad5x, margin, temps).run()
+    return results
+
+def print_timeline(policy, result):
+    total, phase_log, samples = result
+    print(f"  {policy:10} {total:6.0f} s to the first layer")
+    for name, start, waited in phase_log:
+        print(f"      {start:6.0f} s  {name:12} waited {waited:5.0f} s")
+
+def record(path, count, args, models):
+    # Synthetic recordings of the serial macros, with some noise on the phase durations and the start temperature.
+    rng = random.Random(args.seed)
+    recordings = []
+    for _ in range(count):
+        settings = {'use_kamp': rng.choice((0, 1)), 'mesh_test': rng.choice((0, 1, 3)), 'print_leveling': 0,
+                    'clear': rng.choice(('LINE_PURGE', '_CLEAR1'))}
+        force_kamp = settings['use_kamp'] == 1
+        phases = start_phases(settings, force_kamp, False, False, True, True, args.ad5x, args.native_screen)
+        durations = [phase_duration(name, settings['clear']) * rng.uniform(0.85, 1.15) for name in phases]
+        targets = {'heater_bed': rng.choice((60., 80., 100.)), 'extruder': rng.choice((220., 245., 260.))}
+        temps = {'heater_bed': rng.uniform(AMBIENT, 45.), 'extruder': rng.uniform(AMBIENT, 60.)}
+        total, phase_log, samples = Simulation(models, phases, durations, targets, 'serial', args.ad5x, args.margin,
+                                               temps).run()
+        recordings.append({'heaters': sorted(targets), 'targets': targets, 'phases': phase_log, 'samples': samples,
+                           'switched_on': {}, 'policy': 'serial', 'end': round(total, 1), 'temps': temps})
+    save_timeline(path, recordings)
+    print(f"{path}: {count} recordings")
+
+def replay(path, args):
+    recordings = load_timeline(path)
+    if not recordings:
+        print(f"{path}: no recordings", file=sys.stderr)
+        sys.exit(1)
+    models = fit_models(recordings)
+    measured = fit_durations(recordings)
+    for heater, model in sorted(models.items()):
+        print(f"{heater:10} tau {model.tau:6.1f} s  t_max {model.t_max:6.1f}")
+    print(f"phases     {', '.join(f'{name} {seconds:.0f} s' for name, seconds in sorted(measured.items()))}")
+
+    totals = {'recorded': 0., 'serial': 0., 'scheduled': 0.}
+    for number, recording in enumerate(recordings, 1):
+        phases = [name for name, start, waited in recording['phases']]
+        durations = []
+        for position, (name, start, waited) in enumerate(recording['phases']):
+            end = recording['phases'][position + 1][1] if position + 1 < len(phases) else recording['end']
+            durations.append(max(end - start - waited, 0.))
+        first = recording['samples'][0] if recording['samples'] else None
+        temps = recording.get('temps', None)
+        if temps is None and first is not None:
+            temps = dict((heater, first[1 + 2 * index]) for index, heater in enumerate(recording['heaters']))
+        results = simulate(models, phases, durations, recording['targets'], args.ad5x, args.margin, temps)
+        serial, scheduled = results['serial'][0], results['scheduled'][0]
+        totals['recorded'] += recording['end']
+        totals['serial'] += serial
+        totals['scheduled'] += scheduled
+        print(f"{number:3} {recording['policy']:9} {recording['end']:6.0f} s recorded, {serial:6.0f} s serial, "
+              f"{scheduled:6.0f} s scheduled  {' > '.join(phases)}")
+    count = len(recordings)
+    print(f"mean      {totals['recorded'] / count:6.0f} s recorded, {totals['serial'] / count:6.0f} s serial, "
+          f"{totals['scheduled'] / count:6.0f} s scheduled, "
+          f"{(totals['serial'] - totals['scheduled']) / count:.0f} s saved per print start")
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the print start with and without heater scheduling.")
+    parser.add_argument('--bed', type=float, default=80.)
+    parser.add_argument('--extruder', type=float, default=245.)
+    parser.add_argument('--bed-start', type=float, default=AMBIENT, help="bed temperature at print start")
+    parser.add_argument('--extruder-start', type=float, default=AMBIENT)
+    parser.add_argument('--print-leveling', type=int, default=0)
+    parser.add_argument('--use-kamp', type=int, default=0)
+    parser.add_argument('--mesh-test', type=int, default=1)
+    parser.add_argument('--clear', default='LINE_PURGE')
+    parser.add_argument('--disable-priming', type=int, default=0)
+    parser.add_argument('--force-kamp', action='store_true')
+    parser.add_argument('--no-mesh', action='store_true', help="no bed mesh loaded, a full mesh is built")
+    parser.add_argument('--ad5x', action='store_true')
+    parser.add_argument('--native-screen', type=int, default=1)
+    parser.add_argument('--margin', type=float, default=DEFAULT_MARGIN)
+    parser.add_argument('--timeline', help="replay the recordings of this file")
+    parser.add_argument('--record', metavar='FILE', help="write synthetic recordings of the serial macros to FILE")
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    args.native_screen = args.native_screen == 1
+
+    models = dict((heater, HeaterModel(*values)) for heater, values in DEFAULT_MODELS.items())
+    if args.record:
+        record(args.record, max(args.count, 1), args, models)
+        return
+    if args.timeline:
+        replay(args.timeline, args)
+        return
+
+    settings = {'print_leveling': args.print_leveling, 'use_kamp': args.use_kamp, 'mesh_test': args.mesh_test,
+                'clear': args.clear, 'disable_priming': args.disable_priming}
+    phases = start_phases(settings, args.force_kamp, False, False, not args.no_mesh, True, args.ad5x,
+                          args.native_screen)
+    durations = [phase_duration(name, args.clear) for name in phases]
+    targets = {'heater_bed': args.bed, 'extruder': args.extruder}
+    temps = {'heater_bed': args.bed_start, 'extruder': args.extruder_start}
+    results = simulate(models, phases, durations, targets, args.ad5x, args.margin, temps)
+    print(f"{' > '.join(phases)}, bed {args.bed_start:.0f} -> {args.bed:.0f}, "
+          f"extruder {args.extruder_start:.0f} -> {args.extruder:.0f}")
+    for policy, result in results.items():
+        print_timeline(policy, result)
+    saved = results['serial'][0] - results['scheduled'][0]
+    print(f"  saved      {saved:6.0f} s")
+    if saved < -1.:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+# Opt-in timing of gcode_macro execution.
+#
+# (C) 2024-2026 ghzserg https://zmod.link/
+#
+# [zmod_trace]
+# capacity: 2000
+#   Records kept, the oldest are dropped first.
+# dump_file: /opt/config/mod_data/zmod_trace.json
+# macros: *
+#   Comma separated fnmatch patterns of the macros ZMOD_TRACE ENABLE=1 traces when no MACROS is given.
+#
+# ZMOD_TRACE [ENABLE=0|1] [MACROS=<pattern,...>] [RESET=1] [DUMP=1] [TOP=<count>]
+#   ENABLE=1 wraps every macro matching MACROS, ENABLE=0 puts the original commands back. Without ENABLE it reports
+#   the TOP (default 10) macros by self time, the time spent in a macro minus the time spent in the macros it called.
+#   DUMP=1 writes every record to dump_file, RESET=1 drops them.
+#
+# ZMOD_TRACE_POINT NAME=<name> [END=1]
+#   Starts or ends a span inside the running macro, recorded as <macro>:<name>. A no-op while tracing is off.
+#   make_config_macros.py --trace puts these around the generated code of GET_ZMOD_DATA, SAVE_ZMOD_DATA, _RESET_ZMOD
+#   and _GLOBAL.
+#
+# For every call of a traced macro one record holds the time its template took to render, the wall time of the whole
+# call, nested macros included, its self time, the number of commands the template emitted and how deep the call was
+# nested. Nothing is wrapped until ENABLE=1, so the module costs nothing while it is not tracing.
+#
+# MacroTracer does not depend on Klipper, only on a dispatcher with register_command() and macros with a template,
+# so it can be run from a shell against a stand-in dispatcher, and a dump can be read back:
+#   python3 zmod_trace.py --stand-in                  (traces a few stand-in macros and prints the report)
+#   python3 zmod_trace.py zmod_trace.json [--top N] [--sort self|wall|render|calls|commands]
+
+import argparse
+import collections
+import fnmatch
+import json
+import logging
+import os
+import sys
+import time
+
+DEFAULT_CAPACITY = 2000
+DEFAULT_DUMP_FILE = '/opt/config/mod_data/zmod_trace.json'
+DEFAULT_TOP = 10
+DUMP_VERSION = 1
+
+SORT_KEYS = ('self', 'wall', 'render', 'calls', 'commands')
+
+def count_commands(script):
+    # What run_script() would dispatch: every line that is not empty once its comment is gone.
+    count = 0
+    for line in script.split('\n'):
+        if line.split(';', 1)[0].strip():
+            count += 1
+    return count
+
+class Frame:
+    def __init__(self, name, depth, start):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.render = 0.
+        self.commands = 0
+        self.child_wall = 0.
+
+class MacroTracer:
+    def __init__(self, gcode, capacity=DEFAULT_CAPACITY, clock=time.perf_counter):
+        self.gcode = gcode
+        self.clock = clock
+        self.records = collections.deque(maxlen=capacity)
+        self.stack = []
+        self.spans = {}
+        self.wrapped = {}
+        self.seq = 0
+        self.origin = clock()
+
+    def enabled(self):
+        return bool(self.wrapped)
+
+    def install(self, macros, patterns=('*',)):
+        # macros: [(command name, macro)]. Returns how many were wrapped.
+        if not self.wrapped:
+            self.origin = self.clock()
+        for name, macro in macros:
+            if name in self.wrapped or not any(fnmatch.fnmatchcase(name, pattern.upper()) for pattern in patterns):
+                continue
+            help_texts = getattr(self.gcode, 'gcode_help', {})
+            desc = help_texts.get(name, None)
+            original = self.gcode.register_command(name, None)
+            if original is None:
+                continue
+            self.gcode.register_command(name, self._wrap_command(name, original), desc=desc)
+            macro.template.render = self._wrap_render(name, macro.template.render)
+            self.wrapped[name] = (macro, original, desc)
+        return len(self.wrapped)
+
+    def uninstall(self):
+        for name, (macro, original, desc) in self.wrapped.items():
+            self.gcode.register_command(name, None)
+            self.gcode.register_command(name, original, desc=desc)
+            # The instance attribute shadowed the class method.
+            del macro.template.render
+        # A traced call still running (ZMOD_TRACE ENABLE=0 from inside a macro) records itself when it returns.
+        self.wrapped = {}
+        self.spans = {}
+
+    def reset(self):
+        self.records.clear()
+        self.origin = self.clock()
+
+    def _wrap_command(self, name, original):
+        def traced(gcmd):
+            frame = Frame(name, len(self.stack), self.clock())
+            self.stack.append(frame)
+            try:
+                return original(gcmd)
+            finally:
+                self.stack.pop()
+                self._record_frame(frame)
+        return traced
+
+    def _wrap_render(self, name, render):
+        def traced_render(*args, **kwargs):
+            start = self.clock()
+            script = render(*args, **kwargs)
+            # Only the render of the macro's own call, not a render from somewhere else (display, other modules).
+            if self.stack and self.stack[-1].name == name:
+                frame = self.stack[-1]
+                frame.render += self.clock() - start
+                frame.commands += count_commands(script)
+            return script
+        return traced_render
+
+    def _record_frame(self, frame):
+        wall = self.clock() - frame.start
+        if self.stack:
+            self.stack[-1].child_wall += wall
+        self._record('macro', frame.name, frame.depth, frame.start, wall, wall - frame.child_wall, frame.render,
+                     frame.commands)
+
+    def _record(self, kind, name, depth, start, wall, self_time, render, commands):
+        self.seq += 1
+        self.records.append({'seq': self.seq, 'kind': kind, 'name': name, 'depth': depth,
+                             'start': round(start - self.origin, 6), 'wall': wall, 'self': self_time,
+                             'render': render, 'commands': commands})
+
+    def point(self, name, end=False):
+        if not self.wrapped:
+            return
+        frame = self.stack[-1] if self.stack else Frame('', 0, 0.)
+        key = f"{frame.name}:{name}"
+        if not end:
+            self.spans.setdefault(key, []).append((self.clock(), frame.child_wall))
+            return
+        starts = self.spans.get(key, None)
+        if not starts:
+            return
+        start, child_wall = starts.pop()
+        wall = self.clock() - start
+        # The span's self time leaves out the macros it called, like a macro's.
+        self._record('span', key, len(self.stack), start, wall, wall - (frame.child_wall - child_wall), 0., 0)
+
+class ZmodTrace:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.dump_file = config.get('dump_file', DEFAULT_DUMP_FILE)
+        self.patterns = [pattern.strip() for pattern in config.get('macros', '*').split(',') if pattern.strip()]
+        self.gcode = self.printer.lookup_object('gcode')
+        self.tracer = MacroTracer(self.gcode, config.getint('capacity', DEFAULT_CAPACITY, minval=10))
+        self.gcode.register_command('ZMOD_TRACE', self.cmd_ZMOD_TRACE, desc="Trace how long macros take")
+        self.gcode.register_command('ZMOD_TRACE_POINT', self.cmd_ZMOD_TRACE_POINT,
+                                    desc="Start or end a traced span inside a macro")
+
+    def _macros(self):
+        return [(macro.alias, macro) for _, macro in self.printer.lookup_objects('gcode_macro')]
+
+    def cmd_ZMOD_TRACE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        if gcmd.get_int('RESET', 0):
+            self.tracer.reset()
+            gcmd.respond_info("zmod_trace: records dropped")
+        if enable == 1:
+            patterns = [pattern.strip() for pattern in gcmd.get('MACROS', ','.join(self.patterns)).split(',')
+                        if pattern.strip()]
+            count = self.tracer.install(self._macros(), patterns)
+            gcmd.respond_info("zmod_trace: tracing %d macros" % (count,))
+        elif enable == 0:
+            self.tracer.uninstall()
+            gcmd.respond_info("zmod_trace: off")
+        if gcmd.get_int('DUMP', 0):
+            count = dump(self.tracer.records, self.dump_file)
+            gcmd.respond_info("zmod_trace: %d records written to %s" % (count, self.dump_file))
+        if enable is None and not gcmd.get_int('RESET', 0) and not gcmd.get_int('DUMP', 0):
+            gcmd.respond_info('\n'.join(report(self.tracer.records, gcmd.get_int('TOP', DEFAULT_TOP, minval=1))))
+
+    def cmd_ZMOD_TRACE_POINT(self, gcmd):
+        self.tracer.point(gcmd.get('NAME'), bool(gcmd.get_int('END', 0)))
+
+    def get_status(self, eventtime):
+        return {'enabled': self.tracer.enabled(), 'macros': len(self.tracer.wrapped),
+                'records': len(self.tracer.records)}
+
+def load_config(config):
+    return ZmodTrace(config)
+
+def dump(records, filename):
+    records = list(records)
+    part_path = f"{filename}.{os.getpid()}.part"
+    try:
+        with open(part_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': DUMP_VERSION, 'records': records}, f, separators=(',', ':'))
+        os.replace(part_path, filename)
+    except OSError:
+        logging.exception("zmod_trace: unable to write %s", filename)
+        raise
+    return len(records)
+
+def load_dump(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version', None) != DUMP_VERSION:
+        raise ValueError(f"{filename}: unsupported dump version {data.get('version', None)}")
+    return data['records']
+
+def summarize(records):
+    # name -> totals over every call
+    totals = collections.OrderedDict()
+    for record in records:
+        entry = totals.setdefault(record['name'], {'calls': 0, 'wall': 0., 'self': 0., 'render': 0., 'commands': 0,
+                                                   'max_wall': 0., 'max_depth': 0})
+        entry['calls'] += 1
+        entry['wall'] += record['wall']
+        entry['self'] += record['self']
+        entry['render'] += record['render']
+        entry['commands'] += record['commands']
+        entry['max_wall'] = max(entry['max_wall'], record['wall'])
+        entry['max_depth'] = max(entry['max_depth'], record['depth'])
+    return totals
+
+def report(records, top=DEFAULT_TOP, sort='self'):
+    totals = summarize(records)
+    if not totals:
+        return ["zmod_trace: nothing recorded"]
+    ranked = sorted(totals.items(), key=lambda item: item[1][sort], reverse=True)[:top]
+    lines = [f"{'macro':<32} {'calls':>6} {'self ms':>9} {'wall ms':>9} {'max ms':>8} {'render ms':>9} "
+             f"{'cmds':>6} {'depth':>5}"]
+    for name, entry in ranked:
+        lines.append(f"{name[:32]:<32} {entry['calls']:>6} {entry['self'] * 1000.:>9.1f} {entry['wall'] * 1000.:>9.1f} "
+                     f"{entry['max_wall'] * 1000.:>8.1f} {entry['render'] * 1000.:>9.1f} {entry['commands']:>6} "
+                     f"{entry['max_depth']:>5}")
+    return lines
+
+# A dispatcher and macros that behave like Klipper's gcode and gcode_macro for what MacroTracer touches.
+
+class StandInCommand:
+    def __init__(self, params):
+        self.params = params
+
+    def get(self, name, default=None):
+        return self.params.get(name, default)
+
+    def respond_info(self, msg):
+        print(msg)
+
+class StandInGCode:
+    def __init__(self):
+        self.handlers = {}
+        self.gcode_help = {}
+        self.dispatched = 0
+
+    def register_command(self, cmd, func, desc=None):
+        if func is None:
+            return self.handlers.pop(cmd, None)
+        if cmd in self.handlers:
+            raise ValueError(f"gcode command {cmd} already registered")
+        self.handlers[cmd] = func
+        if desc is not None:
+            self.gcode_help[cmd] = desc
+
+    def run_script_from_command(self, script):
+        for line in script.split('\n'):
+            line = line.split(';', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            params = dict(part.split('=', 1) for part in parts[1:] if '=' in part)
+            self.dispatched += 1
+            handler = self.handlers.get(parts[0].upper(), None)
+            if handler is not None:
+                handler(StandInCommand(params))
+
+class StandInTemplate:
+    def __init__(self, gcode, render):
+        self.gcode = gcode
+        self.render_script = render
+
+    def render(self, context=None):
+        return self.render_script(context or {})
+
+    def run_gcode_from_command(self, context=None):
+        self.gcode.run_script_from_command(self.render(context))
+
+class StandInMacro:
+    def __init__(self, gcode, name, render, work=0.):
+        self.alias = name
+        self.work = work
+        self.template = StandInTemplate(gcode, render)
+        gcode.register_command(name, self.cmd, desc=f"stand-in {name}")
+
+    def cmd(self, gcmd):
+        self.template.run_gcode_from_command({'params': gcmd.params})
+        if self.work:
+            time.sleep(self.work)
+
+def stand_in_macros(gcode):
+    # A print start that heats, levels and loads filament, calling into smaller macros.
+    def heat(context):
+        return '\n'.join(['M104 S220', 'M140 S60', '; wait', 'M190 S60', 'M109 S220'])
+
+    def mesh(context):
+        time.sleep(0.002)
+        return '\n'.join(['G28'] + [f"G1 X{x * 20} Y{y * 20}" for x in range(5) for y in range(5)])
+
+    def load(context):
+        return '\n'.join(['M83', 'G1 E50 F300', 'G1 E-2 F1800'])
+
+    def start(context):
+        return '\n'.join(['ZMOD_TRACE_POINT NAME=prepare', '_STAND_IN_HEAT', '_STAND_IN_MESH',
+                          'ZMOD_TRACE_POINT NAME=prepare END=1', '_STAND_IN_LOAD', '_STAND_IN_LOAD', 'G92 E0'])
+
+    return [StandInMacro(gcode, '_STAND_IN_HEAT', heat, 0.004),
+            StandInMacro(gcode, '_STAND_IN_MESH', mesh, 0.01),
+            StandInMacro(gcode, '_STAND_IN_LOAD', load, 0.003),
+            StandInMacro(gcode, '_STAND_IN_START', start, 0.001)]
+
+def run_stand_in(capacity):
+    gcode = StandInGCode()
+    macros = stand_in_macros(gcode)
+    tracer = MacroTracer(gcode, capacity)
+    gcode.register_command('ZMOD_TRACE_POINT', lambda gcmd: tracer.point(gcmd.get('NAME'), bool(int(gcmd.get('END', 0)))))
+    count = tracer.install([(macro.alias, macro) for macro in macros])
+    gcode.run_script_from_command('_STAND_IN_START\n_STAND_IN_START')
+    tracer.uninstall()
+    if any(gcode.handlers[macro.alias] != macro.cmd for macro in macros):
+        raise RuntimeError("the original commands were not restored")
+    print(f"{count} macros traced, {gcode.dispatched} commands dispatched, {len(tracer.records)} records")
+    return tracer.records
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the macro timings recorded by [zmod_trace].")
+    parser.add_argument('dump_file', nargs='?', help="a file written by ZMOD_TRACE DUMP=1")
+    parser.add_argument('--stand-in', action='store_true', help="trace a few stand-in macros instead")
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP)
+    parser.add_argument('--sort', choices=SORT_KEYS, default='self')
+    parser.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY)
+    args = parser.parse_args()
+
+    if args.stand_in:
+        records = run_stand_in(args.capacity)
+    elif args.dump_file:
+        try:
+            records = load_dump(args.dump_file)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"{args.dump_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        parser.error("no dump file given")
+    print('\n'.join(report(records, args.top, args.sort)))
+
+if __name__ == "__main__":
+    main()
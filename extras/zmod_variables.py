@@ -0,0 +1,97 @@
+# Batched, change-only writes to the save_variables file.
+#
+# (C) 2024-2026 ghzserg https://zmod.link/
+#
+# [zmod_variables]
+#   Needs [save_variables]. No options.
+#
+# ZMOD_SAVE_VARIABLE VARIABLE=<name> VALUE=<literal>
+#   Takes the same arguments as SAVE_VARIABLE, but only stages the value, and only when it differs from what the
+#   variables file holds. Nothing is written.
+#
+# ZMOD_FLUSH_VARIABLES
+#   Writes every staged value with one atomic rewrite of the variables file, or does nothing if no value changed.
+#
+# Klipper's SAVE_VARIABLE rewrites the whole file for every call, so GET_ZMOD_DATA, SAVE_ZMOD_DATA and _RESET_ZMOD,
+# which save every setting, cost dozens of rewrites per call on the printer's eMMC, mostly of values that did not
+# change. The generated macros use ZMOD_SAVE_VARIABLE when this module is loaded and flush once after the generated
+# code, before anything that reads printer.save_variables again. Without it they fall back to SAVE_VARIABLE.
+
+import ast
+import configparser
+import logging
+import os
+
+class ZmodVariables:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.save_variables = self.printer.load_object(config, 'save_variables')
+        # name -> value, changes not written yet
+        self.pending = {}
+        self.flushes = 0
+        self.unchanged = 0
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('ZMOD_SAVE_VARIABLE', self.cmd_ZMOD_SAVE_VARIABLE,
+                               desc="Stage a variable for ZMOD_FLUSH_VARIABLES if its value changed")
+        gcode.register_command('ZMOD_FLUSH_VARIABLES', self.cmd_ZMOD_FLUSH_VARIABLES,
+                               desc="Write the staged variables to disk in one go")
+
+    def stage(self, name, value):
+        # The file holds repr() of every value, so a value only changes the file when its repr does (1 == True, but
+        # they are stored differently).
+        stored = self.save_variables.allVariables
+        if name in stored and repr(stored[name]) == repr(value):
+            self.pending.pop(name, None)
+            self.unchanged += 1
+            return False
+        self.pending[name] = value
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        variables = dict(self.save_variables.allVariables)
+        variables.update(self.pending)
+
+        # The format SAVE_VARIABLE writes, so either command can read what the other wrote.
+        varfile = configparser.ConfigParser()
+        varfile.add_section('Variables')
+        for name, value in sorted(variables.items()):
+            varfile.set('Variables', name, repr(value))
+
+        filename = self.save_variables.filename
+        temp_file = filename + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                varfile.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, filename)
+        except Exception:
+            msg = "Unable to save variables"
+            logging.exception(msg)
+            raise self.printer.command_error(msg)
+
+        count = len(self.pending)
+        self.pending = {}
+        self.flushes += 1
+        self.save_variables.loadVariables()
+        return count
+
+    def cmd_ZMOD_SAVE_VARIABLE(self, gcmd):
+        name = gcmd.get('VARIABLE')
+        value = gcmd.get('VALUE')
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
+        self.stage(name, value)
+
+    def cmd_ZMOD_FLUSH_VARIABLES(self, gcmd):
+        self.flush()
+
+    def get_status(self, eventtime):
+        return {'pending': len(self.pending), 'flushes': self.flushes, 'unchanged': self.unchanged}
+
+def load_config(config):
+    return ZmodVariables(config)
@@ -0,0 +1,122 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+# Installs a language pack written by csv/translate.py --pack, copying only what differs.
+#
+# Usage: python3 apply_pack.py <pack_dir> <lang> <target_dir> [--dry-run]
+#
+# <pack_dir>/<lang>.pack.json lists every config of the language with the sha256 of its content, the content itself is
+# <pack_dir>/objects/<first two hex digits>/<sha256>. A file is copied into target_dir only when the installed one has
+# a different hash, so switching languages or updating the mod rewrites the few files that actually changed instead of
+# the whole tree.
+#
+# What was installed is remembered in target_dir/.pack_state.json together with size and mtime, so unchanged files
+# are not even read again. A file whose size or mtime no longer matches (edited by hand) is hashed before it is
+# trusted. Files installed by an earlier pack that the new one no longer has are removed, unless they were modified.
+
+PACK_VERSION = 1
+PACK_SUFFIX = '.pack.json'
+STATE_FILE = '.pack_state.json'
+
+class PackError(Exception):
+    pass
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_state(target_dir):
+    try:
+        with open(os.path.join(target_dir, STATE_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f).get('files', {})
+    except (OSError, ValueError):
+        return {}
+
+def installed_hash(target_dir, name, state):
+    # Hash of the installed file, None if there is none.
+    path = os.path.join(target_dir, name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    entry = state.get(name, None)
+    if entry is not None and entry.get('size', None) == stat.st_size and entry.get('mtime_ns', None) == stat.st_mtime_ns:
+        return entry['hash']
+    return hash_file(path)
+
+def install(pack_dir, file_hash, path):
+    with open(os.path.join(pack_dir, 'objects', file_hash[:2], file_hash), 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != file_hash:
+        raise PackError(f"object {file_hash} is corrupt")
+
+    part_path = f"{path}.{os.getpid()}.part"
+    with open(part_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(part_path, path)
+    return len(data)
+
+def apply_pack(pack_dir, language, target_dir, dry_run=False):
+    # Returns (files, copied, bytes copied, removed).
+    with open(os.path.join(pack_dir, f"{language}{PACK_SUFFIX}"), 'r', encoding='utf-8') as f:
+        pack = json.load(f)
+    if pack.get('version', None) != PACK_VERSION:
+        raise PackError(f"unsupported pack version {pack.get('version', None)}")
+
+    state = load_state(target_dir)
+    new_state = {}
+    copied = 0
+    copied_bytes = 0
+    for name, entry in pack['files'].items():
+        path = os.path.join(target_dir, name)
+        if installed_hash(target_dir, name, state) != entry['hash']:
+            copied += 1
+            copied_bytes += entry['size']
+            if not dry_run:
+                install(pack_dir, entry['hash'], path)
+        if not dry_run:
+            stat = os.stat(path)
+            new_state[name] = {'hash': entry['hash'], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    removed = 0
+    for name, entry in state.items():
+        if name in pack['files']:
+            continue
+        if installed_hash(target_dir, name, state) == entry['hash']:
+            removed += 1
+            if not dry_run:
+                os.remove(os.path.join(target_dir, name))
+
+    if not dry_run:
+        part_path = os.path.join(target_dir, f"{STATE_FILE}.{os.getpid()}.part")
+        with open(part_path, 'w', encoding='utf-8') as f:
+            json.dump({'language': language, 'files': new_state}, f, indent=1)
+        os.replace(part_path, os.path.join(target_dir, STATE_FILE))
+    return len(pack['files']), copied, copied_bytes, removed
+
+def main():
+    parser = argparse.ArgumentParser(description="Install a language pack, copying only the files that differ.")
+    parser.add_argument('pack_dir')
+    parser.add_argument('language')
+    parser.add_argument('target_dir')
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be copied and removed")
+    args = parser.parse_args()
+
+    try:
+        files, copied, copied_bytes, removed = apply_pack(args.pack_dir, args.language, args.target_dir, args.dry_run)
+    except (OSError, ValueError, KeyError, PackError) as e:
+        print(f"{args.language}: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"{args.language}: {files} files, {copied} copied ({copied_bytes} bytes), {files - copied} unchanged, "
+          f"{removed} removed{' (dry run)' if args.dry_run else ''}")
+
+if __name__ == "__main__":
+    main()
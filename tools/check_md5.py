@@ -0,0 +1,205 @@
+import argparse
+import configparser
+import hashlib
+import os
+import re
+import sys
+import time
+
+# Single pass G-code verifier, a drop-in for the check_md5 shell command started by CHECK_MD5.
+#
+# Usage: python3 check_md5.py <file.gcode> [True|False] [--variables variables.cfg] [--chunk-size MB] [--progress]
+#
+# The file is read once in large chunks into one reusable buffer. For every chunk the MD5 is updated and the complete
+# lines of the chunk are scanned for arc (G2/G3) and plane select (G17/G18/G19) commands while the chunk is still hot.
+# Once an arc has been seen there is nothing left to lint and the rest of the file is only hashed.
+#
+# The slicer's checksum is the "; MD5:<hex>" first line, the MD5 is taken over everything after it. The result is
+# written as check_md5 into the save_variables file, where _CHECK_MD5 / _FINAL_CHECK_MD5 pick it up after
+# ZLOAD_VARIABLE:
+#
+#   1 - no file name given             5 - MD5 matches
+#   2 - file not found                 4 - MD5 matches, file has G2/G3 arcs
+#   3 - file has no MD5 checksum       8 - MD5 matches, file has G17/G18/G19 (and no arcs)
+#   6 - MD5 mismatch, file deleted     7 - MD5 mismatch
+#
+# A file without checksum is still linted, but reported as 3: the macros only show the missing checksum then.
+
+NO_FILENAME = 1
+NOT_FOUND = 2
+NO_CHECKSUM = 3
+HAS_ARCS = 4
+VERIFIED = 5
+MISMATCH_DELETED = 6
+MISMATCH = 7
+HAS_PLANE_SELECT = 8
+
+# Where ff5.cfg and ad5x.cfg point [save_variables] to.
+VARIABLES_FILES = ('/opt/config/mod_data/variables.cfg', '/usr/data/config/mod_data/variables.cfg')
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_HEADER_SIZE = 256
+
+MD5_HEADER = re.compile(rb'^;\s*MD5\s*:\s*([0-9a-fA-F]{32})\s*$')
+# A command at the start of a line, optionally after a line number. G2 must not match G28, G17 must not match G170.
+ARC_OR_PLANE = re.compile(rb'^[ \t]*(?:[Nn]\d+[ \t]+)?[Gg](0?[23]|1[789])(?![0-9.])', re.MULTILINE)
+ARC = re.compile(rb'^[ \t]*(?:[Nn]\d+[ \t]+)?[Gg]0?[23](?![0-9.])', re.MULTILINE)
+
+class VerifyResult:
+    __slots__ = ('code', 'expected_md5', 'actual_md5', 'has_arcs', 'has_plane_select', 'size', 'elapsed')
+
+    def __init__(self, code):
+        self.code = code
+        self.expected_md5 = None
+        self.actual_md5 = None
+        self.has_arcs = False
+        self.has_plane_select = False
+        self.size = 0
+        self.elapsed = 0.0
+
+class _Linter:
+    __slots__ = ('has_arcs', 'has_plane_select')
+
+    def __init__(self):
+        self.has_arcs = False
+        self.has_plane_select = False
+
+    def scan(self, data, pos=0, endpos=None):
+        # data[pos:endpos] must start at the beginning of a line and end with a complete one.
+        if endpos is None:
+            endpos = len(data)
+        while not self.has_arcs and pos < endpos:
+            if self.has_plane_select:
+                match = ARC.search(data, pos, endpos)
+            else:
+                match = ARC_OR_PLANE.search(data, pos, endpos)
+            if match is None:
+                return
+            if self.has_plane_select or match.group(1).lstrip(b'0') in (b'2', b'3'):
+                self.has_arcs = True
+            else:
+                self.has_plane_select = True
+            pos = match.end()
+
+def verify(filename, delete=False, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    # progress, if given, is called with the fraction of the file read after every chunk.
+    if not filename:
+        return VerifyResult(NO_FILENAME)
+    if not os.path.isfile(filename):
+        return VerifyResult(NOT_FOUND)
+
+    start = time.monotonic()
+    md5 = hashlib.md5()
+    linter = _Linter()
+    result = VerifyResult(NO_CHECKSUM)
+
+    total_size = os.path.getsize(filename) or 1
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as f:
+        # The checksum line is short, anything longer is not one.
+        carry = f.readline(MAX_HEADER_SIZE)
+        result.size = len(carry)
+        header = MD5_HEADER.match(carry.rstrip(b'\r\n'))
+        if header is not None:
+            result.expected_md5 = header.group(1).decode('ascii').lower()
+            carry = b''
+        else:
+            md5.update(carry)
+
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            result.size += count
+            md5.update(view[:count])
+            if progress is not None:
+                progress(min(result.size / total_size, 1.0))
+            if linter.has_arcs:
+                continue
+
+            # Lines cut by the chunk boundary are linted once they are complete.
+            first_newline = buffer.find(b'\n', 0, count)
+            if first_newline < 0:
+                carry += bytes(view[:count])
+                continue
+            linter.scan(carry + bytes(view[:first_newline + 1]))
+            last_newline = buffer.rfind(b'\n', first_newline, count)
+            linter.scan(buffer, first_newline + 1, last_newline + 1)
+            carry = bytes(view[last_newline + 1:count])
+
+    if carry:
+        linter.scan(carry)
+    view.release()
+
+    result.actual_md5 = md5.hexdigest()
+    result.has_arcs = linter.has_arcs
+    result.has_plane_select = linter.has_plane_select
+    if result.expected_md5 is None:
+        result.code = NO_CHECKSUM
+    elif result.expected_md5 != result.actual_md5:
+        if delete:
+            os.remove(filename)
+            result.code = MISMATCH_DELETED
+        else:
+            result.code = MISMATCH
+    elif linter.has_arcs:
+        result.code = HAS_ARCS
+    elif linter.has_plane_select:
+        result.code = HAS_PLANE_SELECT
+    else:
+        result.code = VERIFIED
+    result.elapsed = time.monotonic() - start
+    return result
+
+def find_variables_file():
+    for path in VARIABLES_FILES:
+        if os.path.isfile(path):
+            return path
+    return None
+
+def save_variable(variables_file, name, value):
+    # The same layout SAVE_VARIABLE writes, so ZLOAD_VARIABLE reads it back.
+    variables = configparser.ConfigParser()
+    variables.optionxform = str
+    variables.read(variables_file)
+    if not variables.has_section('Variables'):
+        variables.add_section('Variables')
+    variables.set('Variables', name, repr(value))
+
+    part_file = f"{variables_file}.{os.getpid()}.part"
+    with open(part_file, 'w') as f:
+        variables.write(f)
+    os.replace(part_file, variables_file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify the MD5 checksum of a G-code file and lint it for arcs.")
+    parser.add_argument('filename', nargs='?', default='')
+    parser.add_argument('delete', nargs='?', default='False', help="True to delete the file on MD5 mismatch")
+    parser.add_argument('--variables', help="save_variables file to write check_md5 to (default: the printer's)")
+    parser.add_argument('--chunk-size', type=float, default=DEFAULT_CHUNK_SIZE / (1024 * 1024), help="in MB")
+    parser.add_argument('--dry-run', action='store_true', help="only print the result")
+    parser.add_argument('--progress', action='store_true',
+                        help="print progress=<fraction> lines while reading, for extras/zmod_jobs.py")
+    args = parser.parse_args()
+
+    chunk_size = max(int(args.chunk_size * 1024 * 1024), 64 * 1024)
+    progress = None
+    if args.progress:
+        progress = lambda fraction: print(f"progress={fraction:.3f}", flush=True)
+    result = verify(args.filename, args.delete == 'True', chunk_size, progress)
+
+    print(f"check_md5={result.code} expected={result.expected_md5} actual={result.actual_md5} "
+          f"arcs={result.has_arcs} plane_select={result.has_plane_select} size={result.size} "
+          f"time={result.elapsed:.2f}s")
+
+    if args.dry_run:
+        return
+    variables_file = args.variables or find_variables_file()
+    if variables_file is None:
+        print("save_variables file not found, use --variables", file=sys.stderr)
+        sys.exit(1)
+    save_variable(variables_file, 'check_md5', result.code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+from check_md5 import MD5_HEADER, VARIABLES_FILES
+
+# Cached color / material metadata of G-code files, for the AD5X tool selection (scan_file_colors).
+#
+# Usage: python3 gcode_meta.py <file.gcode> [--index index.json] [--max-entries N] [--no-cache]
+#
+# Slicers write what the color menu needs into comment blocks at the start and the end of the file: the MD5 line and
+# the header block before the first command, and the config block (filament_colour, filament_type, filament used ...)
+# after the last one. parse() streams the header line by line until the first command and reads the tail backwards in
+# growing windows until the config block starts, so the middle of the file, which is nearly all of it, is never read.
+#
+# The result is kept in a JSON index keyed by the file's real path and validated by size, mtime and a fingerprint of
+# its first and last FINGERPRINT_SIZE bytes, which catches a file replaced by one of the same size and mtime. A file
+# that was already seen is answered from the index after one stat and two small reads. The index keeps at most
+# --max-entries files, the least recently used ones are evicted first.
+#
+# Prints one JSON object: colors, materials, tool_count, used_tools, has_checksum, cached.
+
+INDEX_VERSION = 1
+INDEX_NAME = 'gcode_meta.json'
+DEFAULT_MAX_ENTRIES = 500
+# seconds
+USED_RESOLUTION = 3600
+
+FINGERPRINT_SIZE = 4096
+MAX_LINE = 64 * 1024
+# The header of a file with large thumbnails can run to a few hundred KB.
+MAX_HEAD_SIZE = 2 * 1024 * 1024
+TAIL_WINDOW = 64 * 1024
+MAX_TAIL_SIZE = 2 * 1024 * 1024
+
+CONFIG_BLOCK_STARTS = (b'; CONFIG_BLOCK_START', b'; prusaslicer_config = begin')
+THUMBNAIL_BEGIN = re.compile(rb'^;\s*(thumbnail(_\w+)? begin|THUMBNAIL_BLOCK_START)')
+THUMBNAIL_END = re.compile(rb'^;\s*(thumbnail(_\w+)? end|THUMBNAIL_BLOCK_END)')
+COMMENT_VALUE = re.compile(rb'^;\s*([A-Za-z_][\w \[\]().-]*?)\s*[=:]\s*(.*?)\s*$')
+
+COLOR_KEYS = ('filament_colour', 'extruder_colour')
+MATERIAL_KEYS = ('filament_type',)
+USAGE_KEYS = ('filament used [g]', 'filament used [mm]')
+
+def _parse_lines(lines, values):
+    in_thumbnail = False
+    for line in lines:
+        if in_thumbnail:
+            in_thumbnail = THUMBNAIL_END.match(line) is None
+            continue
+        if THUMBNAIL_BEGIN.match(line) is not None:
+            in_thumbnail = True
+            continue
+        match = COMMENT_VALUE.match(line)
+        if match is not None:
+            values[match.group(1).decode('utf-8', 'replace').strip()] = match.group(2).decode('utf-8', 'replace')
+
+def _read_head(f, values):
+    # Comment lines up to the first command. Returns (has checksum, bytes read).
+    first = f.readline(MAX_LINE)
+    has_checksum = MD5_HEADER.match(first.rstrip(b'\r\n')) is not None
+    size = len(first)
+    lines = []
+    while size < MAX_HEAD_SIZE:
+        line = f.readline(MAX_LINE)
+        if not line:
+            break
+        size += len(line)
+        stripped = line.strip()
+        if stripped and not stripped.startswith(b';'):
+            break
+        lines.append(stripped)
+    _parse_lines(lines, values)
+    return has_checksum, size
+
+def _read_tail(f, file_size, head_size, values):
+    window = TAIL_WINDOW
+    while True:
+        start = max(file_size - window, head_size)
+        f.seek(start)
+        data = f.read(file_size - start)
+        found = any(marker in data for marker in CONFIG_BLOCK_STARTS)
+        if found or start == head_size or window >= MAX_TAIL_SIZE:
+            break
+        window *= 2
+    lines = data.split(b'\n')
+    if start > head_size:
+        # The first line is cut by the window.
+        lines = lines[1:]
+    _parse_lines([line.strip() for line in lines], values)
+
+def _split(value, separator):
+    return [item.strip() for item in value.split(separator) if item.strip()]
+
+def parse(filename):
+    values = {}
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        has_checksum, head_size = _read_head(f, values)
+        if head_size < file_size:
+            _read_tail(f, file_size, head_size, values)
+
+    colors = next((_split(values[key], ';') for key in COLOR_KEYS if values.get(key, '')), [])
+    materials = next((_split(values[key], ';') for key in MATERIAL_KEYS if values.get(key, '')), [])
+    used_tools = []
+    for key in USAGE_KEYS:
+        if values.get(key, ''):
+            try:
+                usage = [float(item) for item in _split(values[key], ',')]
+            except ValueError:
+                continue
+            used_tools = [tool for tool, amount in enumerate(usage) if amount > 0]
+            break
+
+    return {
+        'colors': colors,
+        'materials': materials,
+        'tool_count': len(used_tools) if used_tools else max(len(colors), len(materials)),
+        'used_tools': used_tools,
+        'has_checksum': has_checksum
+    }
+
+def fingerprint(filename, file_size):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_SIZE))
+        if file_size > FINGERPRINT_SIZE:
+            f.seek(max(file_size - FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+            digest.update(f.read(FINGERPRINT_SIZE))
+    return digest.hexdigest()
+
+class MetadataIndex:
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version', None) == INDEX_VERSION:
+                self.entries = data.get('entries', {})
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, filename):
+        # Returns (metadata, True if it came from the index).
+        key = os.path.realpath(filename)
+        stat = os.stat(key)
+        file_fingerprint = fingerprint(key, stat.st_size)
+        entry = self.entries.get(key, None)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns and \
+                entry['fingerprint'] == file_fingerprint:
+            # The eviction order only needs to be roughly right, not worth a write on every hit.
+            now = time.time()
+            if now - entry['used'] > USED_RESOLUTION:
+                entry['used'] = now
+                self.dirty = True
+            return entry['meta'], True
+
+        meta = parse(key)
+        self.entries[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fingerprint': file_fingerprint,
+                             'used': time.time(), 'meta': meta}
+        self.dirty = True
+        return meta, False
+
+    def save(self):
+        if not self.dirty:
+            return
+        # Drop files that are gone, then the least recently used ones above the cap.
+        entries = [(key, entry) for key, entry in self.entries.items() if os.path.exists(key)]
+        entries.sort(key=lambda item: item[1]['used'], reverse=True)
+        self.entries = dict(entries[:self.max_entries])
+
+        part_path = f"{self.path}.{os.getpid()}.part"
+        with open(part_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'entries': self.entries}, f, separators=(',', ':'))
+        os.replace(part_path, self.path)
+        self.dirty = False
+
+def default_index_path():
+    # Next to the save_variables file, in mod_data.
+    for path in VARIABLES_FILES:
+        if os.path.isdir(os.path.dirname(path)):
+            return os.path.join(os.path.dirname(path), INDEX_NAME)
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the color / material metadata of a G-code file, cached.")
+    parser.add_argument('filename')
+    parser.add_argument('--index', help="index file (default: gcode_meta.json next to the printer's variables.cfg)")
+    parser.add_argument('--max-entries', type=int, default=DEFAULT_MAX_ENTRIES)
+    parser.add_argument('--no-cache', action='store_true', help="parse the file and leave the index alone")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.filename):
+        print(f"{args.filename} not found", file=sys.stderr)
+        sys.exit(1)
+
+    index_path = args.index or default_index_path()
+    if args.no_cache or index_path is None:
+        meta, cached = parse(args.filename), False
+    else:
+        index = MetadataIndex(index_path, max(args.max_entries, 1))
+        meta, cached = index.lookup(args.filename)
+        index.save()
+
+    result = dict(meta)
+    result['cached'] = cached
+    print(json.dumps(result, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+import argparse
+import hashlib
+import math
+import os
+import queue
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from check_md5 import DEFAULT_CHUNK_SIZE, MAX_HEADER_SIZE, MD5_HEADER, VERIFIED, find_variables_file, save_variable, \
+    verify
+
+# Rewrites the G2/G3 arcs of a G-code file as G1 segments and drops G17/G18/G19, for printers without [gcode_arcs].
+#
+# Usage: python3 linearize_arcs.py <file.gcode> [--output out.gcode] [--tolerance MM] [--chunk-size MB]
+#                                  [--variables variables.cfg] [--dry-run] [--progress]
+#        python3 linearize_arcs.py --bench MB
+#
+# check_md5.py reports such a file as 4 (arcs) or 8 (plane select), which the FF5M's Klipper cannot print. This turns
+# it into one it can: every arc becomes the chords of a polygon that stays within --tolerance mm of the arc, with Z of
+# a helical arc and E spread evenly over the chords. The arc plane follows G17/G18/G19 the way Klipper's gcode_arcs
+# reads them (G18 is X/Z with I/K, G19 Y/Z with J/K), R arcs are supported, P (turns) is not.
+#
+# The file is streamed: read in --chunk-size chunks, the complete lines of a chunk searched for the few commands that
+# matter (arcs, plane select, G90/G91, M82/M83, G92, G28), everything between them copied as it is. An arc only needs
+# the position it starts from, which is the last X/Y/Z/E word before it: it is looked up backwards from the arc, never
+# further than the previous one of those commands. Moves in relative mode (G91) are not summed up, arcs there do not
+# need a start. Output goes through a write-behind thread, so hashing and writing overlap with the transform and at
+# most WRITE_QUEUE buffers are ever held.
+#
+# The input's "; MD5:" line is verified on the way and the output gets a new one over what was written. A file with a
+# wrong checksum, G20 (inches) or an arc that cannot be converted is left alone, nothing is ever half replaced: the
+# output is written next to the file and renamed over it at the end. On success check_md5 is set to 5 in the
+# save_variables file, like check_md5.py would for a clean file.
+
+DEFAULT_TOLERANCE = 0.01
+# Chords of a tiny arc within the tolerance could be a single one, which for a full circle goes nowhere.
+MAX_SEGMENT_ANGLE = math.pi / 4
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_QUEUE = 4
+PLACEHOLDER_MD5 = b'0' * 32
+
+# The commands that change what an arc is converted from. G2 must not match G28, G17 must not match G170.
+COMMAND = re.compile(rb'^[ \t]*(?:[Nn]\d+[ \t]+)?([Gg](?:0?[23]|1[789]|9[012]|2[08])|[Mm]8[23])(?![0-9.])',
+                     re.MULTILINE)
+MOVE = re.compile(rb'^[ \t]*[Gg]0?[01](?![0-9.])', re.MULTILINE)
+WORD = re.compile(rb'([A-Za-z])[ \t]*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))')
+AXIS_WORDS = dict((axis, re.compile(rb'(?<![A-Za-z])' + axis + rb'[ \t]*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))'))
+                  for axis in (b'X', b'Y', b'Z', b'E'))
+ARC_WORDS = set('XYZEFIJKR')
+
+# plane: (first axis, second axis, helical axis, offset of the first, offset of the second)
+PLANES = {
+    17: ('X', 'Y', 'Z', 'I', 'J'),
+    18: ('X', 'Z', 'Y', 'I', 'K'),
+    19: ('Y', 'Z', 'X', 'J', 'K')
+}
+
+class TransformError(Exception):
+    pass
+
+class TransformResult:
+    __slots__ = ('arcs', 'segments', 'plane_selects', 'expected_md5', 'input_md5', 'output_md5', 'input_size',
+                 'output_size', 'elapsed')
+
+    def __init__(self):
+        self.arcs = 0
+        self.segments = 0
+        self.plane_selects = 0
+        self.expected_md5 = None
+        self.input_md5 = None
+        self.output_md5 = None
+        self.input_size = 0
+        self.output_size = 0
+        self.elapsed = 0.0
+
+    def changed(self):
+        return self.arcs > 0 or self.plane_selects > 0
+
+class WriteBehind:
+    # Hashes and writes buffers on a thread of its own. f may be None, then only the hash is kept.
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.buffer = bytearray()
+        self.queue = queue.Queue(WRITE_QUEUE)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.md5.update(data)
+                if self.f is not None:
+                    self.f.write(data)
+            except OSError as e:
+                self.error = e
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= WRITE_BUFFER_SIZE:
+            self.queue.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        # Returns the hex MD5 of everything written.
+        if self.buffer:
+            self.queue.put(bytes(self.buffer))
+            self.buffer.clear()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.md5.hexdigest()
+
+def _number(value, digits):
+    text = ('%.3f' if digits == 3 else '%.5f') % value
+    text = text.rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+def _words(code):
+    return dict((letter.decode('ascii').upper(), float(value)) for letter, value in WORD.findall(code))
+
+def _last_axis_value(data, low, high, axis):
+    # The value of the last G0/G1 word for axis in data[low:high], None if there is none. low is a line start.
+    end = high
+    while end > low:
+        pos = data.rfind(axis, low, end)
+        if pos < 0:
+            return None
+        line_start = data.rfind(b'\n', low, pos) + 1
+        if line_start < low:
+            line_start = low
+        line_end = data.find(b'\n', pos, high)
+        if line_end < 0:
+            line_end = high
+        code = data[line_start:line_end].split(b';', 1)[0]
+        if MOVE.match(code):
+            match = None
+            for match in AXIS_WORDS[axis].finditer(code):
+                pass
+            if match is not None:
+                return float(match.group(1))
+        end = line_start
+    return None
+
+class ArcLinearizer:
+    def __init__(self, tolerance=DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+        self.plane = 17
+        self.absolute_coord = True
+        self.absolute_extrude = True
+        # The G-code position after the last command handled, None where it is not known.
+        self.position = {'X': None, 'Y': None, 'Z': None, 'E': None}
+        self.arcs = 0
+        self.segments = 0
+        self.plane_selects = 0
+
+    def _relative(self, axis):
+        return not self.absolute_coord or (axis == 'E' and not self.absolute_extrude)
+
+    def _catch_up(self, data, low, high):
+        # Brings position up to data[high], data[low:high] holding only moves since the last command handled.
+        if low >= high:
+            return
+        moved = None
+        for axis in self.position:
+            if self._relative(axis):
+                if self.position[axis] is not None:
+                    if moved is None:
+                        moved = MOVE.search(data, low, high) is not None
+                    if moved:
+                        self.position[axis] = None
+                continue
+            value = _last_axis_value(data, low, high, axis.encode('ascii'))
+            if value is not None:
+                self.position[axis] = value
+
+    def process(self, data, end, write):
+        # Transforms the complete lines data[:end], calling write() with what replaces them.
+        handled = 0
+        copied = 0
+        for match in COMMAND.finditer(data, 0, end):
+            line_start = match.start()
+            line_end = data.find(b'\n', line_start, end) + 1
+            if line_end == 0:
+                line_end = end
+            self._catch_up(data, handled, line_start)
+            replacement = self._handle(match.group(1), data[line_start:line_end])
+            if replacement is not None:
+                write(data[copied:line_start])
+                write(replacement)
+                copied = line_end
+            handled = line_end
+        self._catch_up(data, handled, end)
+        write(data[copied:end])
+
+    def _handle(self, command, line):
+        # Returns what replaces line, None to keep it.
+        letter = command[:1].upper()
+        number = int(command[1:])
+        if letter == b'M':
+            self.absolute_extrude = number == 82
+            return None
+        if number in PLANES:
+            self.plane = number
+            self.plane_selects += 1
+            return b''
+        if number == 20:
+            raise TransformError("G20 (inch units) is not supported")
+        code = line.split(b';', 1)[0]
+        words = _words(code[code.upper().find(command.upper()) + len(command):])
+        if number == 90:
+            self.absolute_coord = True
+        elif number == 91:
+            self.absolute_coord = False
+        elif number == 92:
+            for axis in self.position:
+                if axis in words or not words:
+                    self.position[axis] = words.get(axis, 0.0)
+        elif number == 28:
+            homed = [axis for axis in 'XYZ' if axis in words] or ['X', 'Y', 'Z']
+            for axis in homed:
+                self.position[axis] = None
+        elif number == 21:
+            return None
+        elif number in (2, 3):
+            return self._linearize(number == 2, words, line)
+        return None
+
+    def _linearize(self, clockwise, words, line):
+        if not set(words) <= ARC_WORDS or line.lstrip()[:1] in (b'N', b'n') or b'*' in line.split(b';', 1)[0]:
+            raise TransformError(f"unsupported arc: {line.strip().decode('utf-8', 'replace')}")
+        first, second, helical, first_offset, second_offset = PLANES[self.plane]
+
+        start = {}
+        target = {}
+        for axis in (first, second, helical):
+            if self.absolute_coord:
+                start[axis] = self.position[axis]
+                if start[axis] is None and (axis != helical or axis not in words):
+                    raise TransformError(f"arc from an unknown {axis} position: {line.strip().decode('utf-8', 'replace')}")
+                target[axis] = words.get(axis, start[axis])
+                if start[axis] is None:
+                    start[axis] = target[axis]
+            else:
+                start[axis] = 0.0
+                target[axis] = words.get(axis, 0.0)
+
+        extrude = None
+        if 'E' in words:
+            if self._relative('E'):
+                extrude = words['E']
+            elif self.position['E'] is None:
+                raise TransformError(f"arc from an unknown E position: {line.strip().decode('utf-8', 'replace')}")
+            else:
+                extrude = words['E'] - self.position['E']
+
+        delta_first = target[first] - start[first]
+        delta_second = target[second] - start[second]
+        if 'R' in words:
+            radius = words['R']
+            distance = math.hypot(delta_first, delta_second)
+            height = 4.0 * radius * radius - distance * distance
+            if distance == 0.0 or height < -1e-9:
+                raise TransformError(f"arc radius does not reach its end: {line.strip().decode('utf-8', 'replace')}")
+            # The center on the side the direction and the sign of R ask for, as in RS274.
+            ratio = -math.sqrt(max(height, 0.0)) / distance
+            if not clockwise:
+                ratio = -ratio
+            if radius < 0:
+                ratio = -ratio
+            offset = (0.5 * (delta_first - delta_second * ratio), 0.5 * (delta_second + delta_first * ratio))
+        else:
+            offset = (words.get(first_offset, 0.0), words.get(second_offset, 0.0))
+
+        # Angular travel, the way Klipper's gcode_arcs plans it.
+        r_first, r_second = -offset[0], -offset[1]
+        center_first, center_second = start[first] + offset[0], start[second] + offset[1]
+        rt_first, rt_second = target[first] - center_first, target[second] - center_second
+        travel = math.atan2(r_first * rt_second - r_second * rt_first, r_first * rt_first + r_second * rt_second)
+        if travel < 0.0:
+            travel += 2.0 * math.pi
+        if clockwise:
+            travel -= 2.0 * math.pi
+        if travel == 0.0 and delta_first == 0.0 and delta_second == 0.0:
+            travel = 2.0 * math.pi
+
+        radius = math.hypot(r_first, r_second)
+        if radius > self.tolerance:
+            segment_angle = min(2.0 * math.acos(1.0 - self.tolerance / radius), MAX_SEGMENT_ANGLE)
+        else:
+            segment_angle = MAX_SEGMENT_ANGLE
+        count = max(1, int(math.ceil(abs(travel) / segment_angle - 1e-9)))
+
+        ending = b'\r\n' if line.endswith(b'\r\n') else b'\n'
+        comment = line.rstrip(b'\r\n').partition(b';')[2]
+        helical_start = start[helical]
+        helical_delta = target[helical] - helical_start
+        relative = not self.absolute_coord
+        relative_e = self._relative('E')
+        base_e = self.position['E'] or 0.0
+        names = (first, second, helical) if helical_delta != 0.0 else (first, second)
+        previous = [round(start[axis], 3) for axis in names]
+        previous_e = 0.0
+        feedrate = ' F' + _number(words['F'], 3) if 'F' in words else ''
+        out = []
+        for index in range(1, count + 1):
+            if index == count:
+                point = [target[axis] for axis in names]
+            else:
+                angle = travel * index / count
+                cos_angle, sin_angle = math.cos(angle), math.sin(angle)
+                point = [center_first + r_first * cos_angle - r_second * sin_angle,
+                         center_second + r_first * sin_angle + r_second * cos_angle,
+                         helical_start + helical_delta * index / count][:len(names)]
+            parts = ['G1']
+            for slot, axis in enumerate(names):
+                value = round(point[slot], 3)
+                parts.append(axis + _number(value - previous[slot] if relative else value, 3))
+                previous[slot] = value
+            if extrude is not None:
+                cumulative = round(extrude * index / count, 5)
+                parts.append('E' + _number(cumulative - previous_e if relative_e else base_e + cumulative, 5))
+                previous_e = cumulative
+            text = ' '.join(parts)
+            if index == 1:
+                text = (text + feedrate).encode('ascii')
+                if comment:
+                    text += b' ;' + comment
+                out.append(text + ending)
+            else:
+                out.append(text.encode('ascii') + ending)
+
+        if self.absolute_coord:
+            for axis in (first, second, helical):
+                self.position[axis] = target[axis]
+        if extrude is not None and not self._relative('E'):
+            self.position['E'] = words['E']
+        self.arcs += 1
+        self.segments += count
+        return b''.join(out)
+
+def linearize(filename, output, tolerance=DEFAULT_TOLERANCE, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    # Writes the linearized filename to output (None: only count what would change). Returns a TransformResult,
+    # raises TransformError when the file cannot be converted.
+    start = time.monotonic()
+    result = TransformResult()
+    linearizer = ArcLinearizer(tolerance)
+    input_md5 = hashlib.md5()
+    total_size = os.path.getsize(filename) or 1
+
+    out_file = open(output, 'wb') if output is not None else None
+    try:
+        with open(filename, 'rb', buffering=0) as f:
+            first = f.readline(MAX_HEADER_SIZE)
+            result.input_size = len(first)
+            header = MD5_HEADER.match(first.rstrip(b'\r\n'))
+            if header is not None:
+                result.expected_md5 = header.group(1).decode('ascii').lower()
+                # Patched once the MD5 of the rest is known, the same length whatever it is.
+                if out_file is not None:
+                    out_file.write(b'; MD5:' + PLACEHOLDER_MD5 + b'\n')
+                carry = b''
+            else:
+                input_md5.update(first)
+                carry = first
+
+            writer = WriteBehind(out_file)
+            buffer = bytearray(chunk_size)
+            view = memoryview(buffer)
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                result.input_size += count
+                input_md5.update(view[:count])
+                data = carry + view[:count]
+                end = data.rfind(b'\n') + 1
+                linearizer.process(data, end, writer.write)
+                carry = data[end:]
+                if progress is not None:
+                    progress(min(result.input_size / total_size, 1.0))
+            if carry:
+                linearizer.process(carry, len(carry), writer.write)
+            view.release()
+            result.output_md5 = writer.close()
+            result.output_size = writer.size
+
+        result.input_md5 = input_md5.hexdigest()
+        if result.expected_md5 is not None and result.expected_md5 != result.input_md5:
+            raise TransformError(f"MD5 mismatch, expected {result.expected_md5}, got {result.input_md5}")
+        if result.expected_md5 is not None:
+            result.output_size += len(b'; MD5:' + PLACEHOLDER_MD5 + b'\n')
+            if out_file is not None:
+                out_file.seek(0)
+                out_file.write(b'; MD5:' + result.output_md5.encode('ascii'))
+        if out_file is not None:
+            out_file.flush()
+            os.fsync(out_file.fileno())
+    finally:
+        if out_file is not None:
+            out_file.close()
+
+    result.arcs = linearizer.arcs
+    result.segments = linearizer.segments
+    result.plane_selects = linearizer.plane_selects
+    result.elapsed = time.monotonic() - start
+    return result
+
+def linearize_in_place(filename, output=None, tolerance=DEFAULT_TOLERANCE, chunk_size=DEFAULT_CHUNK_SIZE,
+                       progress=None, dry_run=False):
+    # output defaults to filename. The file is only replaced when something changed and everything converted.
+    target = output or filename
+    part_path = None if dry_run else f"{target}.{os.getpid()}.part"
+    try:
+        result = linearize(filename, part_path, tolerance, chunk_size, progress)
+        if part_path is not None and (result.changed() or output is not None):
+            os.replace(part_path, target)
+            part_path = None
+        return result
+    finally:
+        if part_path is not None and os.path.exists(part_path):
+            os.remove(part_path)
+
+def synthetic_gcode(path, size):
+    # A print of about size bytes: layers of extrusion moves, each with a spiral Z hop (G17 + helical G2) and a few
+    # G3 arcs with I/J as slicers write them for arc fitting, MD5 header included.
+    md5 = hashlib.md5()
+    written = 0
+    with open(path, 'wb') as f:
+        f.write(b'; MD5:' + PLACEHOLDER_MD5 + b'\n')
+
+        def emit(text):
+            nonlocal written
+            data = text.encode('ascii')
+            md5.update(data)
+            f.write(data)
+            written += len(data)
+
+        emit("; generated by linearize_arcs.py --bench\nG90\nM83\nG28\nG1 X110 Y110 Z0.3 F6000\n")
+        layer = 0
+        while written < size:
+            layer += 1
+            z = 0.2 * layer + 0.1
+            lines = [f";LAYER_CHANGE\n;Z:{z:.2f}\nG1 Z{z:.2f} F600\n", ";TYPE:Outer wall\n"]
+            for index in range(400):
+                x = 60 + (index * 7) % 100
+                y = 60 + (index * 13) % 100
+                lines.append(f"G1 X{x}.{index % 10} Y{y}.{(index * 3) % 10} E0.{10000 + index * 37 % 89999} F3000\n")
+                if index % 50 == 25:
+                    lines.append(f"G3 X{x + 2}.5 Y{y + 2}.5 I1.25 J1.25 E0.0834\n")
+            lines.append(f"G17\nG2 Z{z + 0.4:.2f} I0.86 J0.5 F12000\n")
+            lines.append(f"G1 X{60 + layer % 100} Y60 F12000\nG1 Z{z:.2f}\n")
+            emit(''.join(lines))
+        f.seek(0)
+        f.write(b'; MD5:' + md5.hexdigest().encode('ascii'))
+    return written
+
+def bench(size_mb, tolerance, chunk_size):
+    with tempfile.TemporaryDirectory(prefix='linearize_arcs_') as work_dir:
+        source = os.path.join(work_dir, 'bench.gcode')
+        size = synthetic_gcode(source, int(size_mb * 1024 * 1024))
+
+        verify_result = verify(source, False, chunk_size)
+        result = linearize_in_place(source, os.path.join(work_dir, 'out.gcode'), tolerance, chunk_size)
+        check = verify(os.path.join(work_dir, 'out.gcode'), False, chunk_size)
+
+    mb = size / (1024 * 1024)
+    print(f"input         {mb:9.1f} MB, {result.arcs} arcs, {result.plane_selects} plane selects")
+    print(f"output        {result.output_size / (1024 * 1024):9.1f} MB, {result.segments} segments")
+    print(f"check_md5     {verify_result.elapsed:9.2f} s  {mb / max(verify_result.elapsed, 1e-9):8.1f} MB/s")
+    print(f"linearize     {result.elapsed:9.2f} s  {mb / max(result.elapsed, 1e-9):8.1f} MB/s")
+    print(f"peak RSS      {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:9.1f} MB")
+    print(f"output check_md5={check.code}")
+    if check.code != VERIFIED:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replace the G2/G3 arcs of a G-code file with G1 segments.")
+    parser.add_argument('filename', nargs='?')
+    parser.add_argument('--output', help="write here instead of replacing the file")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f"max distance of a chord from the arc in mm (default: {DEFAULT_TOLERANCE})")
+    parser.add_argument('--chunk-size', type=float, default=DEFAULT_CHUNK_SIZE / (1024 * 1024), help="in MB")
+    parser.add_argument('--variables', help="save_variables file to write check_md5 to (default: the printer's)")
+    parser.add_argument('--dry-run', action='store_true', help="only count what would change")
+    parser.add_argument('--progress', action='store_true',
+                        help="print progress=<fraction> lines while reading, for extras/zmod_jobs.py")
+    parser.add_argument('--bench', type=float, metavar='MB', help="benchmark on a synthetic file of this size")
+    args = parser.parse_args()
+
+    chunk_size = max(int(args.chunk_size * 1024 * 1024), 64 * 1024)
+    tolerance = max(args.tolerance, 0.0001)
+    if args.bench:
+        bench(args.bench, tolerance, chunk_size)
+        return
+    if not args.filename or not os.path.isfile(args.filename):
+        print(f"{args.filename}: file not found", file=sys.stderr)
+        sys.exit(1)
+
+    progress = None
+    if args.progress:
+        progress = lambda fraction: print(f"progress={fraction:.3f}", flush=True)
+    try:
+        result = linearize_in_place(args.filename, args.output, tolerance, chunk_size, progress, args.dry_run)
+    except (OSError, TransformError) as e:
+        print(f"linearize_arcs=failed {args.filename}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"linearize_arcs=done arcs={result.arcs} segments={result.segments} plane_select={result.plane_selects} "
+          f"size={result.input_size}->{result.output_size} md5={result.output_md5} time={result.elapsed:.2f}s")
+    if args.dry_run or args.output or result.expected_md5 is None:
+        return
+    variables_file = args.variables or find_variables_file()
+    if variables_file is None:
+        print("save_variables file not found, use --variables", file=sys.stderr)
+        sys.exit(1)
+    save_variable(variables_file, 'check_md5', VERIFIED)
+
+if __name__ == "__main__":
+    main()